@@ -1,3 +1,5 @@
+import os
+import sys
 from logging.config import fileConfig
 
 from sqlalchemy import engine_from_config
@@ -14,11 +16,17 @@ config = context.config
 if config.config_file_name is not None:
     fileConfig(config.config_file_name)
 
+# models.py is imported from app/ by module name, like the app does
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+from models import db  # noqa: E402
+
 # add your model's MetaData object here
 # for 'autogenerate' support
-# from myapp import mymodel
-# target_metadata = mymodel.Base.metadata
-target_metadata = None
+target_metadata = db.metadata
+
+# Migrate the database the app is configured with, unless alembic.ini is used as is
+if os.getenv("DATABASE_URI"):
+    config.set_main_option("sqlalchemy.url", os.getenv("DATABASE_URI"))
 
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
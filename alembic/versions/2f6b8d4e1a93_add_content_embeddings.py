@@ -0,0 +1,36 @@
+"""add content embeddings
+
+Revision ID: 2f6b8d4e1a93
+Revises: e5a7c0d93f14
+Create Date: 2026-10-18 15:21:09.734518
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "2f6b8d4e1a93"
+down_revision: Union[str, None] = "e5a7c0d93f14"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Databases set up by the app itself already have both
+    op.execute(
+        """
+        CREATE TABLE IF NOT EXISTS content_embeddings (
+            content_hash VARCHAR(64) PRIMARY KEY,
+            embedding vector(384) NOT NULL,
+            ref_count INTEGER NOT NULL DEFAULT 0
+        )
+        """
+    )
+    op.execute("ALTER TABLE embeddings ADD COLUMN IF NOT EXISTS content_hash VARCHAR(64)")
+
+
+def downgrade() -> None:
+    op.drop_column("embeddings", "content_hash")
+    op.drop_table("content_embeddings")
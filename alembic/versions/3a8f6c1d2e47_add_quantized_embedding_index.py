@@ -0,0 +1,60 @@
+"""add quantized embedding index
+
+Revision ID: 3a8f6c1d2e47
+Revises: 7d0e2c95b6a1
+Create Date: 2026-10-18 21:40:12.507318
+
+"""
+import os
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "3a8f6c1d2e47"
+down_revision: Union[str, None] = "7d0e2c95b6a1"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Expression indices for EMBEDDING_QUANTIZATION (see app/quantization.py), they
+# need pgvector >= 0.7. The expressions must match the queries exactly
+QUANTIZED_INDEXES = {
+    "half": (
+        "ix_embeddings_embedding_half_hnsw",
+        "((embedding::halfvec(384)) halfvec_l2_ops)",
+    ),
+    "binary": (
+        "ix_embeddings_embedding_binary_hnsw",
+        "((binary_quantize(embedding)::bit(384)) bit_hamming_ops)",
+    ),
+}
+FULL_INDEX = ("ix_embeddings_embedding_hnsw", "(embedding vector_l2_ops)")
+
+
+def create_index(name: str, expression: str) -> None:
+    op.execute(
+        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON embeddings "
+        f"USING hnsw {expression} WITH (m = 16, ef_construction = 64)"
+    )
+
+
+def upgrade() -> None:
+    # Only with quantization enabled, run with the same EMBEDDING_QUANTIZATION as
+    # the app. To switch modes later, downgrade this revision and upgrade again
+    mode = os.getenv("EMBEDDING_QUANTIZATION", "none")
+    if mode not in QUANTIZED_INDEXES:
+        return
+    # Built without locking out writes, which can't happen inside a transaction
+    with op.get_context().autocommit_block():
+        create_index(*QUANTIZED_INDEXES[mode])
+        # Approximate searches only use the quantized index now, re-ranking
+        # reads the full vectors of the shortlist from the table
+        op.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {FULL_INDEX[0]}")
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        create_index(*FULL_INDEX)
+        for name, _ in QUANTIZED_INDEXES.values():
+            op.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
@@ -0,0 +1,31 @@
+"""add hnsw index to embeddings
+
+Revision ID: 4b1d9e7c2a05
+Revises:
+Create Date: 2026-10-18 09:12:41.318502
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "4b1d9e7c2a05"
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute("CREATE EXTENSION IF NOT EXISTS vector")
+    # IF NOT EXISTS, since fresh databases get the index from db.create_all()
+    op.execute(
+        "CREATE INDEX IF NOT EXISTS ix_embeddings_embedding_hnsw "
+        "ON embeddings USING hnsw (embedding vector_l2_ops) "
+        "WITH (m = 16, ef_construction = 64)"
+    )
+
+
+def downgrade() -> None:
+    op.execute("DROP INDEX IF EXISTS ix_embeddings_embedding_hnsw")
@@ -0,0 +1,43 @@
+"""add embedding neighbors
+
+Revision ID: 7d0e2c95b6a1
+Revises: 2f6b8d4e1a93
+Create Date: 2026-10-18 16:05:44.290671
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "7d0e2c95b6a1"
+down_revision: Union[str, None] = "2f6b8d4e1a93"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Databases set up by the app itself already have the table
+    op.execute(
+        """
+        CREATE TABLE IF NOT EXISTS embedding_neighbors (
+            embedding_id INTEGER NOT NULL REFERENCES embeddings (id) ON DELETE CASCADE,
+            rank SMALLINT NOT NULL,
+            neighbor_id INTEGER NOT NULL REFERENCES embeddings (id) ON DELETE CASCADE,
+            PRIMARY KEY (embedding_id, rank)
+        )
+        """
+    )
+    # Deleting an image cascades to the edges pointing at it
+    op.create_index(
+        "ix_embedding_neighbors_neighbor_id",
+        "embedding_neighbors",
+        ["neighbor_id"],
+        if_not_exists=True,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_embedding_neighbors_neighbor_id", table_name="embedding_neighbors")
+    op.drop_table("embedding_neighbors")
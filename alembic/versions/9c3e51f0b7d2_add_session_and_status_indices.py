@@ -0,0 +1,55 @@
+"""add session and status indices
+
+Revision ID: 9c3e51f0b7d2
+Revises: 4b1d9e7c2a05
+Create Date: 2026-10-18 11:47:05.102377
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "9c3e51f0b7d2"
+down_revision: Union[str, None] = "4b1d9e7c2a05"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # users.email and sweep_sessions.sweep_session_token are already indexed
+    # through their unique constraints
+    op.create_index(
+        "ix_embeddings_session_status",
+        "embeddings",
+        ["sweep_session_token", "status"],
+        if_not_exists=True,
+    )
+    op.create_index(
+        "ix_embeddings_session_display_path",
+        "embeddings",
+        ["sweep_session_token", "display_path"],
+        if_not_exists=True,
+    )
+    op.create_index(
+        "ix_embeddings_session_unreviewed",
+        "embeddings",
+        ["sweep_session_token", "id"],
+        postgresql_where=sa.text("status = 'unreviewed'"),
+        if_not_exists=True,
+    )
+    op.create_index(
+        "ix_sweep_sessions_user_id",
+        "sweep_sessions",
+        ["user_id", "id"],
+        if_not_exists=True,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_sweep_sessions_user_id", table_name="sweep_sessions")
+    op.drop_index("ix_embeddings_session_unreviewed", table_name="embeddings")
+    op.drop_index("ix_embeddings_session_display_path", table_name="embeddings")
+    op.drop_index("ix_embeddings_session_status", table_name="embeddings")
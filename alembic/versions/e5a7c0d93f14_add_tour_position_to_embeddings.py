@@ -0,0 +1,37 @@
+"""add tour position to embeddings
+
+Revision ID: e5a7c0d93f14
+Revises: 9c3e51f0b7d2
+Create Date: 2026-10-18 14:02:31.518204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "e5a7c0d93f14"
+down_revision: Union[str, None] = "9c3e51f0b7d2"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Tables created by the app itself already have the column
+    op.execute("ALTER TABLE embeddings ADD COLUMN IF NOT EXISTS tour_position INTEGER")
+    # Only unreviewed images are ever looked up on the tour, so reviewed ones
+    # drop out of the index and the next image is the first entry past the cursor
+    op.create_index(
+        "ix_embeddings_session_tour",
+        "embeddings",
+        ["sweep_session_token", "tour_position"],
+        postgresql_where=sa.text("status = 'unreviewed'"),
+        if_not_exists=True,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_embeddings_session_tour", table_name="embeddings")
+    op.drop_column("embeddings", "tour_position")
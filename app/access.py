@@ -0,0 +1,40 @@
+import time
+import logging
+import datetime
+import threading
+from typing import Callable, Dict
+
+
+class AccessTracker:
+    """Last access time per key, collected in memory and written out in bulk at most every `interval` seconds."""
+
+    def __init__(
+        self,
+        interval: float,
+        write: Callable[[Dict[str, datetime.datetime]], None],
+    ) -> None:
+        self.interval = interval
+        self._write = write
+        self._pending: Dict[str, datetime.datetime] = {}
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+    def touch(self, key: str) -> None:
+        """Record an access, flushing everything recorded so far if the interval has passed."""
+        with self._lock:
+            self._pending[key] = datetime.datetime.now()
+            due = time.monotonic() - self._last_flush >= self.interval
+        if due:
+            self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+        if not pending:
+            return
+        try:
+            self._write(pending)
+        except Exception:
+            # Access times are a hint, losing one interval of them is fine
+            logging.exception(f"Writing {len(pending)} access times failed")
@@ -1,13 +1,19 @@
-from typing import List, Optional
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 import os
+import sys
 import logging
 import datetime
+import hmac
+import itertools
+from contextlib import contextmanager, nullcontext
+import mimetypes
+from collections import Counter
 from dotenv import find_dotenv, load_dotenv
 
-import random
 import uuid
 import numpy as np
 import json
+import click
 
 from flask import (
     Flask,
@@ -16,85 +22,68 @@ from flask import (
     redirect,
     url_for,
     send_from_directory,
+    send_file,
+    abort,
+    Response,
     session,
     jsonify,
+    current_app,
 )
 import requests
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
 
-from flask_sqlalchemy import SQLAlchemy
-from pgvector.sqlalchemy import Vector
-from sqlalchemy import Index, Enum, func
+from sqlalchemy import func, text, insert, update, delete, select, case, cast, bindparam
+from sqlalchemy.orm import aliased
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
-from flask_login import LoginManager, UserMixin, login_required, login_user, logout_user
+from flask_login import LoginManager, UserMixin, login_required, login_user
 from authlib.integrations.flask_client import OAuth
-from urllib.parse import quote_plus, urlencode
+from urllib.parse import quote, quote_plus, urlencode
 
 
 import utils
+import access
+import conversion
+import derivatives
+import embeddings
+import janitor
+import jobs
+import lookahead
+import matrix_cache
+import metrics
+import profiling
+import neighbor_graph
+import quantization
+import reaper
+import traversal
+from models import (
+    db,
+    User,
+    SweepSession,
+    Embedding,
+    EmbeddingNeighbor,
+    ContentEmbedding,
+)
 
 # TODOs
 # TODO sort out mixed use of id and sweep_session_token in database tables
 # TODO get rid of unnecessary arguments for routing functions where possible
-# TODO add indices to database tables
 # TODO add login_required where suitable
 
 ENV_FILE = find_dotenv(".env.dev")  # TODO make this flag dependent
 if ENV_FILE:
     load_dotenv(ENV_FILE)
 
-# Create the SQLAlchemy instance
-db = SQLAlchemy()  # maybe make this upper case (?)
-
-
-class User(db.Model):
-    __tablename__: str = "users"
-    id: int = db.Column(db.Integer, primary_key=True)
-    email: str = db.Column(db.String(255), nullable=False, unique=True)
-    nickname: str = db.Column(db.String(255))
-    subscribed: bool = db.Column(db.Boolean, default=False)
+# Number of embeddings per session, sizes only change while ingesting
+_session_sizes: dict = {}
 
-    def __repr__(self) -> str:
-        return f"User('{self.nickname}', '{self.email}')"
-
-
-class SweepSession(db.Model):
-    # TODO maybe make sweep_session_token primary key?
-    # TODO or maybe rename id to something else to avoid confusion?
-    __tablename__ = "sweep_sessions"
-    id: int = db.Column(db.Integer, primary_key=True)
-    user_id: int = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
-    sweep_session_token: str = db.Column(db.String(36), unique=True, nullable=False)
-    creation_time: datetime.datetime = db.Column(
-        db.DateTime, nullable=False, default=datetime.datetime.now()
-    )
-    last_access_time: datetime.datetime = db.Column(
-        db.DateTime, nullable=False, default=datetime.datetime.now()
-    )
-
-    def __repr__(self) -> str:
-        return f"SweepSession('{self.sweep_session_token}', '{self.id}')"
-
-
-class Embedding(db.Model):
-    __tablename__ = "embeddings"
-    id: int = db.Column(db.Integer, primary_key=True)
-    display_path: str = db.Column(db.String(255), nullable=False)
-    download_path: str = db.Column(db.String(255), nullable=False)
-    sweep_session_token: str = db.Column(
-        db.String(36),
-        db.ForeignKey("sweep_sessions.sweep_session_token"),
-        nullable=False,
-    )
-    embedding: np.ndarray = db.Column(Vector(384), nullable=False)
-    status: str = db.Column(
-        Enum("reviewed_keep", "reviewed_discard", "unreviewed", name="status"),
-        nullable=False,
-        default="unreviewed",
-    )
 
-    def __repr__(self) -> str:
-        return f"Embedding('{self.display_path}', '{self.download_path}', '{self.sweep_session_token}', '{self.status}')"
+def invalidate_session_caches(sweep_session_id: str) -> None:
+    """Forget everything cached in-process about a session after its rows changed."""
+    _session_sizes.pop(sweep_session_id, None)
+    session_matrix_cache.invalidate(sweep_session_id)
+    lookahead_queue.invalidate(sweep_session_id)
 
 
 def add_user(email: str, nickname="", subscribed: bool = False) -> User:
@@ -122,13 +111,97 @@ def add_session_for_user(email: str, sweep_session_token: str) -> SweepSession:
         return None
 
 
-def get_sessions_for_user(email: str) -> List[SweepSession]:
-    user = User.query.filter_by(email=email).first()
-    if user:
-        sessions = SweepSession.query.filter_by(user_id=user.id).all()
-        return sessions
-    else:
-        return None
+def get_sessions_for_user(
+    email: str, limit: Optional[int] = None, after_id: Optional[int] = None
+) -> List[SweepSession]:
+    """Get the sessions of a user ordered by id, optionally one page after `after_id`."""
+    query = (
+        SweepSession.query.join(User, User.id == SweepSession.user_id)
+        .filter(User.email == email)
+        .order_by(SweepSession.id)
+    )
+    if after_id is not None:
+        query = query.filter(SweepSession.id > after_id)
+    if limit is not None:
+        query = query.limit(limit)
+    return query.all()
+
+
+def user_has_session(email: str, sweep_session_token: str) -> bool:
+    return db.session.query(
+        SweepSession.query.join(User, User.id == SweepSession.user_id)
+        .filter(
+            User.email == email,
+            SweepSession.sweep_session_token == sweep_session_token,
+        )
+        .exists()
+    ).scalar()
+
+
+def get_session_overviews(
+    email: str, limit: int, after_id: Optional[int] = None, preview_count: int = 3
+) -> List[dict]:
+    """Get a page of a user's sessions with review progress and preview images in two queries."""
+    page = db.session.query(SweepSession.id, SweepSession.sweep_session_token).join(
+        User, User.id == SweepSession.user_id
+    )
+    page = page.filter(User.email == email)
+    if after_id is not None:
+        page = page.filter(SweepSession.id > after_id)
+    page = page.order_by(SweepSession.id).limit(limit).subquery()
+
+    counts = (
+        db.session.query(
+            page.c.id,
+            page.c.sweep_session_token,
+            func.count(Embedding.id).label("total"),
+            func.count(Embedding.id)
+            .filter(Embedding.status != "unreviewed")
+            .label("reviewed"),
+        )
+        .outerjoin(
+            Embedding, Embedding.sweep_session_token == page.c.sweep_session_token
+        )
+        .group_by(page.c.id, page.c.sweep_session_token)
+        .order_by(page.c.id)
+        .all()
+    )
+    overviews = {
+        row.sweep_session_token: {
+            "id": row.id,
+            "sweep_session_token": row.sweep_session_token,
+            "total": row.total,
+            "reviewed": row.reviewed,
+            "percentage_reviewed": (row.reviewed / row.total) * 100
+            if row.total
+            else 0,
+            "preview_paths": [],
+        }
+        for row in counts
+    }
+    if not overviews:
+        return []
+
+    ranked = (
+        db.session.query(
+            Embedding.sweep_session_token,
+            Embedding.display_path,
+            func.row_number()
+            .over(partition_by=Embedding.sweep_session_token, order_by=Embedding.id)
+            .label("rank"),
+        )
+        .filter(Embedding.sweep_session_token.in_(list(overviews)))
+        .subquery()
+    )
+    previews = (
+        db.session.query(ranked.c.sweep_session_token, ranked.c.display_path)
+        .filter(ranked.c.rank <= preview_count)
+        .order_by(ranked.c.sweep_session_token, ranked.c.rank)
+    )
+    for sweep_session_token, display_path in previews:
+        overviews[sweep_session_token]["preview_paths"].append(display_path)
+
+    return list(overviews.values())
 
 
 def add_embedding_for_sweep_session(
@@ -144,11 +217,111 @@ def add_embedding_for_sweep_session(
         )
         db.session.add(new_embedding)
         db.session.commit()
+        invalidate_session_caches(session.sweep_session_token)
         return new_embedding
     else:
         return None
 
 
+def add_embeddings_for_sweep_session(
+    sweep_session_id: int,
+    rows: Iterable[Tuple[str, str, np.ndarray, Optional[str]]],
+    batch_size: Optional[int] = None,
+) -> int:
+    """Insert (display_path, download_path, embedding, content_hash) rows in batches, one transaction per batch.
+
+    Rows with a content hash also add (or reference) the shared content embedding.
+    """
+    session = db.session.get(SweepSession, sweep_session_id)
+    if not session:
+        return 0
+    batch_size = batch_size or current_app.config["INGEST_BATCH_SIZE"]
+
+    inserted = 0
+    batch = []
+    for display_path, download_path, embedding, content_hash in rows:
+        batch.append(
+            {
+                "sweep_session_token": session.sweep_session_token,
+                "display_path": display_path,
+                "download_path": download_path,
+                "embedding": embedding,
+                "content_hash": content_hash,
+            }
+        )
+        if len(batch) >= batch_size:
+            inserted += _insert_embedding_batch(batch)
+            batch = []
+    if batch:
+        inserted += _insert_embedding_batch(batch)
+
+    invalidate_session_caches(session.sweep_session_token)
+    return inserted
+
+
+def _insert_embedding_batch(batch: List[dict]) -> int:
+    with metrics.INGEST_STAGE_SECONDS.time("insert"):
+        # executemany, which SQLAlchemy sends as multi-row INSERT ... VALUES statements
+        db.session.execute(insert(Embedding), batch)
+        _reference_content_embeddings(batch)
+        db.session.commit()
+    return len(batch)
+
+
+def _reference_content_embeddings(batch: List[dict]) -> None:
+    ref_counts = Counter(row["content_hash"] for row in batch if row["content_hash"])
+    if not ref_counts:
+        return
+    embeddings = {row["content_hash"]: row["embedding"] for row in batch}
+    # Sorted, so concurrent ingestions lock shared rows in the same order
+    upsert = pg_insert(ContentEmbedding).values(
+        [
+            {
+                "content_hash": content_hash,
+                "embedding": embeddings[content_hash],
+                "ref_count": ref_count,
+            }
+            for content_hash, ref_count in sorted(ref_counts.items())
+        ]
+    )
+    db.session.execute(
+        upsert.on_conflict_do_update(
+            index_elements=[ContentEmbedding.content_hash],
+            set_={"ref_count": ContentEmbedding.ref_count + upsert.excluded.ref_count},
+        )
+    )
+
+
+def get_content_embeddings(content_hashes: List[str]) -> Dict[str, np.ndarray]:
+    """Known embeddings of file contents by hash, from any session."""
+    if not content_hashes:
+        return {}
+    return dict(
+        db.session.query(ContentEmbedding.content_hash, ContentEmbedding.embedding).filter(
+            ContentEmbedding.content_hash.in_(content_hashes)
+        )
+    )
+
+
+def release_content_embeddings(sweep_session_token: str) -> None:
+    """Drop the references a session's images hold on content embeddings, which stay cached."""
+    refs = (
+        select(Embedding.content_hash, func.count().label("count"))
+        .where(
+            Embedding.sweep_session_token == sweep_session_token,
+            Embedding.content_hash.is_not(None),
+        )
+        .group_by(Embedding.content_hash)
+        .subquery()
+    )
+    db.session.execute(
+        update(ContentEmbedding)
+        .where(ContentEmbedding.content_hash == refs.c.content_hash)
+        .values(ref_count=ContentEmbedding.ref_count - refs.c.count)
+        .execution_options(synchronize_session=False)
+    )
+
+
 def remove_session_for_user(email: str, sweep_session_token: str) -> bool:
     user = User.query.filter_by(email=email).first()
     if user:
@@ -156,16 +329,17 @@ def remove_session_for_user(email: str, sweep_session_token: str) -> bool:
             user_id=user.id, sweep_session_token=sweep_session_token
         ).first()
         if session:
-            # Remove all embeddings for this session
-            embeddings = Embedding.query.filter_by(
-                sweep_session_token=session.sweep_session_token
-            ).all()
-            for embedding in embeddings:
-                db.session.delete(embedding)
-                db.session.commit()
-            # Remove the session
+            # One transaction with a bulk DELETE, neighbor graph edges go with
+            # the embeddings through their cascading foreign keys
+            release_content_embeddings(session.sweep_session_token)
+            db.session.execute(
+                delete(Embedding).where(
+                    Embedding.sweep_session_token == session.sweep_session_token
+                )
+            )
             db.session.delete(session)
             db.session.commit()
+            invalidate_session_caches(sweep_session_token)
 
             return True
         else:
@@ -174,13 +348,42 @@ def remove_session_for_user(email: str, sweep_session_token: str) -> bool:
         return False
 
 
+def write_access_times(access_times: Dict[str, datetime.datetime]) -> None:
+    """Store coalesced last access times of sessions with a single executemany UPDATE.
+
+    Runs in its own transaction on a separate connection, so a failure never
+    leaves the request's session in need of a rollback.
+    """
+    sweep_sessions = SweepSession.__table__
+    with db.engine.begin() as connection:
+        connection.execute(
+            update(sweep_sessions)
+            .where(sweep_sessions.c.sweep_session_token == bindparam("token"))
+            .values(last_access_time=bindparam("accessed")),
+            [
+                {"token": sweep_session_id, "accessed": accessed}
+                for sweep_session_id, accessed in access_times.items()
+            ],
+        )
+
+
 def get_images_to_keep(sweep_session_id: str) -> List[str]:
-    embeddings = Embedding.query.filter_by(sweep_session_token=sweep_session_id).all()
-    images_to_keep = []
-    for embedding in embeddings:
-        if embedding.status == "reviewed_keep":
-            images_to_keep.append(embedding.download_path)
-    return images_to_keep
+    return list(iter_images_to_keep(sweep_session_id))
+
+
+def iter_images_to_keep(sweep_session_id: str, batch_size: int = 1000) -> Iterator[str]:
+    """Stream the download paths of all kept images, filtered in the database."""
+    query = (
+        db.session.query(Embedding.download_path)
+        .filter(
+            Embedding.sweep_session_token == sweep_session_id,
+            Embedding.status == "reviewed_keep",
+        )
+        .order_by(Embedding.id)
+        .yield_per(batch_size)
+    )
+    for (download_path,) in query:
+        yield download_path
 
 
 def get_image_by_path(sweep_session_id: str, image_path: str) -> Embedding:
@@ -190,30 +393,388 @@ def get_image_by_path(sweep_session_id: str, image_path: str) -> Embedding:
 
 
 def get_starting_image(sweep_session_id: str) -> Optional[Embedding]:
+    """Get the first unreviewed image on the session's tour, a random one without a tour."""
     unreviewed_images = Embedding.query.filter_by(
         sweep_session_token=sweep_session_id, status="unreviewed"
-    ).all()
-    if unreviewed_images:
-        return random.choice(unreviewed_images)
+    )
+    if use_tour():
+        starting_image = (
+            unreviewed_images.filter(Embedding.tour_position.is_not(None))
+            .order_by(Embedding.tour_position)
+            .first()
+        )
+        if starting_image is not None:
+            return starting_image
+    # Picked by the database, so only a single row is loaded
+    return unreviewed_images.order_by(func.random()).first()
+
+
+def get_session_size(sweep_session_id: str) -> int:
+    """Get the number of images in a session."""
+    if sweep_session_id not in _session_sizes:
+        _session_sizes[sweep_session_id] = Embedding.query.filter_by(
+            sweep_session_token=sweep_session_id
+        ).count()
+    return _session_sizes[sweep_session_id]
+
+
+def use_approximate_search(sweep_session_id: str) -> bool:
+    """Decide whether neighbor lookups for a session should go through the vector index."""
+    mode = current_app.config["VECTOR_SEARCH_MODE"]
+    if mode == "auto":
+        return (
+            get_session_size(sweep_session_id)
+            > current_app.config["VECTOR_SEARCH_EXACT_MAX_ROWS"]
+        )
+    return mode == "approximate"
+
+
+@contextmanager
+def vector_search(approximate: bool) -> Iterator[None]:
+    """Run the neighbor queries of the block with the recall knobs, or as exact search."""
+    if approximate:
+        statements = [
+            f"SET LOCAL hnsw.ef_search = {int(current_app.config['HNSW_EF_SEARCH'])}",
+            f"SET LOCAL ivfflat.probes = {int(current_app.config['IVFFLAT_PROBES'])}",
+        ]
+        if current_app.config["HNSW_ITERATIVE_SCAN"] != "off":
+            statements.append(
+                f"SET LOCAL hnsw.iterative_scan = {current_app.config['HNSW_ITERATIVE_SCAN']}"
+            )
+        # Only vector index scans read these, so they may last for the transaction
+        db.session.execute(text("; ".join(statements)))
+        yield
     else:
-        return None
+        # Without index scans the planner has to compute every distance, i.e. exact
+        # search. Like SET LOCAL, set_config(..., true) ends with the transaction
+        previous = db.session.execute(
+            text(
+                "SELECT current_setting('enable_indexscan'), "
+                "set_config('enable_indexscan', 'off', true)"
+            )
+        ).scalar()
+        yield
+        # The other queries of the transaction need their indices, so the value
+        # from before goes back. After an error the rollback undoes it instead
+        db.session.execute(
+            text("SELECT set_config('enable_indexscan', :previous, true)"),
+            {"previous": previous},
+        )
 
 
-def get_nearest_neighbor(sweep_session_id: str, query_image_id: int) -> Embedding:
-    """Get the nearest neighbor to the query image."""
-    query_embedding = Embedding.query.get(query_image_id)
-    nns = (
-        db.session.query(Embedding)
+def use_quantization(approximate: bool) -> Optional[str]:
+    """Quantization mode of the candidate search, None to search the full vectors."""
+    mode = current_app.config["EMBEDDING_QUANTIZATION"]
+    # Exact search reads every row anyway, the compact vectors only pay off in the index
+    return mode if approximate and mode != "none" else None
+
+
+def quantized_shortlist(filters: list, query_embedding, mode: str, limit: int = 1):
+    """Ids of the closest candidates by quantized distance, to be re-ranked at full precision.
+
+    Materialized, so the planner answers it from the quantized index and can't
+    fold the full precision ORDER BY back into the vector index scan.
+    """
+    size = max(limit, current_app.config["QUANTIZATION_SHORTLIST"])
+    return (
+        select(Embedding.id)
+        .where(*filters)
+        .order_by(
+            quantization.quantized_distance(Embedding.embedding, query_embedding, mode)
+        )
+        .limit(size)
+        .cte("shortlist")
+        .prefix_with("MATERIALIZED")
+    )
+
+
+def _nearest_neighbors(
+    sweep_session_id: str,
+    query_embedding: Embedding,
+    limit: int = 1,
+    quantization_mode: Optional[str] = None,
+    exclude_ids: Iterable[int] = (),
+) -> List[Embedding]:
+    filters = [
+        Embedding.sweep_session_token == sweep_session_id,
+        Embedding.id.not_in([query_embedding.id, *exclude_ids]),
+        Embedding.status == "unreviewed",
+    ]
+    query = db.session.query(Embedding).filter(*filters)
+    if quantization_mode:
+        shortlist = quantized_shortlist(
+            filters, query_embedding.embedding, quantization_mode, limit
+        )
+        query = query.filter(Embedding.id.in_(select(shortlist.c.id)))
+    return (
+        query.order_by(Embedding.embedding.l2_distance(query_embedding.embedding))
+        .limit(limit)
+        .all()
+    )
+
+
+def load_session_matrix(sweep_session_id: str) -> matrix_cache.SessionMatrix:
+    rows = (
+        db.session.query(Embedding.id, Embedding.embedding, Embedding.status)
         .filter(Embedding.sweep_session_token == sweep_session_id)
-        .filter(Embedding.id != query_image_id)
-        .filter(Embedding.status == "unreviewed")
-        .order_by(Embedding.embedding.l2_distance(query_embedding.embedding))
-        .limit(1)
         .all()
-    )[0]
+    )
+    return matrix_cache.SessionMatrix.from_rows(rows)
+
+
+def compute_neighbor_graph(
+    sweep_session_id: str, session_matrix: Optional[matrix_cache.SessionMatrix] = None
+) -> int:
+    """Store the top NEIGHBOR_GRAPH_K neighbors of every image of a session, replacing older edges.
+
+    Returns the number of stored edges, 0 if the session is too large.
+    """
+    session_matrix = session_matrix or load_session_matrix(sweep_session_id)
+    if len(session_matrix.ids) > current_app.config["NEIGHBOR_GRAPH_MAX_ROWS"]:
+        return 0
+    neighbors, _ = neighbor_graph.knn_graph(
+        session_matrix.matrix, current_app.config["NEIGHBOR_GRAPH_K"]
+    )
+    ids = session_matrix.ids
+    db.session.execute(
+        delete(EmbeddingNeighbor).where(
+            EmbeddingNeighbor.embedding_id.in_(
+                select(Embedding.id).where(
+                    Embedding.sweep_session_token == sweep_session_id
+                )
+            )
+        )
+    )
+    edges = [
+        {"embedding_id": int(ids[row]), "rank": rank, "neighbor_id": int(ids[neighbor])}
+        for row in range(len(ids))
+        for rank, neighbor in enumerate(neighbors[row])
+    ]
+    if edges:
+        db.session.execute(insert(EmbeddingNeighbor), edges)
+    db.session.commit()
+    return len(edges)
+
+
+def get_graph_neighbors(
+    query_image_id: int, k: int = 1, exclude_ids: Iterable[int] = ()
+) -> List[Embedding]:
+    """Unreviewed images from the query image's precomputed adjacency list, nearest first."""
+    return (
+        Embedding.query.join(
+            EmbeddingNeighbor, EmbeddingNeighbor.neighbor_id == Embedding.id
+        )
+        .filter(
+            EmbeddingNeighbor.embedding_id == query_image_id,
+            Embedding.status == "unreviewed",
+            Embedding.id.not_in(list(exclude_ids)),
+        )
+        .order_by(EmbeddingNeighbor.rank)
+        .limit(k)
+        .all()
+    )
+
+
+def get_cached_nearest_neighbors(
+    sweep_session_id: str, query_image_id: int, k: int = 1, exclude_ids: Iterable[int] = ()
+) -> Optional[List[Embedding]]:
+    """Get the nearest neighbors from the in-process session matrix, None if the cache can't answer."""
+    exclude_ids = set(exclude_ids)
+    session_matrix = session_matrix_cache.get(
+        sweep_session_id, lambda: load_session_matrix(sweep_session_id)
+    )
+    try:
+        neighbor_ids = [
+            neighbor_id
+            for neighbor_id in session_matrix.nearest_unreviewed(
+                query_image_id, k + len(exclude_ids)
+            )
+            if neighbor_id not in exclude_ids
+        ][:k]
+    except KeyError:
+        neighbor_ids = []
+    if neighbor_ids:
+        neighbors = {
+            neighbor.id: neighbor
+            for neighbor in Embedding.query.filter(Embedding.id.in_(neighbor_ids))
+        }
+        # Another worker may have changed the session since it was loaded
+        if all(
+            neighbor_id in neighbors and neighbors[neighbor_id].status == "unreviewed"
+            for neighbor_id in neighbor_ids
+        ):
+            return [neighbors[neighbor_id] for neighbor_id in neighbor_ids]
+    session_matrix_cache.invalidate(sweep_session_id)
+    return None
+
+
+def get_nearest_neighbors(
+    sweep_session_id: str, query_image_id: int, k: int, exclude_ids: Iterable[int] = ()
+) -> List[Embedding]:
+    """Get the k nearest unreviewed neighbors of the query image, nearest first.
+
+    Images in `exclude_ids` (e.g. the other image on screen) are never returned.
+    Fewer than k may come back from the neighbor graph, vector search is only
+    needed once all of the query image's graph neighbors have been reviewed.
+    """
+    exclude_ids = list(exclude_ids)
+    if current_app.config["EMBEDDING_CACHE_ENABLED"]:
+        neighbors = get_cached_nearest_neighbors(
+            sweep_session_id, query_image_id, k, exclude_ids
+        )
+        if neighbors is not None:
+            return neighbors
+    if current_app.config["NEIGHBOR_GRAPH_K"]:
+        neighbors = get_graph_neighbors(query_image_id, k, exclude_ids)
+        if neighbors:
+            return neighbors
+
+    query_embedding = Embedding.query.get(query_image_id)
+    approximate = use_approximate_search(sweep_session_id)
+    with vector_search(approximate):
+        nns = _nearest_neighbors(
+            sweep_session_id, query_embedding, k, use_quantization(approximate), exclude_ids
+        )
+    if not nns and approximate:
+        # The index is searched before the session/status filter is applied, so
+        # a small session in a large table can come back empty -> retry exactly
+        logging.info(f"Approximate search found no neighbor for {query_image_id}")
+        with vector_search(False):
+            nns = _nearest_neighbors(
+                sweep_session_id, query_embedding, limit=k, exclude_ids=exclude_ids
+            )
     return nns
 
 
+def get_nearest_neighbor(
+    sweep_session_id: str, query_image_id: int, exclude_ids: Iterable[int] = ()
+) -> Embedding:
+    """Get the nearest neighbor to the query image."""
+    return get_nearest_neighbors(sweep_session_id, query_image_id, 1, exclude_ids)[0]
+
+
+def use_tour() -> bool:
+    return current_app.config["TRAVERSAL_MODE"] == "tour"
+
+
+def compute_session_tour(
+    sweep_session_id: str, session_matrix: Optional[matrix_cache.SessionMatrix] = None
+) -> int:
+    """Order all images of a session into a similarity tour and store their positions on it.
+
+    Returns the length of the stored tour, 0 if the session is empty or too
+    large for the quadratic greedy pass.
+    """
+    session_matrix = session_matrix or load_session_matrix(sweep_session_id)
+    size = len(session_matrix.ids)
+    if size == 0 or size > current_app.config["TRAVERSAL_MAX_ROWS"]:
+        return 0
+    order = traversal.greedy_tour(session_matrix.matrix)
+    order = traversal.two_opt(
+        session_matrix.matrix, order, window=current_app.config["TRAVERSAL_2OPT_WINDOW"]
+    )
+    # Bulk UPDATE by primary key, sent as a single executemany
+    db.session.execute(
+        update(Embedding),
+        [
+            {"id": int(session_matrix.ids[row]), "tour_position": position}
+            for position, row in enumerate(order)
+        ],
+    )
+    db.session.commit()
+    return size
+
+
+def get_tour_successors(
+    sweep_session_id: str, image_paths: List[str], limit: int = 1
+) -> List[Embedding]:
+    """Get the unreviewed images that follow the given images on the session's tour.
+
+    The cursor is the furthest position of the given images, so images already
+    on screen are never returned. Empty if none of them is on the tour.
+    """
+    shown_image = aliased(Embedding)
+    cursor = (
+        select(func.max(shown_image.tour_position))
+        .where(
+            shown_image.sweep_session_token == sweep_session_id,
+            shown_image.display_path.in_(image_paths),
+        )
+        .scalar_subquery()
+    )
+    return (
+        Embedding.query.filter(
+            Embedding.sweep_session_token == sweep_session_id,
+            Embedding.status == "unreviewed",
+            Embedding.tour_position > cursor,
+        )
+        .order_by(Embedding.tour_position)
+        .limit(limit)
+        .all()
+    )
+
+
+def get_next_image(
+    sweep_session_id: str, query_image: Embedding, *shown_image_paths: str
+) -> Embedding:
+    """Get the image that follows a decision on the query image.
+
+    On the tour this is the next unreviewed image past everything on screen;
+    off the tour it is the nearest neighbor, from the lookahead if it has one.
+    """
+    if use_tour():
+        successors = get_tour_successors(
+            sweep_session_id, [query_image.display_path, *shown_image_paths]
+        )
+        if successors:
+            return successors[0]
+    candidate_path = lookahead_queue.pop(sweep_session_id, query_image.display_path)
+    if candidate_path is not None and candidate_path not in shown_image_paths:
+        candidate = get_image_by_path(sweep_session_id, candidate_path)
+        # Lookahead entries are per process, another worker may have reviewed it
+        if candidate is not None and candidate.status == "unreviewed":
+            return candidate
+    shown_ids = []
+    if shown_image_paths:
+        shown_ids = [
+            image_id
+            for (image_id,) in db.session.query(Embedding.id).filter(
+                Embedding.sweep_session_token == sweep_session_id,
+                Embedding.display_path.in_(shown_image_paths),
+            )
+        ]
+    return get_nearest_neighbor(sweep_session_id, query_image.id, shown_ids)
+
+
+def lookahead_candidates(sweep_session_id: str, image_path: str, depth: int) -> List[str]:
+    # Runs on the lookahead threads
+    with app.app_context():
+        image = get_image_by_path(sweep_session_id, image_path)
+        if image is None:
+            return []
+        return [
+            neighbor.display_path
+            for neighbor in get_nearest_neighbors(sweep_session_id, image.id, depth)
+        ]
+
+
+def prefetch_next_images(sweep_session_id: str, *image_paths: str) -> None:
+    """Start looking up the candidates that follow a decision on any of the given images."""
+    # The tour already knows what comes next
+    if not use_tour():
+        lookahead_queue.schedule(sweep_session_id, image_paths, lookahead_candidates)
+
+
+def get_preload_paths(sweep_session_id: str, image_paths: List[str]) -> List[str]:
+    """Images that may follow a decision on the images on screen, for preload hints."""
+    if use_tour():
+        # Every decision continues past the furthest of the shown images
+        successors = get_tour_successors(sweep_session_id, image_paths)
+        if successors:
+            return [successor.display_path for successor in successors]
+    return lookahead_queue.peek(sweep_session_id, image_paths)
+
+
 def update_image_status(
     sweep_session_id: str,
     update_image_path: str,
@@ -226,6 +787,8 @@ def update_image_status(
     if image:
         image.status = set_status_to
         db.session.commit()
+        session_matrix_cache.set_status(sweep_session_id, image.id, set_status_to)
+        lookahead_queue.discard(sweep_session_id, update_image_path)
     else:
         logging.error(f"Image {update_image_path} not found in database.")
         return False
@@ -254,15 +817,199 @@ def redirect_to_decision(
     return redirect_url
 
 
-def get_percentage_reviewed(sweep_session_id: str) -> int:
-    count_all = len(
-        Embedding.query.filter(Embedding.sweep_session_token == sweep_session_id).all()
+def redirect_to_decision_by_id(
+    position: str, sweep_session_id: str, img_1: int, img_2: int,
+) -> str:
+    if position == "left":
+        img_id_left, img_id_right = img_2, img_1
+    else:
+        img_id_left, img_id_right = img_1, img_2
+    return url_for(
+        "render_decision_by_id",
+        sweep_session_id=sweep_session_id,
+        img_id_left=img_id_left,
+        img_id_right=img_id_right,
     )
-    count_reviewed = len(
-        Embedding.query.filter(
+
+
+# Status set on the clicked image by each decision, "continue" also discards the other image
+DECISIONS = {
+    "keep": "reviewed_keep",
+    "discard": "reviewed_discard",
+    "continue": "reviewed_keep",
+}
+
+
+def precomputed_next_image(
+    sweep_session_id: str, clicked_id: int, clicked_path: Optional[str], exclude_ids: List[int]
+):
+    """Filter for the clicked image's nearest neighbor if the lookahead or the session matrix knows it."""
+    if clicked_path is not None:
+        candidate_path = lookahead_queue.pop(sweep_session_id, clicked_path)
+        if candidate_path is not None:
+            return Embedding.display_path == candidate_path
+    if current_app.config["EMBEDDING_CACHE_ENABLED"]:
+        session_matrix = session_matrix_cache.get(
+            sweep_session_id, lambda: load_session_matrix(sweep_session_id)
+        )
+        try:
+            candidate_ids = session_matrix.nearest_unreviewed(clicked_id, 1, exclude_ids)
+        except KeyError:
+            candidate_ids = []
+        if candidate_ids:
+            return Embedding.id == candidate_ids[0]
+    return None
+
+
+def apply_decision(
+    sweep_session_id: str,
+    decision: str,
+    clicked_id: int,
+    other_id: int,
+    clicked_path: Optional[str] = None,
+) -> Optional[Tuple[int, str]]:
+    """Update the reviewed image(s) and pick the next one in a single statement.
+
+    Returns (id, display_path) of the next unreviewed image on the tour or, off
+    the tour, of the clicked image's nearest unreviewed neighbor, taken from
+    the lookahead (by `clicked_path`) or the session matrix when they have it.
+    None if the session has no unreviewed images left.
+    """
+    updated_ids = [clicked_id, other_id] if decision == "continue" else [clicked_id]
+    status_type = Embedding.__table__.c.status.type
+    updated = (
+        update(Embedding)
+        .where(
             Embedding.sweep_session_token == sweep_session_id,
-            Embedding.status.in_(["reviewed_keep", "reviewed_discard"]),
-        ).all()
+            Embedding.id.in_(updated_ids),
+        )
+        .values(
+            status=case(
+                (Embedding.id == clicked_id, cast(DECISIONS[decision], status_type)),
+                else_=cast("reviewed_discard", status_type),
+            )
+        )
+        .returning(Embedding.id, Embedding.display_path)
+        .cte("updated")
+    )
+    query_image = aliased(Embedding)
+    query_embedding = (
+        select(query_image.embedding)
+        .where(
+            query_image.sweep_session_token == sweep_session_id,
+            query_image.id == clicked_id,
+        )
+        .scalar_subquery()
+    )
+    # The outer select sees the rows as they were before the update, so the
+    # updated images are excluded explicitly
+    filters = [
+        Embedding.sweep_session_token == sweep_session_id,
+        Embedding.status == "unreviewed",
+        Embedding.id.not_in(select(updated.c.id)),
+        # The other image stays on screen
+        Embedding.id != other_id,
+    ]
+    next_image = (
+        select(
+            Embedding.id,
+            Embedding.display_path,
+            select(func.array_agg(updated.c.display_path))
+            .scalar_subquery()
+            .label("reviewed_paths"),
+        )
+        .where(*filters)
+        .limit(1)
+    )
+
+    tour = use_tour()
+    graph = bool(current_app.config["NEIGHBOR_GRAPH_K"])
+    approximate = use_approximate_search(sweep_session_id)
+    search = nullcontext()
+    row = None
+    # The tour is answered from an index in the same statement anyway
+    candidate = None if tour else precomputed_next_image(
+        sweep_session_id, clicked_id, clicked_path, [other_id, *updated_ids]
+    )
+    if candidate is not None:
+        # Checked against the database, another worker may have reviewed it. If
+        # so, the statement below repeats the (idempotent) update
+        row = db.session.execute(next_image.where(candidate)).first()
+    if tour:
+        shown_image = aliased(Embedding)
+        cursor = (
+            select(func.max(shown_image.tour_position))
+            .where(
+                shown_image.sweep_session_token == sweep_session_id,
+                shown_image.id.in_([clicked_id, other_id]),
+            )
+            .scalar_subquery()
+        )
+        next_image = next_image.where(Embedding.tour_position > cursor).order_by(
+            Embedding.tour_position
+        )
+    elif graph:
+        next_image = next_image.join(
+            EmbeddingNeighbor, EmbeddingNeighbor.neighbor_id == Embedding.id
+        ).where(EmbeddingNeighbor.embedding_id == clicked_id).order_by(
+            EmbeddingNeighbor.rank
+        )
+    else:
+        quantization_mode = use_quantization(approximate)
+        if quantization_mode:
+            shortlist = quantized_shortlist(filters, query_embedding, quantization_mode)
+            next_image = next_image.where(Embedding.id.in_(select(shortlist.c.id)))
+        next_image = next_image.order_by(
+            Embedding.embedding.l2_distance(query_embedding)
+        )
+        search = vector_search(approximate)
+    if row is None:
+        with search:
+            row = db.session.execute(next_image).first()
+    if row is None and (tour or graph or approximate):
+        # Off the end of the tour or the clicked image's graph neighbors we
+        # continue with a vector search; an empty approximate search is retried
+        # exactly (see get_nearest_neighbors). The update has already happened
+        # in this transaction either way, the other image is still on screen
+        query_image = db.session.get(Embedding, clicked_id)
+        fallback = []
+        if tour or graph:
+            with vector_search(approximate):
+                fallback = _nearest_neighbors(
+                    sweep_session_id,
+                    query_image,
+                    1,
+                    use_quantization(approximate),
+                    exclude_ids=[other_id],
+                )
+        if not fallback and approximate:
+            with vector_search(False):
+                fallback = _nearest_neighbors(
+                    sweep_session_id, query_image, exclude_ids=[other_id]
+                )
+        row = (fallback[0].id, fallback[0].display_path, None) if fallback else None
+    db.session.commit()
+
+    for image_id in updated_ids:
+        status = DECISIONS[decision] if image_id == clicked_id else "reviewed_discard"
+        session_matrix_cache.set_status(sweep_session_id, image_id, status)
+    if row is None or row[2] is None:
+        lookahead_queue.invalidate(sweep_session_id)
+    else:
+        for reviewed_path in row[2]:
+            lookahead_queue.discard(sweep_session_id, reviewed_path)
+
+    return (row[0], row[1]) if row is not None else None
+
+
+def get_percentage_reviewed(sweep_session_id: str) -> int:
+    count_all, count_reviewed = (
+        db.session.query(
+            func.count(Embedding.id),
+            func.count(Embedding.id).filter(Embedding.status != "unreviewed"),
+        )
+        .filter(Embedding.sweep_session_token == sweep_session_id)
+        .one()
     )
     try:
         percentage_reviewed = (count_reviewed / count_all) * 100
@@ -281,14 +1028,144 @@ def create_app():
     # Set up flask global variables
     app.config["GATEWAY_HOST"] = "http://127.0.0.1"
     app.config["GATEWAY_PORT"] = "5000"
-    app.config["EMBEDDINGS_HOST"] = "http://127.0.0.1"
-    app.config["EMBEDDINGS_PORT"] = "5001"
+    app.config["EMBEDDINGS_HOST"] = os.getenv("EMBEDDINGS_HOST", "http://127.0.0.1")
+    app.config["EMBEDDINGS_PORT"] = os.getenv("EMBEDDINGS_PORT", "5001")
+    # Without the embeddings service, ingestion stores random embeddings
+    app.config["EMBEDDINGS_ENABLED"] = (
+        os.getenv("EMBEDDINGS_ENABLED", "false").lower() == "true"
+    )
+    app.config["EMBEDDINGS_BATCH_SIZE"] = int(os.getenv("EMBEDDINGS_BATCH_SIZE", "32"))
+    # Batches in flight to the service at once, across all ingestion jobs
+    app.config["EMBEDDINGS_CONCURRENCY"] = int(
+        os.getenv("EMBEDDINGS_CONCURRENCY", "4")
+    )
+    app.config["EMBEDDINGS_TIMEOUT"] = float(os.getenv("EMBEDDINGS_TIMEOUT", "30"))
+    app.config["EMBEDDINGS_RETRIES"] = int(os.getenv("EMBEDDINGS_RETRIES", "3"))
     app.config["MEDIA_FOLDER"] = os.getenv("MEDIA_FOLDER")
     app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("DATABASE_URI")
+    # Nearest neighbor search: "exact", "approximate" (vector index) or "auto",
+    # which only switches to the index once a session has more rows than the threshold
+    app.config["VECTOR_SEARCH_MODE"] = os.getenv("VECTOR_SEARCH_MODE", "auto")
+    app.config["VECTOR_SEARCH_EXACT_MAX_ROWS"] = int(
+        os.getenv("VECTOR_SEARCH_EXACT_MAX_ROWS", "5000")
+    )
+    # Recall knobs for approximate search (higher = better recall, slower)
+    app.config["HNSW_EF_SEARCH"] = int(os.getenv("HNSW_EF_SEARCH", "100"))
+    app.config["IVFFLAT_PROBES"] = int(os.getenv("IVFFLAT_PROBES", "10"))
+    # "strict_order" or "relaxed_order" keep scanning the index until enough rows
+    # pass the session filter, needs pgvector >= 0.8 (older versions reject it)
+    app.config["HNSW_ITERATIVE_SCAN"] = os.getenv("HNSW_ITERATIVE_SCAN", "off")
+    # Answer neighbor lookups from per-session NumPy matrices kept in memory
+    app.config["EMBEDDING_CACHE_ENABLED"] = (
+        os.getenv("EMBEDDING_CACHE_ENABLED", "false").lower() == "true"
+    )
+    app.config["EMBEDDING_CACHE_MAX_BYTES"] = int(
+        os.getenv("EMBEDDING_CACHE_MAX_BYTES", str(256 * 1024 ** 2))
+    )
+    # Opt-in candidate search on compact vectors ("half" or "binary", needs
+    # pgvector >= 0.7), the shortlist is re-ranked against the full vectors.
+    # Sign bits only carry information for embeddings centered around zero.
+    # The index comes from `alembic upgrade head` run with the same setting
+    app.config["EMBEDDING_QUANTIZATION"] = os.getenv("EMBEDDING_QUANTIZATION", "none")
+    app.config["QUANTIZATION_SHORTLIST"] = int(
+        os.getenv("QUANTIZATION_SHORTLIST", "40")
+    )
+    # Number of sessions that are ingested (converted + embedded) concurrently
+    app.config["INGEST_WORKERS"] = int(os.getenv("INGEST_WORKERS", "2"))
+    # Progress of ingestion jobs, shared by all worker processes of the app
+    app.config["JOBS_FOLDER"] = os.getenv(
+        "JOBS_FOLDER", os.path.join(app.config["MEDIA_FOLDER"] or "", ".jobs")
+    )
+    # Number of embedding rows written per INSERT transaction
+    app.config["INGEST_BATCH_SIZE"] = int(os.getenv("INGEST_BATCH_SIZE", "1000"))
+    # Raw conversion runs on a process pool (defaults to one worker per core) and
+    # only admits files while their estimated decoded size fits into the budget
+    app.config["CONVERSION_WORKERS"] = int(os.getenv("CONVERSION_WORKERS", "0")) or None
+    app.config["CONVERSION_MEMORY_BUDGET"] = int(
+        os.getenv("CONVERSION_MEMORY_BUDGET", str(4 * 1024 ** 3))
+    )
+    # How display jpgs of raw files are made: "embedded" preview (falls back to
+    # "half" size demosaic) or "full" quality; downloads always use the original
+    app.config["RAW_PREVIEW_STRATEGY"] = os.getenv("RAW_PREVIEW_STRATEGY", "embedded")
+    # Resized display variants (thumbnail/screen) served by /media?variant=...
+    app.config["DERIVATIVES_FOLDER"] = os.getenv(
+        "DERIVATIVES_FOLDER",
+        os.path.join(app.config["MEDIA_FOLDER"] or "", ".derivatives"),
+    )
+    app.config["DERIVATIVES_MAX_BYTES"] = int(
+        os.getenv("DERIVATIVES_MAX_BYTES", str(10 * 1024 ** 3))
+    )
+    app.config["DERIVATIVE_FORMAT"] = os.getenv("DERIVATIVE_FORMAT", "webp")
+    # Media is served with inode/mtime/size ETags and cached for this many seconds
+    app.config["MEDIA_MAX_AGE"] = int(os.getenv("MEDIA_MAX_AGE", str(365 * 24 * 3600)))
+    # Leave sending media bytes to the front proxy: "none", "x-accel-redirect"
+    # (nginx, MEDIA_ACCEL_PREFIX is an internal location aliased to MEDIA_FOLDER)
+    # or "x-sendfile" (Apache mod_xsendfile, lighttpd)
+    app.config["MEDIA_OFFLOAD"] = os.getenv("MEDIA_OFFLOAD", "none")
+    app.config["MEDIA_ACCEL_PREFIX"] = os.getenv("MEDIA_ACCEL_PREFIX", "/protected-media/")
+    app.config["USE_X_SENDFILE"] = app.config["MEDIA_OFFLOAD"] == "x-sendfile"
+    # Number of sessions per overview page
+    app.config["OVERVIEW_PAGE_SIZE"] = int(os.getenv("OVERVIEW_PAGE_SIZE", "20"))
+    # Candidate next images precomputed per displayed image (0 disables the lookahead)
+    app.config["LOOKAHEAD_DEPTH"] = int(os.getenv("LOOKAHEAD_DEPTH", "3"))
+    app.config["LOOKAHEAD_WORKERS"] = int(os.getenv("LOOKAHEAD_WORKERS", "2"))
+    # Chunked uploads: chunk size used by the upload page, files sent in parallel
+    # and the largest chunk accepted in a single PUT
+    app.config["UPLOAD_CHUNK_SIZE"] = int(
+        os.getenv("UPLOAD_CHUNK_SIZE", str(8 * 1024 ** 2))
+    )
+    app.config["UPLOAD_CONCURRENCY"] = int(os.getenv("UPLOAD_CONCURRENCY", "4"))
+    app.config["UPLOAD_MAX_CHUNK_BYTES"] = int(
+        os.getenv("UPLOAD_MAX_CHUNK_BYTES", str(64 * 1024 ** 2))
+    )
+    # Session accesses are written to the database at most this often (seconds)
+    app.config["ACCESS_FLUSH_INTERVAL"] = float(
+        os.getenv("ACCESS_FLUSH_INTERVAL", "60")
+    )
+    # Disk quotas of the media folder in bytes (0 is unlimited) and the time
+    # without access after which the janitor may remove a session
+    app.config["USER_QUOTA_BYTES"] = int(os.getenv("USER_QUOTA_BYTES", "0"))
+    app.config["GLOBAL_QUOTA_BYTES"] = int(os.getenv("GLOBAL_QUOTA_BYTES", "0"))
+    app.config["SESSION_TTL_DAYS"] = float(os.getenv("SESSION_TTL_DAYS", "30"))
+    # Converted previews no session uses any more are kept this long, so a
+    # re-uploaded raw file is linked instead of decoded again
+    app.config["CONTENT_TTL_DAYS"] = float(os.getenv("CONTENT_TTL_DAYS", "7"))
+    # "tour" walks a similarity order computed at ingestion, "live" searches the
+    # nearest neighbor after every decision
+    app.config["TRAVERSAL_MODE"] = os.getenv("TRAVERSAL_MODE", "tour")
+    # The greedy tour is quadratic in the session size, larger sessions stay live
+    app.config["TRAVERSAL_MAX_ROWS"] = int(os.getenv("TRAVERSAL_MAX_ROWS", "10000"))
+    app.config["TRAVERSAL_2OPT_WINDOW"] = int(os.getenv("TRAVERSAL_2OPT_WINDOW", "50"))
+    # Neighbors per image stored at ingestion (0 disables the neighbor graph)
+    app.config["NEIGHBOR_GRAPH_K"] = int(os.getenv("NEIGHBOR_GRAPH_K", "10"))
+    app.config["NEIGHBOR_GRAPH_MAX_ROWS"] = int(
+        os.getenv("NEIGHBOR_GRAPH_MAX_ROWS", "50000")
+    )
+    # Setting a token enables POST /test_login, which logs in as any user without
+    # Auth0 for load tests. Never set it in production
+    app.config["TEST_AUTH_TOKEN"] = os.getenv("TEST_AUTH_TOKEN", "")
+    # Request, SQL and ingest metrics, served in the Prometheus format on /metrics
+    app.config["METRICS_ENABLED"] = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+    # Comma separated emails of users allowed to profile the workers
+    app.config["ADMIN_EMAILS"] = [
+        email.strip() for email in os.getenv("ADMIN_EMAILS", "").split(",") if email.strip()
+    ]
+    # Profiler captures, pruned oldest first to these limits. Never inside the
+    # media folder, which is served without authentication
+    app.config["PROFILE_FOLDER"] = os.getenv(
+        "PROFILE_FOLDER", os.path.join(app.instance_path, "profiles")
+    )
+    app.config["PROFILE_MAX_CAPTURES"] = int(os.getenv("PROFILE_MAX_CAPTURES", "50"))
+    app.config["PROFILE_MAX_BYTES"] = int(
+        os.getenv("PROFILE_MAX_BYTES", str(100 * 1024 ** 2))
+    )
 
     # Initialize the SQLAlchemy instance with the Flask app
     db.init_app(app)
 
+    if app.config["METRICS_ENABLED"]:
+        metrics.init_app(app)
+
     with app.app_context():
         db.create_all()
 
@@ -296,6 +1173,40 @@ def create_app():
 
 
 app = create_app()
+session_matrix_cache = matrix_cache.SessionMatrixCache(
+    app.config["EMBEDDING_CACHE_MAX_BYTES"]
+)
+job_queue = jobs.JobQueue(app.config["INGEST_WORKERS"], app.config["JOBS_FOLDER"])
+conversion_pool = conversion.ConversionPool(
+    max_workers=app.config["CONVERSION_WORKERS"],
+    memory_budget=app.config["CONVERSION_MEMORY_BUDGET"],
+    strategy=app.config["RAW_PREVIEW_STRATEGY"],
+)
+derivative_cache = derivatives.DerivativeCache(
+    app.config["DERIVATIVES_FOLDER"], app.config["DERIVATIVES_MAX_BYTES"]
+)
+profiler = profiling.Profiler(
+    app.config["PROFILE_FOLDER"],
+    max_captures=app.config["PROFILE_MAX_CAPTURES"],
+    max_bytes=app.config["PROFILE_MAX_BYTES"],
+)
+profiler.init_app(app)
+trash_reaper = reaper.TrashReaper(
+    os.path.join(app.config["MEDIA_FOLDER"] or "", utils.TRASH_DIR)
+)
+access_tracker = access.AccessTracker(
+    app.config["ACCESS_FLUSH_INTERVAL"], write_access_times
+)
+lookahead_queue = lookahead.LookaheadQueue(
+    app.config["LOOKAHEAD_DEPTH"], max_workers=app.config["LOOKAHEAD_WORKERS"]
+)
+embeddings_client = embeddings.EmbeddingsClient(
+    f"{app.config['EMBEDDINGS_HOST']}:{app.config['EMBEDDINGS_PORT']}",
+    batch_size=app.config["EMBEDDINGS_BATCH_SIZE"],
+    max_concurrency=app.config["EMBEDDINGS_CONCURRENCY"],
+    timeout=app.config["EMBEDDINGS_TIMEOUT"],
+    retries=app.config["EMBEDDINGS_RETRIES"],
+)
 
 # User management
 oauth = OAuth(app)
@@ -349,6 +1260,29 @@ def callback():
     return redirect("/overview")
 
 
+@app.route("/test_login", methods=["POST"])
+def test_login():
+    """Log in as the given user without Auth0, only exists when TEST_AUTH_TOKEN is set."""
+    token = app.config["TEST_AUTH_TOKEN"]
+    if not token:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get("X-Test-Auth-Token", ""), token):
+        abort(403)
+    user_email = request.json.get("email")
+    if not user_email:
+        return jsonify({"error": "Missing email"}), 400
+    user_nickname = request.json.get("nickname", user_email.split("@")[0])
+    # The same shape as the Auth0 token stored by the callback
+    session["user"] = {"userinfo": {"name": user_email, "nickname": user_nickname}}
+
+    if not get_user(user_email):
+        add_user(user_email, user_nickname)
+        logging.info(f"Test user {user_email} added to database.")
+
+    login_user(FlaskUser(user_email))
+    return "", 204
+
+
 @app.route("/logout")
 def logout():
     session.clear()
@@ -389,8 +1323,89 @@ def profile():
 def media(filename):
     # Define the directory where your images are located
     media_folder = app.config["MEDIA_FOLDER"]
+    # Dot directories and files (.derivatives, .content, .trash, partial uploads) are internal
+    if any(part.startswith(".") for part in filename.split("/")):
+        abort(404)
+    source_path = safe_join(media_folder, filename)
+    if source_path is None or not os.path.isfile(source_path):
+        abort(404)
+    variant = request.args.get("variant")
+    if variant in derivatives.VARIANTS:
+        fmt = derivative_format()
+        etag = f"{utils.file_validator(source_path)}-{variant}.{fmt}"
+        # Revalidations are answered before the variant is looked up or rendered
+        if etag in request.if_none_match:
+            response = not_modified(etag)
+        else:
+            response = send_media(
+                derivative_cache.get(source_path, variant, fmt),
+                etag,
+                mimetype=derivatives.FORMATS[fmt][2],
+            )
+        response.vary.add("Accept")
+        return response
     # Serve the requested file from the media directory
-    return send_from_directory(media_folder, filename)
+    return send_media(source_path, utils.file_validator(source_path))
+
+
+def send_media(path: str, etag: str, mimetype: Optional[str] = None) -> Response:
+    """Send a media file with an ETag and immutable caching headers.
+
+    With MEDIA_OFFLOAD=x-accel-redirect the bytes are left to the front proxy;
+    x-sendfile goes through Flask's USE_X_SENDFILE. send_file answers
+    If-None-Match and Range requests itself.
+    """
+    relative_path = os.path.relpath(path, app.config["MEDIA_FOLDER"])
+    if app.config["MEDIA_OFFLOAD"] == "x-accel-redirect" and not relative_path.startswith(".."):
+        if etag in request.if_none_match:
+            return not_modified(etag)
+        response = Response(
+            mimetype=mimetype or mimetypes.guess_type(path)[0] or "application/octet-stream"
+        )
+        # The proxy serves the file (and any Range) from its internal location
+        response.headers["X-Accel-Redirect"] = (
+            app.config["MEDIA_ACCEL_PREFIX"].rstrip("/") + "/" + quote(relative_path)
+        )
+        response.set_etag(etag)
+    else:
+        response = send_file(
+            path,
+            mimetype=mimetype,
+            etag=etag,
+            conditional=True,
+            max_age=app.config["MEDIA_MAX_AGE"],
+        )
+    return immutable(response)
+
+
+def not_modified(etag: str) -> Response:
+    response = Response(status=304)
+    response.set_etag(etag)
+    return immutable(response)
+
+
+def immutable(response: Response) -> Response:
+    """Media never changes after ingest, so browsers may keep it without revalidating."""
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config["MEDIA_MAX_AGE"]
+    response.cache_control.immutable = True
+    return response
+
+
+def derivative_format() -> str:
+    """Use the configured format for display variants if the client accepts it, jpeg otherwise."""
+    fmt = app.config["DERIVATIVE_FORMAT"]
+    mimetype = derivatives.FORMATS[fmt][2]
+    if any(value == mimetype for value, _ in request.accept_mimetypes):
+        return fmt
+    return "jpeg"
+
+
+def media_path_from_src(image_src: str) -> str:
+    """Turn the src of an image on the decision page back into its display path."""
+    # Remove "media/" and the variant query from the image path
+    return image_src.split("?", 1)[0].replace("/media/", "", 1)
 
 
 # TODO do this more elegantly
@@ -403,22 +1418,22 @@ def like_image():
     sweep_session_id = request.json.get("sweep_session_id")
     print(f"Image liked: {clicked_image_src}")
 
-    # Remove "media/" from the image paths
-    clicked_image_name = clicked_image_src.replace("/media/", "", 1)
-    other_image_name = other_image_src.replace("/media/", "", 1)
+    clicked_image_name = media_path_from_src(clicked_image_src)
+    other_image_name = media_path_from_src(other_image_src)
 
     _ = update_image_status(
         sweep_session_id, clicked_image_name, set_status_to="reviewed_keep"
     )
     clicked_img = get_image_by_path(sweep_session_id, clicked_image_name)
 
-    nearest_neighbor_path = get_nearest_neighbor(
-        sweep_session_id, clicked_img.id
+    nearest_neighbor_path = get_next_image(
+        sweep_session_id, clicked_img, other_image_name
     ).display_path
 
     redirect_url = redirect_to_decision(
         position, sweep_session_id, other_image_name, nearest_neighbor_path
     )
+    prefetch_next_images(sweep_session_id, other_image_name, nearest_neighbor_path)
 
     return jsonify({"redirect": redirect_url})
 
@@ -432,22 +1447,22 @@ def drop_image():
     sweep_session_id = request.json.get("sweep_session_id")
     print(f"Image dropped: {clicked_image_src}")
 
-    # Remove "media/" from the image paths
-    clicked_image_name = clicked_image_src.replace("/media/", "", 1)
-    other_image_name = other_image_src.replace("/media/", "", 1)
+    clicked_image_name = media_path_from_src(clicked_image_src)
+    other_image_name = media_path_from_src(other_image_src)
 
     _ = update_image_status(
         sweep_session_id, clicked_image_name, set_status_to="reviewed_discard"
     )
     clicked_img = get_image_by_path(sweep_session_id, clicked_image_name)
 
-    nearest_neighbor_path = get_nearest_neighbor(
-        sweep_session_id, clicked_img.id
+    nearest_neighbor_path = get_next_image(
+        sweep_session_id, clicked_img, other_image_name
     ).display_path
 
     redirect_url = redirect_to_decision(
         position, sweep_session_id, other_image_name, nearest_neighbor_path
     )
+    prefetch_next_images(sweep_session_id, other_image_name, nearest_neighbor_path)
 
     return jsonify({"redirect": redirect_url})
 
@@ -461,9 +1476,8 @@ def continue_from():
     sweep_session_id = request.json.get("sweep_session_id")
     print(f"Image dropped: {clicked_image_src}")
 
-    # Remove "media/" from the image paths
-    clicked_image_name = clicked_image_src.replace("/media/", "", 1)
-    other_image_name = other_image_src.replace("/media/", "", 1)
+    clicked_image_name = media_path_from_src(clicked_image_src)
+    other_image_name = media_path_from_src(other_image_src)
 
     _ = update_image_status(
         sweep_session_id, clicked_image_name, set_status_to="reviewed_keep"
@@ -473,29 +1487,111 @@ def continue_from():
     )
     clicked_img = get_image_by_path(sweep_session_id, clicked_image_name)
 
-    nearest_neighbor_path = get_nearest_neighbor(
-        sweep_session_id, clicked_img.id
+    nearest_neighbor_path = get_next_image(
+        sweep_session_id, clicked_img, other_image_name
     ).display_path
 
     redirect_url = redirect_to_decision(
         position, sweep_session_id, nearest_neighbor_path, clicked_image_name
     )
+    prefetch_next_images(sweep_session_id, nearest_neighbor_path, clicked_image_name)
 
     return jsonify({"redirect": redirect_url})
 
 
+@app.route("/decide", methods=["POST"])
+@login_required
+def decide():
+    """Apply a decision on images identified by id and redirect to the next pair."""
+    sweep_session_id = request.json.get("sweep_session_id")
+    if not user_has_session(session["user"]["userinfo"]["name"], sweep_session_id):
+        return jsonify({"error": "Unknown session"}), 404
+    decision = request.json.get("decision")
+    clicked_id = request.json.get("clicked_id")
+    other_id = request.json.get("other_id")
+    position = request.json.get("position")
+    try:
+        clicked_id, other_id = int(clicked_id), int(other_id)
+    except (TypeError, ValueError):
+        # e.g. "None" from the end of line page
+        return jsonify({"error": "Invalid image id"}), 400
+    if decision not in DECISIONS or clicked_id == other_id:
+        return jsonify({"error": "Invalid decision"}), 400
+    display_paths = dict(
+        db.session.query(Embedding.id, Embedding.display_path).filter(
+            Embedding.sweep_session_token == sweep_session_id,
+            Embedding.id.in_([clicked_id, other_id]),
+        )
+    )
+    if len(display_paths) != 2:
+        return jsonify({"error": "Images not in this session"}), 400
+
+    next_image = apply_decision(
+        sweep_session_id, decision, clicked_id, other_id, display_paths[clicked_id]
+    )
+    if next_image is None:
+        # Nothing left to review in this session
+        return jsonify({"redirect": url_for("overview")})
+
+    next_image_id, _ = next_image
+    if decision == "continue":
+        redirect_url = redirect_to_decision_by_id(
+            position, sweep_session_id, next_image_id, clicked_id
+        )
+    else:
+        redirect_url = redirect_to_decision_by_id(
+            position, sweep_session_id, other_id, next_image_id
+        )
+
+    return jsonify({"redirect": redirect_url})
+
+
+@app.route("/sweep/<string:sweep_session_id>/ids/<int:img_id_left>/<int:img_id_right>")
+@login_required
+def render_decision_by_id(sweep_session_id, img_id_left, img_id_right):
+    if not user_has_session(session["user"]["userinfo"]["name"], sweep_session_id):
+        abort(404)
+    images = {
+        image.id: image
+        for image in Embedding.query.filter(
+            Embedding.sweep_session_token == sweep_session_id,
+            Embedding.id.in_([img_id_left, img_id_right]),
+        )
+    }
+    if img_id_left not in images or img_id_right not in images:
+        abort(404)
+    img_path_left = images[img_id_left].display_path
+    img_path_right = images[img_id_right].display_path
+
+    return render_template(
+        "decision.html",
+        sweep_session_id=sweep_session_id,
+        img_path_left=img_path_left,
+        img_path_right=img_path_right,
+        img_id_left=img_id_left,
+        img_id_right=img_id_right,
+        preload_paths=get_preload_paths(
+            sweep_session_id, [img_path_left, img_path_right]
+        ),
+    )
+
+
 # TODO get rid of img_paths in url
 @login_required
 @app.route(
     "/sweep/<string:sweep_session_id>/left=<path:img_path_left>/right=<path:img_path_right>"
 )
 def render_decision(sweep_session_id, img_path_left, img_path_right):
+    img_id_left, img_id_right = None, None
     if img_path_left == "initial":
         starting_image = get_starting_image(sweep_session_id)
         if starting_image:
-            nearest_neighbor = get_nearest_neighbor(sweep_session_id, starting_image.id)
-            img_path_left = starting_image.display_path
-            img_path_right = nearest_neighbor.display_path
+            nearest_neighbor = get_next_image(sweep_session_id, starting_image)
+            return redirect(
+                redirect_to_decision_by_id(
+                    "right", sweep_session_id, starting_image.id, nearest_neighbor.id
+                )
+            )
 
         else:
             # TODO replace fixed image with something else
@@ -513,12 +1609,47 @@ def render_decision(sweep_session_id, img_path_left, img_path_right):
     else:
         img_path_left = img_path_left
         img_path_right = img_path_right
+        image_ids = {
+            display_path: image_id
+            for image_id, display_path in db.session.query(
+                Embedding.id, Embedding.display_path
+            ).filter(
+                Embedding.sweep_session_token == sweep_session_id,
+                Embedding.display_path.in_([img_path_left, img_path_right]),
+            )
+        }
+        img_id_left = image_ids.get(img_path_left)
+        img_id_right = image_ids.get(img_path_right)
 
     return render_template(
         "decision.html",
         sweep_session_id=sweep_session_id,
         img_path_left=img_path_left,
         img_path_right=img_path_right,
+        img_id_left=img_id_left,
+        img_id_right=img_id_right,
+        preload_paths=get_preload_paths(
+            sweep_session_id, [img_path_left, img_path_right]
+        ),
+    )
+
+
+@app.route("/lookahead/<string:sweep_session_id>", methods=["GET"])
+def lookahead_hints(sweep_session_id):
+    """Images the client should preload, given the images it currently shows."""
+    image_paths = request.args.getlist("image")
+    prefetch_next_images(sweep_session_id, *image_paths)
+    preload_paths = get_preload_paths(sweep_session_id, image_paths)
+    return jsonify(
+        {
+            "preload": [
+                url_for("media", filename=image_path, variant="screen")
+                for image_path in preload_paths
+            ],
+            # Off the tour every shown image gets its own candidate once the
+            # background lookup is done
+            "complete": use_tour() or len(preload_paths) >= len(image_paths),
+        }
     )
 
 
@@ -532,44 +1663,44 @@ def end_session():
 @login_required
 def overview():
     """Renders an overview page listing sessions for a given user."""
-    with app.app_context():
-        sweep_sessions_list = get_sessions_for_user(
-            session.get("user")["userinfo"]["name"]
-        )
-
-    sweep_session_images = (
-        {}
-    )  # Dictionary to store session IDs and their corresponding image paths
-    sweep_session_progress_percentage = {}
+    page_size = app.config["OVERVIEW_PAGE_SIZE"]
+    # Keyset pagination, the page starts after the last session id of the previous one
+    after_id = request.args.get("after", type=int)
+    overviews = get_session_overviews(
+        session.get("user")["userinfo"]["name"], limit=page_size, after_id=after_id
+    )
 
-    for sweep_session in sweep_sessions_list:
-        # Get the image paths for the session from the database
-        embeddings = (
-            Embedding.query.filter_by(
-                sweep_session_token=sweep_session.sweep_session_token
-            )
-            .limit(3)
-            .all()
-        )
-        image_paths = [embedding.display_path for embedding in embeddings]
-        sweep_session_images[sweep_session.sweep_session_token] = image_paths
-        percentage = get_percentage_reviewed(sweep_session.sweep_session_token)
-        sweep_session_progress_percentage[
-            sweep_session.sweep_session_token
-        ] = percentage
+    # Dictionaries from session IDs to their preview image paths and progress
+    sweep_session_images = {
+        overview["sweep_session_token"]: overview["preview_paths"]
+        for overview in overviews
+    }
+    sweep_session_progress_percentage = {
+        overview["sweep_session_token"]: overview["percentage_reviewed"]
+        for overview in overviews
+    }
 
     return render_template(
         "overview.html",
-        sweep_sessions_list=[sess.sweep_session_token for sess in sweep_sessions_list],
+        sweep_sessions_list=[overview["sweep_session_token"] for overview in overviews],
         sweep_session_images=sweep_session_images,
         sweep_session_progress_percentage=sweep_session_progress_percentage,
+        ingesting_sessions={
+            token: job.to_dict() for token, job in job_queue.active_jobs().items()
+        },
+        next_page_after=overviews[-1]["id"] if len(overviews) == page_size else None,
     )
 
 
 @app.route("/upload_form/<string:sweep_session_id>")
 @login_required
 def upload_form(sweep_session_id):
-    return render_template("upload.html", sweep_session_id=sweep_session_id)
+    return render_template(
+        "upload.html",
+        sweep_session_id=sweep_session_id,
+        upload_chunk_size=app.config["UPLOAD_CHUNK_SIZE"],
+        upload_concurrency=app.config["UPLOAD_CONCURRENCY"],
+    )
 
 
 @app.route("/upload_image/<string:sweep_session_id>", methods=["POST"])
@@ -586,64 +1717,245 @@ def upload_image(sweep_session_id):
     return "", 204  # Return 204 No Content response
 
 
+def upload_file_client(sweep_session_id: str, filename: str) -> Tuple[utils.FileClient, str]:
+    """File client and sanitized file name of an upload, 404 if the session has no upload dir."""
+    filename = secure_filename(filename)
+    if not filename or secure_filename(sweep_session_id) != sweep_session_id:
+        abort(404)
+    client = utils.FileClient(
+        media_folder=app.config["MEDIA_FOLDER"], sweep_session_id=sweep_session_id,
+    )
+    if not os.path.isdir(client.upload_dir):
+        abort(404)
+    return client, filename
+
+
+@app.route(
+    "/upload_chunk/<string:sweep_session_id>/<string:filename>", methods=["HEAD", "PUT"]
+)
+def upload_chunk(sweep_session_id, filename):
+    """Resumable upload: HEAD reports the offset to resume from, PUT writes the body at `Upload-Offset`."""
+    client, filename = upload_file_client(sweep_session_id, filename)
+    offset = client.upload_offset(filename)
+    headers = {"Upload-Offset": str(offset)}
+    if request.method == "HEAD":
+        if offset == 0 and os.path.exists(os.path.join(client.upload_dir, filename)):
+            headers["Upload-Complete"] = "1"
+        return "", 200, headers
+
+    requested_offset = request.headers.get("Upload-Offset", type=int)
+    if requested_offset is None:
+        return "", 400, headers
+    if requested_offset != offset:
+        # The client is out of sync, e.g. a chunk was written but its response lost
+        return "", 409, headers
+    if (request.content_length or 0) > app.config["UPLOAD_MAX_CHUNK_BYTES"]:
+        return "", 413, headers
+    # Read straight from the socket, no multipart parsing or spooling
+    offset = client.write_upload_chunk(filename, offset, request.stream)
+    return "", 204, {"Upload-Offset": str(offset)}
+
+
+@app.route(
+    "/upload_finalize/<string:sweep_session_id>/<string:filename>", methods=["POST"]
+)
+def upload_finalize(sweep_session_id, filename):
+    """Check the size (and sha256) of a chunked upload and move it into the session dir."""
+    client, filename = upload_file_client(sweep_session_id, filename)
+    size = request.json.get("size")
+    if not isinstance(size, int):
+        return jsonify({"error": "size is required"}), 400
+    if not client.finalize_upload(filename, size, request.json.get("sha256")):
+        return (
+            jsonify(
+                {
+                    "error": "Upload incomplete or corrupted",
+                    "offset": client.upload_offset(filename),
+                }
+            ),
+            409,
+        )
+    return jsonify({"filename": filename, "size": size})
+
+
 @app.route("/upload_done/<string:sweep_session_id>", methods=["GET", "POST"])
 def upload_done(sweep_session_id):
     return f"Upload for {sweep_session_id} completed"
 
 
-@app.route("/embed_images/<string:sweep_session_id>", methods=["GET", "POST"])
-def embed_images(sweep_session_id):
+def ingest_sweep_session(
+    job: jobs.IngestJob, sweep_session_id: str, sweep_session_db_id: int
+) -> None:
+    """Convert and embed all uploaded images of a session, runs on the job queue."""
+    with app.app_context():
+        media_folder = app.config["MEDIA_FOLDER"]
+        image_dir = os.path.join(media_folder, sweep_session_id)
+        # Hidden files include unfinished chunked uploads
+        img_paths = [
+            os.path.join(image_dir, img_path)
+            for img_path in sorted(os.listdir(image_dir))
+            if not img_path.startswith(".")
+        ]
+        job.start(total=len(img_paths))
+
+        # Hash every file once, identical files within the session are collapsed
+        paths_by_hash: Dict[str, str] = {}
+        for img_path in img_paths:
+            content_hash = utils.file_digest(img_path)
+            if content_hash in paths_by_hash:
+                logging.info(f"Skipping {img_path}, same as {paths_by_hash[content_hash]}")
+                job.advance()
+                continue
+            paths_by_hash[content_hash] = img_path
+
+        def is_raw(img_path: str) -> bool:
+            return img_path.endswith(("dng", "DNG"))
+
+        def has_preview(content_hash: str) -> bool:
+            return os.path.exists(utils.content_preview_path(media_folder, content_hash))
+
+        # Random embeddings are never shared, so contents are only known with the service
+        embeddings_enabled = app.config["EMBEDDINGS_ENABLED"]
+        known_embeddings = (
+            get_content_embeddings(list(paths_by_hash)) if embeddings_enabled else {}
+        )
+        reused_paths = {
+            content_hash: img_path
+            for content_hash, img_path in paths_by_hash.items()
+            if content_hash in known_embeddings
+            and (not is_raw(img_path) or has_preview(content_hash))
+        }
+        new_paths = {
+            content_hash: img_path
+            for content_hash, img_path in paths_by_hash.items()
+            if content_hash not in reused_paths
+        }
+
+        def display_and_download_paths(paths: Dict[str, str]):
+            raw_paths = {}
+            for content_hash, img_path in paths.items():
+                if not is_raw(img_path):
+                    yield content_hash, img_path, img_path
+                elif has_preview(content_hash):
+                    # Converted before, in this or any other session
+                    display_path = utils.jpg_twin_path(img_path)
+                    try:
+                        utils.link_file(
+                            utils.content_preview_path(media_folder, content_hash),
+                            display_path,
+                        )
+                    except FileNotFoundError:
+                        # Removed by the janitor in the meantime
+                        raw_paths[img_path] = content_hash
+                        continue
+                    yield content_hash, display_path, img_path
+                else:
+                    raw_paths[img_path] = content_hash
+            # We add the jpg twin for ease of processing if the image is in raw (dng) format
+            logging.info(f"Converting {len(raw_paths)} dng files...")
+            for result in conversion_pool.convert(list(raw_paths)):
+                if result.error:
+                    job.advance()
+                    continue
+                metrics.INGEST_STAGE_SECONDS.observe(result.seconds, "conversion")
+                content_hash = raw_paths[result.path]
+                utils.link_file(
+                    result.display_path,
+                    utils.content_preview_path(media_folder, content_hash),
+                )
+                yield content_hash, result.display_path, result.download_path
+
+        def media_paths(paths: Dict[str, str]):
+            for content_hash, display_path, download_path in display_and_download_paths(
+                paths
+            ):
+                yield (
+                    content_hash,
+                    utils.strip_media_folder_from_path(media_folder, display_path),
+                    download_path,
+                )
+
+        def reused_images():
+            for content_hash, display_path, download_path in media_paths(reused_paths):
+                job.advance()
+                yield display_path, download_path, known_embeddings[content_hash], content_hash
+
+        def embedded_images():
+            if embeddings_enabled:
+                # Batched and pipelined, the service reads the images from the media folder
+                embedded = embeddings_client.embed(
+                    media_paths(new_paths), path_of=lambda paths: paths[1]
+                )
+            else:
+                embedded = (
+                    (paths, np.random.rand(384)) for paths in media_paths(new_paths)
+                )
+            for (content_hash, display_path, download_path), embedding in embedded:
+                job.advance()
+                if embedding is None:
+                    continue
+                yield (
+                    display_path,
+                    download_path,
+                    embedding,
+                    content_hash if embeddings_enabled else None,
+                )
 
-    image_dir = os.path.join(app.config["MEDIA_FOLDER"], sweep_session_id)
+        logging.info(
+            f"Reusing {len(reused_paths)} known embeddings, embedding {len(new_paths)} images."
+        )
+        # Write the embeddings to the database
+        inserted = add_embeddings_for_sweep_session(
+            sweep_session_db_id, itertools.chain(reused_images(), embedded_images())
+        )
+        logging.info(f"{inserted} images added to session {sweep_session_id}.")
+
+        if use_tour() or app.config["NEIGHBOR_GRAPH_K"]:
+            session_matrix = load_session_matrix(sweep_session_id)
+        if use_tour():
+            with metrics.INGEST_STAGE_SECONDS.time("tour"):
+                tour_length = compute_session_tour(sweep_session_id, session_matrix)
+            logging.info(f"Stored a tour of {tour_length} images for {sweep_session_id}.")
+        if app.config["NEIGHBOR_GRAPH_K"]:
+            with metrics.INGEST_STAGE_SECONDS.time("neighbor_graph"):
+                edges = compute_neighbor_graph(sweep_session_id, session_matrix)
+            logging.info(f"Stored {edges} neighbor graph edges for {sweep_session_id}.")
 
+
+@app.route("/embed_images/<string:sweep_session_id>", methods=["GET", "POST"])
+def embed_images(sweep_session_id):
     new_sweep_session = add_session_for_user(
         session.get("user")["userinfo"]["name"], sweep_session_id
     )
 
     logging.info(f"New session added with ID {new_sweep_session.id}")
 
-    for img_path in os.listdir(image_dir):
-        # We add the jpg twin for ease of processing if the image is in raw (dng) format
-        if img_path.endswith(("dng", "DNG")):
-            logging.info("dng detected... converting")
-            # TODO update utils, so only image name is returned
-            display_path, download_path = utils.convert_dng_to_jpg(
-                os.path.join(image_dir, img_path)
-            )
-        # TODO change `os.path.join(image_dir, img_path)` to `img_path`
-        else:
-            display_path, download_path = (
-                os.path.join(image_dir, img_path),
-                os.path.join(image_dir, img_path),
-            )
-
-        # # TODO replace with actual embedding from embeddings API
-        # embedding_request_url = f"{app.config['EMBEDDINGS_HOST']}:{app.config['EMBEDDINGS_PORT']}/embed_image/{display_path}"
-        # response = requests.get(embedding_request_url)
-        # embedding = response.json()
-
-        embedding = np.random.rand(384)
+    job = job_queue.submit(
+        sweep_session_id, ingest_sweep_session, sweep_session_id, new_sweep_session.id
+    )
 
-        # Write the embedding to the database
-        embedding_row = add_embedding_for_sweep_session(
-            new_sweep_session.id,
-            utils.strip_media_folder_from_path(
-                app.config["MEDIA_FOLDER"], display_path
+    if request.method == "POST":
+        return (
+            jsonify(
+                {
+                    "job_id": job.id,
+                    "status_url": url_for("ingest_status", job_id=job.id),
+                }
             ),
-            download_path,
-            embedding,
+            202,
         )
-        if embedding_row:
-            logging.info(f"Image {display_path} added successfully. ..")
-        else:
-            logging.info(
-                f"Something went wrong when attempting to add image {display_path}"
-            )
-
-    # Once everything is inserted, go to overview page where added session should be listed...
+    # The overview lists the session as ingesting until the job is done
     return redirect(url_for("overview"))
 
 
+@app.route("/ingest_status/<string:job_id>", methods=["GET"])
+def ingest_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job.to_dict())
+
+
 @app.route("/uploads/<filename>")
 def uploaded_file(filename):
     return send_from_directory(app.config["UPLOAD_FOLDER"], filename)
@@ -664,11 +1976,17 @@ def download_subset(sweep_session_id):
         # TODO send message to client that no images were selected
         return redirect(url_for("overview"))
 
-    # Create a zip file containing all uploaded files
-    zip_filename = file_client.zip_dir(subset)
-    # Send the zip file to the client
-    return send_from_directory(
-        app.config["MEDIA_FOLDER"], zip_filename, as_attachment=True
+    download_name = f"{sweep_session_id}.zip"
+    # Archives are cached per keep-set, so repeated downloads are plain file responses
+    archive_path = file_client.archive_path(subset)
+    if os.path.exists(archive_path):
+        return send_file(archive_path, as_attachment=True, download_name=download_name)
+
+    # Otherwise stream the zip to the client while it is being built
+    return Response(
+        file_client.stream_zip(subset),
+        mimetype="application/zip",
+        headers={"Content-Disposition": f"attachment; filename={download_name}"},
     )
 
 
@@ -685,8 +2003,11 @@ def init_new_sweep_session():
 
 
 @app.route("/drop_sweep_session/<string:sweep_session_id>")
+@login_required
 def drop_sweep_session(sweep_session_id):
     """Remove a session and all its contents from the database and the media directory."""
+    if not utils.is_session_id(sweep_session_id):
+        abort(404)
     success = remove_session_for_user(
         session.get("user")["userinfo"]["name"], sweep_session_id
     )
@@ -695,17 +2016,175 @@ def drop_sweep_session(sweep_session_id):
             f"SweepSession {sweep_session_id} successfully removed from database."
         )
     else:
+        # Not a session of this user, so its directory is left alone
         logging.info(
             f"Something went wrong when attempting to remove session {sweep_session_id}."
         )
+        return redirect(url_for("overview"))
 
     client = utils.FileClient(
         media_folder=app.config["MEDIA_FOLDER"], sweep_session_id=sweep_session_id,
     )
-    client.remove_directory()
+    if client.trash_directory() is None:
+        logging.info(f"No directory found for session {sweep_session_id}.")
+    trash_reaper.schedule()
 
     return redirect(url_for("overview"))
 
 
+@app.route("/metrics")
+def metrics_endpoint():
+    if not app.config["METRICS_ENABLED"]:
+        abort(404)
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
+
+
+def is_admin() -> bool:
+    user = session.get("user")
+    return bool(user) and user["userinfo"]["name"] in app.config["ADMIN_EMAILS"]
+
+
+@app.route("/admin/profiling", methods=["GET"])
+@login_required
+def profiling_status():
+    """Armed endpoints and the captures of this worker's profiler."""
+    if not is_admin():
+        abort(403)
+    return jsonify(
+        {
+            "pid": os.getpid(),
+            "armed": profiler.armed(),
+            "sampling": profiler.sampling(),
+            "captures": profiler.captures(),
+        }
+    )
+
+
+@app.route("/admin/profiling/requests", methods=["POST"])
+@login_required
+def profile_requests():
+    """Run the next `count` requests to `endpoint` (e.g. like_image) under cProfile."""
+    if not is_admin():
+        abort(403)
+    endpoint = request.json.get("endpoint")
+    try:
+        count = int(request.json.get("count", 1))
+    except (TypeError, ValueError):
+        count = -1
+    if endpoint not in app.view_functions or not 0 <= count <= 1000:
+        return jsonify({"error": "Unknown endpoint or invalid count"}), 400
+    profiler.arm(endpoint, count)
+    logging.info(f"Profiling the next {count} requests to {endpoint} in worker {os.getpid()}")
+    return jsonify({"pid": os.getpid(), "armed": profiler.armed()})
+
+
+@app.route("/admin/profiling/sample", methods=["POST"])
+@login_required
+def profile_sample():
+    """Sample the stacks of all threads of this worker for `seconds`."""
+    if not is_admin():
+        abort(403)
+    try:
+        seconds = float(request.json.get("seconds", 10))
+        interval = float(request.json.get("interval", 0.005))
+    except (TypeError, ValueError):
+        seconds = interval = 0.0
+    if not 0 < seconds <= 600 or not 0.001 <= interval <= 1:
+        return jsonify({"error": "Invalid seconds or interval"}), 400
+    if not profiler.sample(seconds, interval):
+        return jsonify({"error": "Already sampling"}), 409
+    logging.info(f"Sampling worker {os.getpid()} for {seconds}s")
+    return jsonify({"pid": os.getpid(), "sampling": True}), 202
+
+
+@app.route("/admin/profiling/captures/<string:name>", methods=["GET"])
+@login_required
+def profile_capture(name):
+    if not is_admin():
+        abort(403)
+    return send_from_directory(profiler.capture_dir, name, as_attachment=True)
+
+
+@app.before_request
+def track_session_access():
+    sweep_session_id = (request.view_args or {}).get("sweep_session_id")
+    if sweep_session_id:
+        access_tracker.touch(sweep_session_id)
+
+
+def session_usages() -> List[janitor.SessionUsage]:
+    """Disk usage and last access of every session that isn't being ingested right now."""
+    ingesting = job_queue.active_jobs()
+    rows = db.session.query(
+        SweepSession.sweep_session_token, User.email, SweepSession.last_access_time
+    ).join(User, User.id == SweepSession.user_id)
+    return [
+        janitor.SessionUsage(
+            sweep_session_id,
+            email,
+            last_access_time.timestamp(),
+            janitor.directory_size(
+                os.path.join(app.config["MEDIA_FOLDER"], sweep_session_id),
+                exclusive=True,
+            ),
+        )
+        for sweep_session_id, email, last_access_time in rows
+        if sweep_session_id not in ingesting
+    ]
+
+
+def evict_session(email: str, sweep_session_id: str) -> bool:
+    if not remove_session_for_user(email, sweep_session_id):
+        return False
+    utils.FileClient(
+        media_folder=app.config["MEDIA_FOLDER"], sweep_session_id=sweep_session_id,
+    ).trash_directory()
+    trash_reaper.schedule()
+    return True
+
+
+def run_janitor(dry_run: bool = True) -> dict:
+    """Enforce the disk quotas of the media folder, see janitor.Janitor."""
+    access_tracker.flush()
+    media_janitor = janitor.Janitor(
+        app.config["MEDIA_FOLDER"],
+        derivative_cache,
+        user_quota=app.config["USER_QUOTA_BYTES"],
+        global_quota=app.config["GLOBAL_QUOTA_BYTES"],
+        session_ttl=app.config["SESSION_TTL_DAYS"] * 24 * 3600,
+        content_ttl=app.config["CONTENT_TTL_DAYS"] * 24 * 3600,
+    )
+    # Content previews stay while a session references their hash
+    referenced_content = {
+        content_hash
+        for (content_hash,) in db.session.query(ContentEmbedding.content_hash).filter(
+            ContentEmbedding.ref_count > 0
+        )
+    }
+    return media_janitor.run(
+        session_usages(),
+        evict_session,
+        dry_run=dry_run,
+        referenced_content=referenced_content,
+    )
+
+
+@app.cli.command("janitor")
+@click.option("--dry-run", is_flag=True, help="Only report what would be evicted.")
+def janitor_command(dry_run):
+    """Evict archives, derivatives and expired sessions until the disk quotas are met."""
+    with app.app_context():
+        report = run_janitor(dry_run)
+    click.echo(json.dumps(report, indent=2))
+
+
 if __name__ == "__main__":
-    app.run(port=app.config["GATEWAY_PORT"], debug=True)
+    # Serve through the flask CLI instead: the conversion workers import the
+    # main module again, which must not be this file, since it creates the app
+    os.execv(
+        sys.executable,
+        [
+            sys.executable, "-m", "flask", "--app", os.path.abspath(__file__),
+            "run", "--debug", "--port", app.config["GATEWAY_PORT"],
+        ],
+    )
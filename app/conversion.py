@@ -0,0 +1,156 @@
+import os
+import time
+import queue
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Iterator, List, Optional
+
+import utils
+
+# Rough peak memory of decoding a raw file relative to its size on disk: LibRaw's
+# 4x16 bit working image, the raw buffer and the 8 bit RGB output for a losslessly
+# compressed DNG add up to about 12x the file size. A half-size demosaic (which
+# is also the fallback of "embedded") needs about a third of that.
+DECODE_FACTORS = {"embedded": 4, "half": 4, "full": 12}
+DECODE_FACTOR = DECODE_FACTORS["full"]
+
+
+class MemoryBudget:
+    """Admission control for work whose (estimated) memory use must stay below a budget."""
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.used = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, nbytes: int) -> None:
+        """Block until `nbytes` fit into the budget; an oversized item is admitted alone."""
+        with self._condition:
+            while self.used > 0 and self.used + nbytes > self.max_bytes:
+                self._condition.wait()
+            self.used += nbytes
+
+    def release(self, nbytes: int) -> None:
+        with self._condition:
+            self.used -= nbytes
+            self._condition.notify_all()
+
+
+class ConversionResult:
+    def __init__(
+        self,
+        path: str,
+        estimated_bytes: int,
+        display_path: Optional[str] = None,
+        download_path: Optional[str] = None,
+        seconds: float = 0.0,
+        error: Optional[str] = None,
+    ) -> None:
+        self.path = path
+        self.estimated_bytes = estimated_bytes
+        self.display_path = display_path
+        self.download_path = download_path
+        self.seconds = seconds
+        self.error = error
+
+    def __repr__(self) -> str:
+        return f"ConversionResult('{self.path}', {self.seconds:.2f}s, error={self.error})"
+
+
+def estimate_decoded_bytes(path: str, decode_factor: int = DECODE_FACTOR) -> int:
+    return os.path.getsize(path) * decode_factor
+
+
+def _convert(path: str, strategy: str):
+    # Runs in a worker process
+    start = time.perf_counter()
+    display_path, download_path = utils.convert_dng_to_jpg(path, strategy)
+    return display_path, download_path, time.perf_counter() - start
+
+
+class ConversionPool:
+    """Converts raw files on a process pool while keeping the estimated decode memory within a budget."""
+
+    def __init__(
+        self,
+        max_workers: Optional[int] = None,
+        memory_budget: int = 4 * 1024 ** 3,
+        strategy: str = "full",
+    ) -> None:
+        self.max_workers = max_workers or os.cpu_count()
+        self.budget = MemoryBudget(memory_budget)
+        self.strategy = strategy
+        self.decode_factor = DECODE_FACTORS[strategy]
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        # Workers are started on first use, not when the app is imported
+        with self._lock:
+            if self._executor is None:
+                # Not forked from the app, whose other threads may hold locks
+                # (logging, database pools) that would stay locked in the child
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("forkserver"),
+                )
+            return self._executor
+
+    def convert(self, paths: List[str]) -> Iterator[ConversionResult]:
+        """Convert raw files to jpg twins, yielding results in completion order."""
+        if not paths:
+            return
+        results: "queue.Queue[ConversionResult]" = queue.Queue()
+
+        def on_done(future: Future, path: str, estimated_bytes: int) -> None:
+            self.budget.release(estimated_bytes)
+            try:
+                display_path, download_path, seconds = future.result()
+                results.put(
+                    ConversionResult(
+                        path, estimated_bytes, display_path, download_path, seconds
+                    )
+                )
+            except Exception as e:
+                results.put(ConversionResult(path, estimated_bytes, error=str(e)))
+
+        def submit_all() -> None:
+            for path in paths:
+                try:
+                    estimated_bytes = estimate_decoded_bytes(path, self.decode_factor)
+                except OSError as e:
+                    results.put(ConversionResult(path, 0, error=e.strerror))
+                    continue
+                self.budget.acquire(estimated_bytes)
+                try:
+                    future = self.executor.submit(_convert, path, self.strategy)
+                except Exception as e:
+                    self.budget.release(estimated_bytes)
+                    results.put(ConversionResult(path, estimated_bytes, error=str(e)))
+                    continue
+                future.add_done_callback(
+                    lambda f, p=path, n=estimated_bytes: on_done(f, p, n)
+                )
+
+        # Submit from a separate thread, so finished conversions are handed out
+        # while others still wait for budget
+        threading.Thread(target=submit_all, daemon=True).start()
+        for _ in paths:
+            result = results.get()
+            if result.error:
+                logging.error(f"Converting {result.path} failed: {result.error}")
+            else:
+                logging.info(
+                    f"Converted {result.path} in {result.seconds:.2f}s "
+                    f"(~{result.estimated_bytes / 1024 ** 2:.0f} MB budgeted)"
+                )
+            yield result
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
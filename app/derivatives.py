@@ -0,0 +1,133 @@
+import os
+import uuid
+import logging
+import threading
+from typing import Optional
+
+from PIL import Image, ImageOps
+
+import utils
+
+# Longest side in px of each display variant
+VARIANTS = {"thumb": 320, "screen": 2048}
+# Encodings of the variants as (PIL format, extension, mimetype)
+FORMATS = {
+    "webp": ("WEBP", "webp", "image/webp"),
+    "jpeg": ("JPEG", "jpg", "image/jpeg"),
+}
+
+
+class DerivativeCache:
+    """On-disk cache of resized, orientation-corrected display images, keyed by source file contents."""
+
+    def __init__(self, cache_dir: str, max_bytes: int) -> None:
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._nbytes: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def path_for(self, content_hash: str, variant: str, fmt: str) -> str:
+        extension = FORMATS[fmt][1]
+        return os.path.join(
+            self.cache_dir, content_hash[:2], f"{content_hash}-{variant}.{extension}"
+        )
+
+    def get(self, source_path: str, variant: str, fmt: str = "jpeg") -> str:
+        """Get the path of a variant of `source_path`, rendering it on a miss."""
+        path = self.path_for(utils.file_digest(source_path), variant, fmt)
+        try:
+            # The modification time doubles as last access time for eviction
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            pass
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Render into a temporary file, so concurrent readers never see partial files
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            self.render(source_path, tmp_path, variant, fmt)
+            with self._lock:
+                nbytes = self.size()
+                # A concurrent request may have rendered the same variant meanwhile
+                try:
+                    nbytes -= os.path.getsize(path)
+                except FileNotFoundError:
+                    pass
+                os.replace(tmp_path, path)
+                self._nbytes = nbytes + os.path.getsize(path)
+                if self._nbytes > self.max_bytes:
+                    self.evict(keep=path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return path
+
+    @staticmethod
+    def render(source_path: str, path: str, variant: str, fmt: str) -> None:
+        size = VARIANTS[variant]
+        with Image.open(source_path) as img:
+            # Let the JPEG decoder downscale while decoding, which is much cheaper
+            img.draft("RGB", (size, size))
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((size, size), Image.LANCZOS)
+            if img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            img.save(path, FORMATS[fmt][0], quality=85)
+
+    def size(self) -> int:
+        if self._nbytes is None:
+            self._nbytes = sum(entry[2] for entry in self.entries())
+        return self._nbytes
+
+    def evict(
+        self, target_bytes: Optional[int] = None, keep: Optional[str] = None
+    ) -> int:
+        """Remove least recently used variants until the cache fits `target_bytes`, returns bytes freed."""
+        if target_bytes is None:
+            # Leave some headroom, so we don't evict on every new variant
+            target_bytes = int(self.max_bytes * 0.9)
+        entries = sorted(self.entries(), key=lambda entry: entry[1])
+        total = sum(entry[2] for entry in entries)
+        freed = 0
+        for path, _, nbytes in entries:
+            if total - freed <= target_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                freed += nbytes
+            except FileNotFoundError:
+                pass
+        self._nbytes = total - freed
+        logging.info(f"Evicted {freed} bytes from {self.cache_dir}")
+        return freed
+
+    def remove(self, path: str) -> int:
+        """Remove a single cached variant, returns bytes freed."""
+        with self._lock:
+            try:
+                nbytes = os.path.getsize(path)
+                os.remove(path)
+            except FileNotFoundError:
+                return 0
+            self._nbytes = None
+        return nbytes
+
+    def entries(self):
+        """(path, mtime, size) of every cached variant."""
+        if not os.path.isdir(self.cache_dir):
+            return []
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for file in files:
+                if file.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, file)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((path, stat.st_mtime, stat.st_size))
+        return entries
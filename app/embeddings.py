@@ -0,0 +1,153 @@
+import base64
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple, TypeVar
+from urllib.parse import quote
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+
+T = TypeVar("T")
+
+
+def encode_embeddings(embeddings: np.ndarray) -> dict:
+    """Wire format of a batch of embeddings: base64 of the little endian float32 matrix."""
+    embeddings = np.ascontiguousarray(embeddings, dtype="<f4")
+    return {
+        "dtype": "float32",
+        "shape": list(embeddings.shape),
+        "data": base64.b64encode(embeddings.tobytes()).decode("ascii"),
+    }
+
+
+def decode_embeddings(payload: dict) -> np.ndarray:
+    """Decode a service response to a float32 matrix, accepting plain JSON lists as well."""
+    if "data" in payload:
+        embeddings = np.frombuffer(base64.b64decode(payload["data"]), dtype="<f4")
+        return embeddings.reshape(payload["shape"]).astype(np.float32, copy=False)
+    return np.asarray(payload["embeddings"], dtype=np.float32)
+
+
+class EmbeddingsClient:
+    """Client for the embeddings service with keep-alive pooling, batching, bounded concurrency and retries.
+
+    Images are sent as paths relative to the media folder, which the service
+    reads itself, `batch_size` per POST to `/embed_images`. Services without
+    that endpoint (404 / 405) are asked one image at a time through
+    `GET /embed_image/<path>` instead, which returns the embedding as a list.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        batch_size: int = 32,
+        max_concurrency: int = 4,
+        timeout: float = 30.0,
+        retries: int = 3,
+        dim: int = 384,
+    ) -> None:
+        self.url = f"{base_url.rstrip('/')}/embed_images"
+        self.image_url = f"{base_url.rstrip('/')}/embed_image/"
+        self.batch_endpoint = True
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.dim = dim
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=0.5,
+            status_forcelist=(429, 500, 502, 503, 504),
+            # Embedding is idempotent, so POSTs may be retried as well
+            allowed_methods=frozenset({"GET", "POST"}),
+        )
+        # One pooled connection per concurrent batch, kept alive between batches
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=max_concurrency, max_retries=retry
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix="embeddings"
+        )
+
+    def embed_batch(self, image_paths: List[str]) -> np.ndarray:
+        """Embed one batch of images, returns a (len(image_paths), dim) float32 matrix."""
+        if self.batch_endpoint:
+            response = self.session.post(
+                self.url, json={"paths": image_paths}, timeout=self.timeout
+            )
+            if response.status_code in (404, 405):
+                logging.warning(
+                    f"{self.url} is not available, embedding one image per request"
+                )
+                self.batch_endpoint = False
+            else:
+                response.raise_for_status()
+                embeddings = decode_embeddings(response.json())
+        if not self.batch_endpoint:
+            embeddings = np.stack([self.embed_image(path) for path in image_paths])
+        if embeddings.shape != (len(image_paths), self.dim):
+            raise ValueError(
+                f"Expected embeddings of shape {(len(image_paths), self.dim)}, "
+                f"got {embeddings.shape}"
+            )
+        return embeddings
+
+    def embed_image(self, image_path: str) -> np.ndarray:
+        """Embed a single image through the per-image endpoint of older services."""
+        response = self.session.get(
+            self.image_url + quote(image_path.lstrip("/")), timeout=self.timeout
+        )
+        response.raise_for_status()
+        embedding = np.asarray(response.json(), dtype=np.float32)
+        if embedding.shape != (self.dim,):
+            raise ValueError(
+                f"Expected an embedding of shape {(self.dim,)}, got {embedding.shape}"
+            )
+        return embedding
+
+    def _embed_items(
+        self, batch: List[T], path_of: Callable[[T], str]
+    ) -> List[Tuple[T, Optional[np.ndarray]]]:
+        try:
+            with metrics.INGEST_STAGE_SECONDS.time("embedding"):
+                embeddings = self.embed_batch([path_of(item) for item in batch])
+        except (requests.RequestException, ValueError, KeyError) as e:
+            logging.error(f"Embedding a batch of {len(batch)} images failed: {e}")
+            return [(item, None) for item in batch]
+        return list(zip(batch, embeddings))
+
+    def embed(
+        self, items: Iterable[T], path_of: Callable[[T], str] = str
+    ) -> Iterator[Tuple[T, Optional[np.ndarray]]]:
+        """Embed a stream of items in batches, yielding (item, embedding) in input order.
+
+        At most `max_concurrency` batches are in flight, so the input is consumed
+        only as fast as the service keeps up. Items of a batch that failed after
+        all retries are yielded with None.
+        """
+        in_flight = deque()
+        batch: List[T] = []
+        for item in items:
+            batch.append(item)
+            if len(batch) < self.batch_size:
+                continue
+            if len(in_flight) >= self.max_concurrency:
+                yield from in_flight.popleft().result()
+            in_flight.append(self._executor.submit(self._embed_items, batch, path_of))
+            batch = []
+        if batch:
+            in_flight.append(self._executor.submit(self._embed_items, batch, path_of))
+        while in_flight:
+            yield from in_flight.popleft().result()
+
+    def close(self) -> None:
+        self._executor.shutdown()
+        self.session.close()
@@ -0,0 +1,91 @@
+"""Local stand-in for the embeddings service.
+
+Serves `POST /embed_images` and the older per-image `GET /embed_image/<path>`
+with the same request and response formats as the real service, but derives
+each embedding from a hash of the image file instead of running a model, so
+the same image always gets the same vector. An optional per-image delay
+simulates model time, `--no-batch` a service without the batch endpoint. Run
+from `app/`:
+
+    python embeddings_stub.py [--port 5001] [--media-folder DIR] [--latency 0.01]
+"""
+import os
+import time
+import hashlib
+import argparse
+
+import numpy as np
+from dotenv import find_dotenv, load_dotenv
+from flask import Flask, abort, jsonify, request
+from werkzeug.security import safe_join
+
+from embeddings import encode_embeddings
+
+DIM = 384
+
+
+def stub_embedding(path: str, dim: int = DIM) -> np.ndarray:
+    """Unit vector seeded by the sha256 of the file's content."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    rng = np.random.default_rng(int.from_bytes(digest.digest()[:8], "little"))
+    embedding = rng.standard_normal(dim).astype(np.float32)
+    return embedding / np.linalg.norm(embedding)
+
+
+def create_stub_app(
+    media_folder: str, latency: float = 0.0, batch_endpoint: bool = True
+) -> Flask:
+    stub = Flask(__name__)
+
+    def embed(path: str) -> np.ndarray:
+        full_path = safe_join(media_folder, path.lstrip("/"))
+        # 400 rather than 404, which clients take for a missing endpoint
+        if full_path is None or not os.path.isfile(full_path):
+            abort(400)
+        return stub_embedding(full_path)
+
+    def embed_images():
+        paths = (request.get_json(silent=True) or {}).get("paths")
+        if not isinstance(paths, list):
+            abort(400)
+        embeddings = np.empty((len(paths), DIM), dtype=np.float32)
+        for i, path in enumerate(paths):
+            embeddings[i] = embed(path)
+        if latency:
+            time.sleep(latency * len(paths))
+        return jsonify(encode_embeddings(embeddings))
+
+    @stub.route("/embed_image/<path:path>", methods=["GET"])
+    def embed_image(path):
+        embedding = embed(path)
+        if latency:
+            time.sleep(latency)
+        return jsonify(embedding.tolist())
+
+    if batch_endpoint:
+        stub.add_url_rule("/embed_images", view_func=embed_images, methods=["POST"])
+    return stub
+
+
+def main() -> None:
+    load_dotenv(find_dotenv(".env.dev"))
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=int(os.getenv("EMBEDDINGS_PORT", "5001")))
+    parser.add_argument("--media-folder", default=os.getenv("MEDIA_FOLDER"))
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per image")
+    parser.add_argument(
+        "--no-batch", action="store_true", help="only serve GET /embed_image/<path>"
+    )
+    args = parser.parse_args()
+    if not args.media_folder:
+        parser.error("--media-folder or MEDIA_FOLDER is required")
+    create_stub_app(args.media_folder, args.latency, not args.no_batch).run(
+        port=args.port, threaded=True
+    )
+
+
+if __name__ == "__main__":
+    main()
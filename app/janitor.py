@@ -0,0 +1,276 @@
+import os
+import glob
+import time
+import logging
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import utils
+from derivatives import DerivativeCache
+
+def directory_size(
+    path: str, seen: Optional[Set[Tuple[int, int]]] = None, exclusive: bool = False
+) -> int:
+    """Bytes used by the files below `path`, hardlinked files are only counted once.
+
+    With `exclusive` files also linked from elsewhere (e.g. `.content`) are left
+    out, so the result is what removing the directory actually frees.
+    """
+    seen = set() if seen is None else seen
+    total = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            try:
+                stat = os.lstat(os.path.join(root, file))
+            except FileNotFoundError:
+                continue
+            if (stat.st_dev, stat.st_ino) in seen or (exclusive and stat.st_nlink > 1):
+                continue
+            seen.add((stat.st_dev, stat.st_ino))
+            total += stat.st_size
+    return total
+
+
+class SessionUsage:
+    def __init__(
+        self, sweep_session_id: str, email: str, last_access_time: float, nbytes: int
+    ) -> None:
+        self.sweep_session_id = sweep_session_id
+        self.email = email
+        self.last_access_time = last_access_time
+        self.nbytes = nbytes
+
+
+class Eviction:
+    """Something the janitor can delete: an archive, a derivative or a whole session."""
+
+    def __init__(
+        self,
+        kind: str,
+        key: str,
+        nbytes: int,
+        last_access_time: float,
+        owner: Optional[str] = None,
+    ) -> None:
+        self.kind = kind
+        self.key = key
+        self.nbytes = nbytes
+        self.last_access_time = last_access_time
+        self.owner = owner
+        self.reason: Optional[str] = None
+
+    def to_dict(self) -> dict:
+        return {
+            "kind": self.kind,
+            "key": self.key,
+            "bytes": self.nbytes,
+            "last_access_time": self.last_access_time,
+            "owner": self.owner,
+            "reason": self.reason,
+        }
+
+
+class Janitor:
+    """Keeps the media folder within per-user and global disk quotas.
+
+    Converted previews in `.content` that no session has used for `content_ttl`
+    seconds are always removed. Beyond that cached zip archives go first, then display derivatives
+    and only then whole sessions whose last access is older than `session_ttl`
+    seconds, each in least recently used order. Derivatives are shared between
+    users, so they only count towards the global quota. A quota of 0 is unlimited.
+    """
+
+    def __init__(
+        self,
+        media_folder: str,
+        derivative_cache: DerivativeCache,
+        user_quota: int = 0,
+        global_quota: int = 0,
+        session_ttl: float = 30 * 24 * 3600,
+        content_ttl: float = 7 * 24 * 3600,
+    ) -> None:
+        self.media_folder = media_folder
+        self.derivative_cache = derivative_cache
+        self.user_quota = user_quota
+        self.global_quota = global_quota
+        self.session_ttl = session_ttl
+        self.content_ttl = content_ttl
+
+    def archives(self, owners: Dict[str, str]) -> List[Eviction]:
+        """Cached download archives, including the legacy `<token>.zip` of FileClient.zip_dir."""
+        archives = []
+        paths = glob.glob(os.path.join(self.media_folder, ".archives", "*.zip")) + glob.glob(
+            os.path.join(self.media_folder, "*.zip")
+        )
+        for path in paths:
+            sweep_session_id = os.path.basename(path)[: -len(".zip")].split("-")[0]
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            archives.append(
+                Eviction(
+                    "archive",
+                    path,
+                    stat.st_size,
+                    max(stat.st_atime, stat.st_mtime),
+                    owners.get(sweep_session_id),
+                )
+            )
+        return archives
+
+    def contents(self, referenced: Set[str], now: float) -> List[Eviction]:
+        """Content previews without references: no content embedding and no hardlink from a session.
+
+        Removing the last session hardlink updates the ctime of a preview, so
+        previews unreferenced for less than `content_ttl` are kept for re-uploads.
+        """
+        unreferenced = []
+        for path in glob.glob(os.path.join(self.media_folder, utils.CONTENT_DIR, "*.jpg")):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            content_hash = os.path.splitext(os.path.basename(path))[0]
+            if (
+                stat.st_nlink > 1
+                or content_hash in referenced
+                or stat.st_ctime > now - self.content_ttl
+            ):
+                continue
+            unreferenced.append(Eviction("content", path, stat.st_size, stat.st_mtime))
+        return unreferenced
+
+    def derivatives(self) -> List[Eviction]:
+        return [
+            Eviction("derivative", path, nbytes, mtime)
+            for path, mtime, nbytes in self.derivative_cache.entries()
+        ]
+
+    def plan(
+        self,
+        sessions: List[SessionUsage],
+        now: Optional[float] = None,
+        referenced_content: Set[str] = frozenset(),
+    ) -> Tuple[List[Eviction], dict]:
+        """Decide what to evict, returns the evictions and the usage they were planned on.
+
+        `referenced_content` are the content hashes still referenced by some session.
+        """
+        now = time.time() if now is None else now
+        owners = {usage.sweep_session_id: usage.email for usage in sessions}
+        archives = sorted(
+            self.archives(owners), key=lambda eviction: eviction.last_access_time
+        )
+        expired_sessions = sorted(
+            (
+                Eviction(
+                    "session",
+                    usage.sweep_session_id,
+                    usage.nbytes,
+                    usage.last_access_time,
+                    usage.email,
+                )
+                for usage in sessions
+                if usage.last_access_time < now - self.session_ttl
+            ),
+            key=lambda eviction: eviction.last_access_time,
+        )
+
+        evictions: List[Eviction] = []
+        evicted: Set[Tuple[str, str]] = set()
+        for content in self.contents(referenced_content, now):
+            content.reason = "unreferenced"
+            evictions.append(content)
+            evicted.add((content.kind, content.key))
+
+        def evict(candidates: Iterable[Eviction], usage: int, quota: int, reason: str) -> int:
+            for candidate in candidates:
+                if usage <= quota:
+                    break
+                if (candidate.kind, candidate.key) in evicted:
+                    continue
+                candidate.reason = reason
+                evictions.append(candidate)
+                evicted.add((candidate.kind, candidate.key))
+                usage -= candidate.nbytes
+            return usage
+
+        user_usage: Dict[str, int] = defaultdict(int)
+        for usage in sessions:
+            user_usage[usage.email] += usage.nbytes
+        for archive in archives:
+            if archive.owner is not None:
+                user_usage[archive.owner] += archive.nbytes
+        over_quota_users = []
+        if self.user_quota:
+            for email, usage in user_usage.items():
+                if usage <= self.user_quota:
+                    continue
+                usage = evict(
+                    [a for a in archives if a.owner == email]
+                    + [s for s in expired_sessions if s.owner == email],
+                    usage,
+                    self.user_quota,
+                    "user quota",
+                )
+                if usage > self.user_quota:
+                    over_quota_users.append(email)
+
+        global_usage = directory_size(self.media_folder)
+        remaining = global_usage - sum(eviction.nbytes for eviction in evictions)
+        if self.global_quota and remaining > self.global_quota:
+            derivatives = sorted(
+                self.derivatives(), key=lambda eviction: eviction.last_access_time
+            )
+            remaining = evict(
+                archives + derivatives + expired_sessions,
+                remaining,
+                self.global_quota,
+                "global quota",
+            )
+
+        return evictions, {
+            "usage_bytes": global_usage,
+            "user_usage_bytes": dict(user_usage),
+            "over_quota_users": over_quota_users,
+            "over_global_quota": bool(self.global_quota and remaining > self.global_quota),
+        }
+
+    def run(
+        self,
+        sessions: List[SessionUsage],
+        remove_session: Callable[[str, str], bool],
+        dry_run: bool = True,
+        referenced_content: Set[str] = frozenset(),
+    ) -> dict:
+        """Plan and (unless `dry_run`) carry out the evictions, returns a report of the reclaimed bytes.
+
+        Sessions are removed through `remove_session(email, sweep_session_id)`.
+        """
+        evictions, usage = self.plan(sessions, referenced_content=referenced_content)
+        reclaimed_by_kind: Dict[str, int] = defaultdict(int)
+        for eviction in evictions:
+            if not dry_run:
+                try:
+                    if eviction.kind in ("archive", "content"):
+                        os.remove(eviction.key)
+                    elif eviction.kind == "derivative":
+                        self.derivative_cache.remove(eviction.key)
+                    elif not remove_session(eviction.owner, eviction.key):
+                        continue
+                except OSError as e:
+                    logging.error(f"Evicting {eviction.kind} {eviction.key} failed: {e}")
+                    continue
+                logging.info(
+                    f"Evicted {eviction.kind} {eviction.key} ({eviction.nbytes} bytes, {eviction.reason})"
+                )
+            reclaimed_by_kind[eviction.kind] += eviction.nbytes
+
+        return {
+            "dry_run": dry_run,
+            **usage,
+            "reclaimed_bytes": sum(reclaimed_by_kind.values()),
+            "reclaimed_bytes_by_kind": dict(reclaimed_by_kind),
+            "evictions": [eviction.to_dict() for eviction in evictions],
+        }
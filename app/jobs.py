@@ -0,0 +1,228 @@
+import os
+import re
+import glob
+import json
+import time
+import uuid
+import socket
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+JOB_ID = re.compile(r"[0-9a-f]{32}")
+# Progress is written to the state file at most this often (seconds)
+SAVE_INTERVAL = 1.0
+
+
+class IngestJob:
+    """Progress of a background ingestion of one sweep session."""
+
+    def __init__(
+        self,
+        sweep_session_id: str,
+        on_change: Optional[Callable[["IngestJob"], None]] = None,
+    ) -> None:
+        self.id: str = uuid.uuid4().hex
+        self.sweep_session_id = sweep_session_id
+        self.host: str = socket.gethostname()
+        self.pid: int = os.getpid()
+        self.status: str = "queued"
+        self.total: int = 0
+        self.processed: int = 0
+        self.error: Optional[str] = None
+        self.created_time: float = time.time()
+        self.started_time: Optional[float] = None
+        self.finished_time: Optional[float] = None
+        self._on_change = on_change
+        self._saved_time = 0.0
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("finished", "failed")
+
+    @property
+    def throughput(self) -> float:
+        """Processed images per second."""
+        if self.started_time is None:
+            return 0.0
+        elapsed = (self.finished_time or time.time()) - self.started_time
+        return self.processed / elapsed if elapsed > 0 else 0.0
+
+    def start(self, total: int) -> None:
+        self.total = total
+        self.status = "running"
+        self.started_time = time.time()
+        self._changed()
+
+    def advance(self, count: int = 1) -> None:
+        self.processed += count
+        if time.time() - self._saved_time >= SAVE_INTERVAL:
+            self._changed()
+
+    def finish(self) -> None:
+        self.status = "finished"
+        self.finished_time = time.time()
+        self._changed()
+
+    def fail(self, error: str) -> None:
+        self.status = "failed"
+        self.error = error
+        self.finished_time = time.time()
+        self._changed()
+
+    def _changed(self) -> None:
+        self._saved_time = time.time()
+        if self._on_change is not None:
+            self._on_change(self)
+
+    def state(self) -> dict:
+        """Everything needed to restore the job in another process."""
+        return {
+            key: getattr(self, key)
+            for key in (
+                "id",
+                "sweep_session_id",
+                "host",
+                "pid",
+                "status",
+                "total",
+                "processed",
+                "error",
+                "created_time",
+                "started_time",
+                "finished_time",
+            )
+        }
+
+    @classmethod
+    def from_state(cls, state: dict) -> "IngestJob":
+        job = cls(state["sweep_session_id"])
+        for key, value in state.items():
+            setattr(job, key, value)
+        return job
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "sweep_session_id": self.sweep_session_id,
+            "status": self.status,
+            "processed": self.processed,
+            "total": self.total,
+            "throughput": round(self.throughput, 2),
+            "error": self.error,
+        }
+
+
+class JobQueue:
+    """Runs ingestion jobs on a local thread pool and keeps track of their progress.
+
+    With a `state_dir` every job is also written there as `<job id>.json`, so
+    the other worker processes of the app (and the janitor) see its progress.
+    State files not updated for `retention` seconds are removed.
+    """
+
+    def __init__(
+        self,
+        max_workers: int,
+        state_dir: Optional[str] = None,
+        max_finished_jobs: int = 1000,
+        retention: float = 24 * 3600,
+    ) -> None:
+        self.state_dir = state_dir
+        self.max_finished_jobs = max_finished_jobs
+        self.retention = retention
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="ingest"
+        )
+        self._jobs: Dict[str, IngestJob] = {}
+        self._lock = threading.Lock()
+
+    def submit(
+        self, sweep_session_id: str, fn: Callable[..., None], *args
+    ) -> IngestJob:
+        """Queue `fn(job, *args)`, which is expected to report progress on the job."""
+        job = IngestJob(sweep_session_id, on_change=self._save)
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        self._save(job)
+        self._executor.submit(self._run, job, fn, *args)
+        return job
+
+    def get(self, job_id: str) -> Optional[IngestJob]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None and self.state_dir and JOB_ID.fullmatch(job_id):
+            job = self._load(os.path.join(self.state_dir, f"{job_id}.json"))
+        return job
+
+    def active_jobs(self) -> Dict[str, IngestJob]:
+        """Unfinished jobs by sweep session id, including those of other processes."""
+        jobs = []
+        if self.state_dir:
+            for path in glob.glob(os.path.join(self.state_dir, "*.json")):
+                job = self._load(path)
+                if job is not None:
+                    jobs.append(job)
+        with self._lock:
+            jobs.extend(self._jobs.values())
+        return {job.sweep_session_id: job for job in jobs if not job.done}
+
+    def _run(self, job: IngestJob, fn: Callable[..., None], *args) -> None:
+        try:
+            fn(job, *args)
+        except Exception as e:
+            logging.exception(f"Ingestion of {job.sweep_session_id} failed")
+            job.fail(str(e))
+        else:
+            job.finish()
+
+    def _save(self, job: IngestJob) -> None:
+        if not self.state_dir:
+            return
+        path = os.path.join(self.state_dir, f"{job.id}.json")
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            os.makedirs(self.state_dir, exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump(job.state(), f)
+            os.replace(tmp_path, path)
+        except OSError:
+            logging.exception(f"Could not save the state of job {job.id}")
+
+    @staticmethod
+    def _load(path: str) -> Optional[IngestJob]:
+        try:
+            with open(path) as f:
+                job = IngestJob.from_state(json.load(f))
+        except (OSError, ValueError, KeyError):
+            return None
+        if not job.done and job.host == socket.gethostname() and not _is_alive(job.pid):
+            job.fail("The worker running the ingestion exited")
+        return job
+
+    def _prune(self) -> None:
+        finished = [job for job in self._jobs.values() if job.done]
+        if len(finished) > self.max_finished_jobs:
+            finished.sort(key=lambda job: job.finished_time)
+            for job in finished[: len(finished) - self.max_finished_jobs]:
+                del self._jobs[job.id]
+        if not self.state_dir:
+            return
+        for path in glob.glob(os.path.join(self.state_dir, "*")):
+            try:
+                if os.path.getmtime(path) < time.time() - self.retention:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
@@ -0,0 +1,123 @@
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List, Optional
+
+
+class LookaheadQueue:
+    """Candidate next images for the images currently on screen, filled in the background.
+
+    For every displayed image (by display path) we keep its nearest unreviewed
+    neighbors, so a decision on it - keep or discard, both continue from the
+    decided image - can be answered without waiting for a neighbor query.
+    """
+
+    def __init__(
+        self,
+        depth: int,
+        max_workers: int = 2,
+        max_sessions: int = 1000,
+        max_images_per_session: int = 8,
+    ) -> None:
+        self.depth = depth
+        self.max_sessions = max_sessions
+        self.max_images_per_session = max_images_per_session
+        # session -> displayed image path -> candidate paths, nearest first
+        self._candidates: "OrderedDict[str, OrderedDict[str, List[str]]]" = OrderedDict()
+        self._pending: set = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="lookahead"
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.depth > 0
+
+    def schedule(
+        self,
+        sweep_session_id: str,
+        image_paths: Iterable[str],
+        fill: Callable[[str, str, int], List[str]],
+    ) -> None:
+        """Compute candidates for the given images in the background via `fill(session, path, depth)`."""
+        if not self.enabled:
+            return
+        with self._lock:
+            known = self._candidates.get(sweep_session_id, {})
+            missing = [
+                image_path
+                for image_path in image_paths
+                if image_path not in known
+                and (sweep_session_id, image_path) not in self._pending
+            ]
+            self._pending.update((sweep_session_id, path) for path in missing)
+        for image_path in missing:
+            self._executor.submit(self._fill, sweep_session_id, image_path, fill)
+
+    def _fill(
+        self,
+        sweep_session_id: str,
+        image_path: str,
+        fill: Callable[[str, str, int], List[str]],
+    ) -> None:
+        try:
+            candidates = fill(sweep_session_id, image_path, self.depth)
+        except Exception:
+            logging.exception(f"Lookahead for {image_path} failed")
+            candidates = None
+        with self._lock:
+            if (sweep_session_id, image_path) not in self._pending:
+                # Invalidated while we were computing
+                return
+            self._pending.discard((sweep_session_id, image_path))
+            if candidates is None:
+                return
+            session_candidates = self._candidates.setdefault(
+                sweep_session_id, OrderedDict()
+            )
+            self._candidates.move_to_end(sweep_session_id)
+            session_candidates[image_path] = candidates
+            while len(session_candidates) > self.max_images_per_session:
+                session_candidates.popitem(last=False)
+            while len(self._candidates) > self.max_sessions:
+                self._candidates.popitem(last=False)
+
+    def pop(self, sweep_session_id: str, image_path: str) -> Optional[str]:
+        """Take the best candidate to follow a decision on `image_path`, None if there is none yet."""
+        with self._lock:
+            candidates = self._candidates.get(sweep_session_id, {}).pop(
+                image_path, None
+            )
+        return candidates[0] if candidates else None
+
+    def peek(self, sweep_session_id: str, image_paths: Iterable[str]) -> List[str]:
+        """Best known candidate for each of the given images, for preload hints."""
+        with self._lock:
+            session_candidates = self._candidates.get(sweep_session_id, {})
+            return [
+                session_candidates[image_path][0]
+                for image_path in image_paths
+                if session_candidates.get(image_path)
+            ]
+
+    def discard(self, sweep_session_id: str, image_path: str) -> None:
+        """Drop an image that was just reviewed from the candidate lists of its session.
+
+        Its own candidates are kept, since they answer the decision that reviewed it.
+        """
+        with self._lock:
+            session_candidates = self._candidates.get(sweep_session_id)
+            if not session_candidates:
+                return
+            for candidates in session_candidates.values():
+                if image_path in candidates:
+                    candidates.remove(image_path)
+
+    def invalidate(self, sweep_session_id: str) -> None:
+        with self._lock:
+            self._candidates.pop(sweep_session_id, None)
+            self._pending = {
+                pending for pending in self._pending if pending[0] != sweep_session_id
+            }
@@ -0,0 +1,137 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+# Status bits, an image is unreviewed as long as no bit is set
+REVIEWED_KEEP = 1
+REVIEWED_DISCARD = 2
+STATUS_BITS = {
+    "unreviewed": 0,
+    "reviewed_keep": REVIEWED_KEEP,
+    "reviewed_discard": REVIEWED_DISCARD,
+}
+
+
+class SessionMatrix:
+    """Embeddings of one sweep session as a contiguous float32 matrix with an id array and status bitmask."""
+
+    def __init__(
+        self, ids: np.ndarray, matrix: np.ndarray, status: np.ndarray
+    ) -> None:
+        self.ids = np.ascontiguousarray(ids, dtype=np.int64)
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        self.status = np.ascontiguousarray(status, dtype=np.uint8)
+        self.squared_norms = np.einsum("ij,ij->i", self.matrix, self.matrix)
+        self.rows = {int(image_id): row for row, image_id in enumerate(self.ids)}
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Tuple[int, np.ndarray, str]]) -> "SessionMatrix":
+        """Build the matrix from (id, embedding, status) rows."""
+        rows = list(rows)
+        dim = len(rows[0][1]) if rows else 0
+        ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        matrix = np.empty((len(rows), dim), dtype=np.float32)
+        for i, row in enumerate(rows):
+            matrix[i] = row[1]
+        status = np.fromiter(
+            (STATUS_BITS[row[2]] for row in rows), dtype=np.uint8, count=len(rows)
+        )
+        return cls(ids, matrix, status)
+
+    @property
+    def nbytes(self) -> int:
+        return (
+            self.ids.nbytes
+            + self.matrix.nbytes
+            + self.status.nbytes
+            + self.squared_norms.nbytes
+        )
+
+    def set_status(self, image_id: int, status: str) -> bool:
+        row = self.rows.get(image_id)
+        if row is None:
+            return False
+        self.status[row] = STATUS_BITS[status]
+        return True
+
+    def nearest_unreviewed(
+        self, query_image_id: int, k: int = 1, exclude_ids: Iterable[int] = ()
+    ) -> List[int]:
+        """Ids of the k unreviewed images closest (l2) to the query image, nearest first."""
+        query_row = self.rows[query_image_id]
+        query = self.matrix[query_row]
+        # ||x - q||^2 up to the constant ||q||^2, computed for all rows in one matvec
+        distances = self.squared_norms - 2.0 * (self.matrix @ query)
+        distances[self.status != 0] = np.inf
+        distances[query_row] = np.inf
+        for image_id in exclude_ids:
+            row = self.rows.get(image_id)
+            if row is not None:
+                distances[row] = np.inf
+
+        k = min(k, len(distances))
+        if k == 0:
+            return []
+        candidates = np.argpartition(distances, k - 1)[:k]
+        candidates = candidates[np.argsort(distances[candidates])]
+        return [int(self.ids[row]) for row in candidates if np.isfinite(distances[row])]
+
+
+class SessionMatrixCache:
+    """In-process LRU cache of session matrices, bounded by memory."""
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self._matrices: "OrderedDict[str, SessionMatrix]" = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    def get(
+        self, sweep_session_id: str, loader: Callable[[], SessionMatrix]
+    ) -> SessionMatrix:
+        """Get the matrix of a session, calling `loader` on a miss."""
+        with self._lock:
+            session_matrix = self._matrices.get(sweep_session_id)
+            if session_matrix is not None:
+                self._matrices.move_to_end(sweep_session_id)
+                return session_matrix
+
+        # Load outside the lock, so other sessions are not blocked by the query
+        session_matrix = loader()
+        if session_matrix.nbytes > self.max_bytes:
+            return session_matrix
+
+        with self._lock:
+            previous = self._matrices.pop(sweep_session_id, None)
+            if previous is not None:
+                self._nbytes -= previous.nbytes
+            self._matrices[sweep_session_id] = session_matrix
+            self._nbytes += session_matrix.nbytes
+            while self._nbytes > self.max_bytes:
+                _, evicted = self._matrices.popitem(last=False)
+                self._nbytes -= evicted.nbytes
+        return session_matrix
+
+    def peek(self, sweep_session_id: str) -> Optional[SessionMatrix]:
+        with self._lock:
+            return self._matrices.get(sweep_session_id)
+
+    def set_status(self, sweep_session_id: str, image_id: int, status: str) -> None:
+        """Update the status bit of a cached image in place."""
+        with self._lock:
+            session_matrix = self._matrices.get(sweep_session_id)
+            if session_matrix is not None and not session_matrix.set_status(
+                image_id, status
+            ):
+                self._drop(sweep_session_id)
+
+    def invalidate(self, sweep_session_id: str) -> None:
+        with self._lock:
+            self._drop(sweep_session_id)
+
+    def _drop(self, sweep_session_id: str) -> None:
+        session_matrix = self._matrices.pop(sweep_session_id, None)
+        if session_matrix is not None:
+            self._nbytes -= session_matrix.nbytes
@@ -0,0 +1,223 @@
+"""Request, SQL and ingest metrics in the Prometheus text format.
+
+Metrics live in the process, so with several workers every worker reports its
+own values (scrape them one by one or label them by instance).
+"""
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from flask import Flask, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Seconds, from a cached query to a large ingest batch
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 200, 500, 1000)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)) + "}"
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: List["Metric"] = []
+
+    def register(self, metric: "Metric") -> None:
+        self.metrics.append(metric)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class Metric:
+    kind = ""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        registry: Optional[Registry] = registry,
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [
+            f"{self.name}_total{_format_labels(self.labelnames, labels)} {value}"
+            for labels, value in values
+        ]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, *args, buckets: Sequence[float] = DEFAULT_BUCKETS, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        # Per label values: count of each bucket (not cumulative, the last is +Inf) and the sum
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(
+                labels, ([0] * (len(self.buckets) + 1), [0.0])
+            )
+            counts[index] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(
+                (labels, list(counts), total[0])
+                for labels, (counts, total) in self._values.items()
+            )
+        lines = []
+        names = self.labelnames + ("le",)
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(names, labels + (le,))} {cumulative}"
+                )
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {total}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+REQUEST_SECONDS = Histogram(
+    "sweeper_request_duration_seconds",
+    "Time to produce a response (streamed bodies excluded).",
+    ("endpoint", "method", "status"),
+)
+REQUEST_SQL_STATEMENTS = Histogram(
+    "sweeper_request_sql_statements",
+    "SQL statements executed per request.",
+    ("endpoint",),
+    buckets=COUNT_BUCKETS,
+)
+REQUEST_SQL_SECONDS = Histogram(
+    "sweeper_request_sql_seconds",
+    "Time spent in SQL statements per request.",
+    ("endpoint",),
+)
+SQL_STATEMENTS = Counter("sweeper_sql_statements", "SQL statements executed.")
+SQL_SECONDS = Counter("sweeper_sql_seconds", "Time spent in SQL statements.")
+INGEST_STAGE_SECONDS = Histogram(
+    "sweeper_ingest_stage_seconds",
+    "Time per unit of ingest work: a converted file, an embedded or inserted batch, a tour or graph.",
+    ("stage",),
+)
+
+
+class RequestStats:
+    __slots__ = ("start", "sql_statements", "sql_seconds")
+
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("metrics_query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info["metrics_query_start"].pop()
+    SQL_STATEMENTS.inc()
+    SQL_SECONDS.inc(amount=seconds)
+    if has_request_context():
+        stats = g.get("metrics")
+        if stats is not None:
+            stats.sql_statements += 1
+            stats.sql_seconds += seconds
+
+
+def _handle_error(exception_context) -> None:
+    connection = exception_context.connection
+    if connection is not None and connection.info.get("metrics_query_start"):
+        connection.info["metrics_query_start"].pop()
+
+
+def _start_request() -> None:
+    g.metrics = RequestStats()
+
+
+def _finish_request(response):
+    stats = g.pop("metrics", None)
+    if stats is not None:
+        # Unmatched URLs share one label, so scanners can't blow up the label set
+        endpoint = request.endpoint or "unmatched"
+        REQUEST_SECONDS.observe(
+            time.perf_counter() - stats.start,
+            endpoint,
+            request.method,
+            str(response.status_code),
+        )
+        REQUEST_SQL_STATEMENTS.observe(stats.sql_statements, endpoint)
+        REQUEST_SQL_SECONDS.observe(stats.sql_seconds, endpoint)
+    return response
+
+
+def init_app(app: Flask) -> None:
+    """Time every request of `app` and count the SQL statements of all engines."""
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(Engine, "handle_error", _handle_error)
+    # First in, so the time of the other before_request hooks is included
+    app.before_request_funcs.setdefault(None, []).insert(0, _start_request)
+    app.after_request(_finish_request)
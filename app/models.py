@@ -0,0 +1,124 @@
+import datetime
+
+import numpy as np
+from flask_sqlalchemy import SQLAlchemy
+from pgvector.sqlalchemy import Vector
+from sqlalchemy import Index, Enum, text
+
+# Create the SQLAlchemy instance
+db = SQLAlchemy()  # maybe make this upper case (?)
+
+
+class User(db.Model):
+    __tablename__: str = "users"
+    id: int = db.Column(db.Integer, primary_key=True)
+    email: str = db.Column(db.String(255), nullable=False, unique=True)
+    nickname: str = db.Column(db.String(255))
+    subscribed: bool = db.Column(db.Boolean, default=False)
+
+    def __repr__(self) -> str:
+        return f"User('{self.nickname}', '{self.email}')"
+
+
+class SweepSession(db.Model):
+    # TODO maybe make sweep_session_token primary key?
+    # TODO or maybe rename id to something else to avoid confusion?
+    __tablename__ = "sweep_sessions"
+    # Keep in sync with the alembic migrations creating the same indices
+    __table_args__ = (Index("ix_sweep_sessions_user_id", "user_id", "id"),)
+    id: int = db.Column(db.Integer, primary_key=True)
+    user_id: int = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    sweep_session_token: str = db.Column(db.String(36), unique=True, nullable=False)
+    creation_time: datetime.datetime = db.Column(
+        db.DateTime, nullable=False, default=datetime.datetime.now
+    )
+    last_access_time: datetime.datetime = db.Column(
+        db.DateTime, nullable=False, default=datetime.datetime.now
+    )
+
+    def __repr__(self) -> str:
+        return f"SweepSession('{self.sweep_session_token}', '{self.id}')"
+
+
+class Embedding(db.Model):
+    __tablename__ = "embeddings"
+    # Keep in sync with the alembic migrations creating the same indices
+    __table_args__ = (
+        Index("ix_embeddings_session_status", "sweep_session_token", "status"),
+        Index(
+            "ix_embeddings_session_display_path", "sweep_session_token", "display_path"
+        ),
+        Index(
+            "ix_embeddings_session_unreviewed",
+            "sweep_session_token",
+            "id",
+            postgresql_where=text("status = 'unreviewed'"),
+        ),
+        Index(
+            "ix_embeddings_session_tour",
+            "sweep_session_token",
+            "tour_position",
+            postgresql_where=text("status = 'unreviewed'"),
+        ),
+        Index(
+            "ix_embeddings_embedding_hnsw",
+            "embedding",
+            postgresql_using="hnsw",
+            postgresql_with={"m": 16, "ef_construction": 64},
+            postgresql_ops={"embedding": "vector_l2_ops"},
+        ),
+    )
+    id: int = db.Column(db.Integer, primary_key=True)
+    display_path: str = db.Column(db.String(255), nullable=False)
+    download_path: str = db.Column(db.String(255), nullable=False)
+    sweep_session_token: str = db.Column(
+        db.String(36),
+        db.ForeignKey("sweep_sessions.sweep_session_token"),
+        nullable=False,
+    )
+    embedding: np.ndarray = db.Column(Vector(384), nullable=False)
+    status: str = db.Column(
+        Enum("reviewed_keep", "reviewed_discard", "unreviewed", name="status"),
+        nullable=False,
+        default="unreviewed",
+    )
+    # Position on the session's precomputed similarity tour, None until it is computed
+    tour_position: int = db.Column(db.Integer, nullable=True)
+    # sha256 of the uploaded file, shared with the ContentEmbedding it was taken from
+    content_hash: str = db.Column(db.String(64), nullable=True)
+
+    def __repr__(self) -> str:
+        return f"Embedding('{self.display_path}', '{self.download_path}', '{self.sweep_session_token}', '{self.status}')"
+
+
+class EmbeddingNeighbor(db.Model):
+    """Edge of a session's precomputed k-nearest-neighbor graph, rank 0 is the nearest neighbor."""
+
+    __tablename__ = "embedding_neighbors"
+    # Keep in sync with the alembic migration creating the same table
+    __table_args__ = (Index("ix_embedding_neighbors_neighbor_id", "neighbor_id"),)
+    embedding_id: int = db.Column(
+        db.Integer,
+        db.ForeignKey("embeddings.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    rank: int = db.Column(db.SmallInteger, primary_key=True)
+    neighbor_id: int = db.Column(
+        db.Integer, db.ForeignKey("embeddings.id", ondelete="CASCADE"), nullable=False
+    )
+
+    def __repr__(self) -> str:
+        return f"EmbeddingNeighbor({self.embedding_id}, {self.rank}, {self.neighbor_id})"
+
+
+class ContentEmbedding(db.Model):
+    """Embedding of a file's content, shared by every session that contains the file."""
+
+    __tablename__ = "content_embeddings"
+    content_hash: str = db.Column(db.String(64), primary_key=True)
+    embedding: np.ndarray = db.Column(Vector(384), nullable=False)
+    # Number of session images using this content, entries at 0 are kept as a cache
+    ref_count: int = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self) -> str:
+        return f"ContentEmbedding('{self.content_hash}', {self.ref_count})"
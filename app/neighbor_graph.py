@@ -0,0 +1,45 @@
+from typing import Optional, Tuple
+
+import numpy as np
+
+# Distances computed per block are capped at this many floats (64 MB)
+MAX_BLOCK_ELEMENTS = 16 * 1024 ** 2
+
+
+def knn_graph(
+    matrix: np.ndarray, k: int, block_size: Optional[int] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Top-k (l2) neighbors of every row of `matrix`, excluding the row itself.
+
+    Distances are computed for a block of query rows at a time with one matrix
+    multiplication against all rows. Returns (neighbors, distances), both of
+    shape (n, min(k, n - 1)) and sorted nearest first.
+    """
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    n = len(matrix)
+    k = min(k, n - 1)
+    neighbors = np.empty((n, max(k, 0)), dtype=np.int64)
+    distances = np.empty((n, max(k, 0)), dtype=np.float32)
+    if k <= 0:
+        return neighbors, distances
+    block_size = block_size or max(1, MAX_BLOCK_ELEMENTS // n)
+    squared_norms = np.einsum("ij,ij->i", matrix, matrix)
+
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        # ||x - q||^2 = ||x||^2 + ||q||^2 - 2 x.q for the whole block at once
+        block = (
+            squared_norms[start:stop, None]
+            + squared_norms[None, :]
+            - 2.0 * (matrix[start:stop] @ matrix.T)
+        )
+        rows = np.arange(stop - start)
+        block[rows, rows + start] = np.inf
+        candidates = np.argpartition(block, k - 1, axis=1)[:, :k]
+        candidate_distances = np.take_along_axis(block, candidates, axis=1)
+        order = np.argsort(candidate_distances, axis=1)
+        neighbors[start:stop] = np.take_along_axis(candidates, order, axis=1)
+        distances[start:stop] = np.maximum(
+            np.take_along_axis(candidate_distances, order, axis=1), 0.0
+        )
+    return neighbors, distances
@@ -0,0 +1,153 @@
+"""On-demand profiling of a live worker.
+
+Either the next requests to an endpoint run under cProfile (one `.prof` file
+per request, open with `snakeviz` or `pstats`), or a background thread samples
+the stacks of all threads for some seconds and writes them as collapsed stacks
+(`.collapsed`, one `frame;frame;frame count` line per stack, for flamegraph.pl
+or speedscope). Captures go into a directory that is pruned to a number of
+files and bytes, oldest first. Only the worker process that was asked does the
+profiling; while nothing is armed the only cost per request is an empty dict check.
+"""
+import os
+import sys
+import time
+import uuid
+import cProfile
+import logging
+import threading
+from collections import Counter
+from typing import Dict, List, Optional
+
+from flask import Flask, g, request
+
+SUFFIXES = (".prof", ".collapsed")
+
+
+def collapse_frame(frame) -> str:
+    """One line of collapsed stacks for a thread's frame, outermost call first."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        filename = os.path.basename(code.co_filename)
+        names.append(f"{code.co_name} ({filename}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class Profiler:
+    def __init__(
+        self, capture_dir: str, max_captures: int = 50, max_bytes: int = 100 * 1024 ** 2
+    ) -> None:
+        self.capture_dir = capture_dir
+        self.max_captures = max_captures
+        self.max_bytes = max_bytes
+        # Endpoint -> number of requests still to profile
+        self._armed: Dict[str, int] = {}
+        self._sampler: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def arm(self, endpoint: str, count: int) -> None:
+        """Profile the next `count` requests to `endpoint`."""
+        with self._lock:
+            self._armed[endpoint] = count
+
+    def armed(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._armed)
+
+    def sample(self, seconds: float, interval: float = 0.005) -> bool:
+        """Sample all threads for `seconds` in the background, False if a sampling already runs."""
+        with self._lock:
+            if self._sampler is not None and self._sampler.is_alive():
+                return False
+            self._sampler = threading.Thread(
+                target=self._sample, args=(seconds, interval), daemon=True
+            )
+            self._sampler.start()
+        return True
+
+    def sampling(self) -> bool:
+        return self._sampler is not None and self._sampler.is_alive()
+
+    def _sample(self, seconds: float, interval: float) -> None:
+        stacks: Counter = Counter()
+        own_id = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id:
+                    stacks[collapse_frame(frame)] += 1
+            time.sleep(interval)
+        lines = [f"{stack} {count}" for stack, count in stacks.most_common()]
+        self._write(f"sample-{seconds:g}s.collapsed", "\n".join(lines).encode() + b"\n")
+
+    def start_request(self) -> None:
+        if not self._armed:
+            return
+        with self._lock:
+            remaining = self._armed.get(request.endpoint)
+            if not remaining:
+                return
+            if remaining == 1:
+                del self._armed[request.endpoint]
+            else:
+                self._armed[request.endpoint] = remaining - 1
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python >= 3.12 allows a single cProfile at a time per process
+            logging.info(f"Not profiling {request.endpoint}, another profile is running")
+            return
+        g.profile = profile
+
+    def finish_request(self, exception: Optional[BaseException] = None) -> None:
+        profile = g.pop("profile", None)
+        if profile is not None:
+            profile.disable()
+            path = self._path(f"{request.endpoint}.prof")
+            profile.dump_stats(path)
+            self._prune()
+
+    def _path(self, name: str) -> str:
+        os.makedirs(self.capture_dir, exist_ok=True)
+        timestamp = time.strftime("%Y%m%d-%H%M%S")
+        return os.path.join(
+            self.capture_dir, f"{timestamp}-{os.getpid()}-{uuid.uuid4().hex[:8]}-{name}"
+        )
+
+    def _write(self, name: str, data: bytes) -> None:
+        with open(self._path(name), "wb") as f:
+            f.write(data)
+        self._prune()
+
+    def captures(self) -> List[dict]:
+        """Captures, newest first."""
+        try:
+            names = [n for n in os.listdir(self.capture_dir) if n.endswith(SUFFIXES)]
+        except FileNotFoundError:
+            return []
+        captures = []
+        for name in names:
+            try:
+                stat = os.stat(os.path.join(self.capture_dir, name))
+            except FileNotFoundError:
+                continue
+            captures.append({"name": name, "bytes": stat.st_size, "mtime": stat.st_mtime})
+        return sorted(captures, key=lambda capture: capture["mtime"], reverse=True)
+
+    def _prune(self) -> None:
+        captures = self.captures()
+        total = sum(capture["bytes"] for capture in captures)
+        while captures and (len(captures) > self.max_captures or total > self.max_bytes):
+            oldest = captures.pop()
+            total -= oldest["bytes"]
+            try:
+                os.remove(os.path.join(self.capture_dir, oldest["name"]))
+            except FileNotFoundError:
+                pass
+
+    def init_app(self, app: Flask) -> None:
+        app.before_request(self.start_request)
+        # A teardown runs even when the request raised, so cProfile is always disabled
+        app.teardown_request(self.finish_request)
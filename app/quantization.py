@@ -0,0 +1,50 @@
+import numpy as np
+from pgvector.sqlalchemy import Vector
+from sqlalchemy import Float, cast, func, literal
+from sqlalchemy.dialects.postgresql import BIT
+from sqlalchemy.sql.elements import ColumnElement
+from sqlalchemy.types import UserDefinedType
+
+DIM = 384
+MODES = ("none", "half", "binary")
+
+
+class HalfVector(UserDefinedType):
+    """pgvector's halfvec, only used in casts (the column itself stays a full vector)."""
+
+    cache_ok = True
+
+    def __init__(self, dim: int) -> None:
+        self.dim = dim
+
+    def get_col_spec(self, **kw) -> str:
+        return f"halfvec({self.dim})"
+
+
+def quantize(embedding, mode: str):
+    """The quantized form of a vector column or query vector (numpy or SQL expression)."""
+    if isinstance(embedding, np.ndarray):
+        # Typed explicitly, functions like binary_quantize are overloaded
+        embedding = cast(literal(embedding, Vector(DIM)), Vector(DIM))
+    if mode == "half":
+        return cast(embedding, HalfVector(DIM))
+    if mode == "binary":
+        return cast(func.binary_quantize(embedding), BIT(DIM))
+    raise ValueError(f"Unknown quantization mode {mode}")
+
+
+def quantized_distance(column, query, mode: str) -> ColumnElement:
+    """Distance for the candidate search: l2 between half vectors, hamming between sign bits."""
+    operator = "<~>" if mode == "binary" else "<->"
+    return quantize(column, mode).op(operator, return_type=Float())(
+        quantize(query, mode)
+    )
+
+
+def simulate(matrix: np.ndarray, mode: str) -> np.ndarray:
+    """What the database compares for a mode, for offline recall measurements."""
+    if mode == "half":
+        return matrix.astype(np.float16).astype(np.float32)
+    if mode == "binary":
+        return (matrix > 0).astype(np.float32)
+    return matrix
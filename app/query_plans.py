@@ -0,0 +1,160 @@
+"""Check that the hot queries of the app are answered from indices.
+
+Runs the read paths of the swipe flow and the overview against the configured
+database, records the SQL they send and EXPLAINs every statement with
+sequential scans disabled, so a `Seq Scan` in a plan means no usable index
+exists. The planner may then read a whole index instead, so an index scan
+without an `Index Cond` (and no vector `Order By`) counts as a scan too.
+Exits non-zero if any plan still scans a table. Run from `app/`, or through
+pytest (tests/test_query_plans.py):
+
+    python query_plans.py [--sweep-session-id TOKEN] [--email EMAIL]
+"""
+import sys
+import argparse
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import event
+
+from app import (
+    app,
+    db,
+    Embedding,
+    SweepSession,
+    User,
+    get_user,
+    get_sessions_for_user,
+    get_session_overviews,
+    get_image_by_path,
+    get_starting_image,
+    get_nearest_neighbor,
+    get_graph_neighbors,
+    get_tour_successors,
+    get_percentage_reviewed,
+    get_images_to_keep,
+)
+
+
+@contextmanager
+def recorded_statements(statements: List[tuple]):
+    """Record (statement, parameters) of every query sent while the block runs."""
+
+    def before_cursor_execute(
+        conn, cursor, statement, parameters, context, executemany
+    ):
+        statements.append((statement, parameters))
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+
+
+def full_scans(plan: dict) -> List[str]:
+    """The nodes of a (json) plan that read a whole table or index, as text."""
+    scans = []
+    node_type = plan.get("Node Type")
+    if node_type == "Seq Scan":
+        scans.append(f"Seq Scan on {plan.get('Relation Name')}")
+    elif (
+        node_type in ("Index Scan", "Index Only Scan")
+        and "Index Cond" not in plan
+        # Nearest neighbor scans of the vector indices stop at the LIMIT
+        and "Order By" not in plan
+    ):
+        scans.append(
+            f"{node_type} using {plan.get('Index Name')} on "
+            f"{plan.get('Relation Name')} without Index Cond"
+        )
+    for child in plan.get("Plans", []):
+        scans.extend(full_scans(child))
+    return scans
+
+
+def explain(statement: str, parameters) -> dict:
+    connection = db.session.connection().connection
+    with connection.cursor() as cursor:
+        cursor.execute("SET LOCAL enable_seqscan = off")
+        cursor.execute(f"EXPLAIN (FORMAT JSON) {statement}", parameters)
+        return cursor.fetchone()[0][0]["Plan"]
+
+
+def hot_queries(sweep_session_id: str, email: str) -> Dict[str, Callable[[], object]]:
+    image = Embedding.query.filter_by(sweep_session_token=sweep_session_id).first()
+    display_path = image.display_path if image else ""
+    return {
+        "get_user": lambda: get_user(email),
+        "get_sessions_for_user": lambda: get_sessions_for_user(email, limit=20),
+        "get_session_overviews": lambda: get_session_overviews(email, limit=20),
+        "get_image_by_path": lambda: get_image_by_path(sweep_session_id, display_path),
+        "get_starting_image": lambda: get_starting_image(sweep_session_id),
+        "get_nearest_neighbor": lambda: image
+        and get_nearest_neighbor(sweep_session_id, image.id),
+        "get_graph_neighbors": lambda: image and get_graph_neighbors(image.id),
+        "get_tour_successors": lambda: get_tour_successors(
+            sweep_session_id, [display_path]
+        ),
+        "get_percentage_reviewed": lambda: get_percentage_reviewed(sweep_session_id),
+        "get_images_to_keep": lambda: get_images_to_keep(sweep_session_id),
+    }
+
+
+def check_query_plans(sweep_session_id: str, email: str) -> Dict[str, List[str]]:
+    """Map each hot query to the full scans in its plans."""
+    failures = {}
+    for name, run in hot_queries(sweep_session_id, email).items():
+        statements: List[tuple] = []
+        with recorded_statements(statements):
+            try:
+                run()
+            except IndexError:
+                # No neighbor left in the session, the query was sent all the same
+                pass
+        for statement, parameters in statements:
+            if not statement.lstrip().upper().startswith(("SELECT", "WITH")):
+                continue
+            scans = full_scans(explain(statement, parameters))
+            if scans:
+                failures.setdefault(name, []).extend(scans)
+        db.session.rollback()
+    return failures
+
+
+def check_target(
+    sweep_session_id: Optional[str] = None, email: Optional[str] = None
+) -> Tuple[str, str]:
+    """The session and user to plan the queries for, by default any existing session."""
+    query = SweepSession.query
+    if sweep_session_id:
+        query = query.filter_by(sweep_session_token=sweep_session_id)
+    sweep_session = query.first()
+    # An empty database still gets planned, just with nothing to find
+    sweep_session_id = sweep_session_id or getattr(
+        sweep_session, "sweep_session_token", ""
+    )
+    if email is None:
+        user = sweep_session and db.session.get(User, sweep_session.user_id)
+        email = user.email if user else ""
+    return sweep_session_id, email
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sweep-session-id", help="defaults to any existing session")
+    parser.add_argument("--email", help="defaults to the owner of the session")
+    args = parser.parse_args()
+
+    with app.app_context():
+        failures = check_query_plans(*check_target(args.sweep_session_id, args.email))
+
+    for name, scans in failures.items():
+        print(f"{name}: {'; '.join(sorted(set(scans)))}")
+    if not failures:
+        print("All hot queries use indices.")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
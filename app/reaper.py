@@ -0,0 +1,49 @@
+import os
+import shutil
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TrashReaper:
+    """Deletes what was moved into a trash directory on a background thread.
+
+    Moving a directory into the trash is a single rename, so requests never
+    wait for the unlinking of its files.
+    """
+
+    def __init__(self, trash_dir: str) -> None:
+        self.trash_dir = trash_dir
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="reaper")
+        self._scheduled = False
+        self._lock = threading.Lock()
+
+    def schedule(self) -> None:
+        """Empty the trash in the background, also removing leftovers of earlier runs."""
+        with self._lock:
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self._executor.submit(self._reap)
+
+    def _reap(self) -> None:
+        with self._lock:
+            # Anything trashed from here on needs another run
+            self._scheduled = False
+        try:
+            entries = os.listdir(self.trash_dir)
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            path = os.path.join(self.trash_dir, entry)
+            try:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+                logging.info(f"Reaped '{path}'.")
+            except OSError as e:
+                logging.error(f"Reaping '{path}' failed: {e}")
+
+    def shutdown(self) -> None:
+        self._executor.shutdown()
@@ -0,0 +1,72 @@
+import numpy as np
+
+
+def greedy_tour(matrix: np.ndarray, start: int = 0) -> np.ndarray:
+    """Order the rows of `matrix` so each row is followed by its nearest (l2) unvisited row.
+
+    Returns the row indices in tour order. Visited rows are swapped behind the
+    active block, so every step is a single matvec over the rows still left.
+    """
+    n = len(matrix)
+    order = np.empty(n, dtype=np.int64)
+    if n == 0:
+        return order
+    work = np.array(matrix, dtype=np.float32)
+    squared_norms = np.einsum("ij,ij->i", work, work)
+    rows = np.arange(n)
+
+    remaining = n
+    position = start
+    for step in range(n):
+        order[step] = rows[position]
+        query = work[position].copy()
+        remaining -= 1
+        # Swap the visited row out of the active block [0, remaining)
+        work[position] = work[remaining]
+        squared_norms[position] = squared_norms[remaining]
+        rows[position] = rows[remaining]
+        if remaining == 0:
+            break
+        distances = squared_norms[:remaining] - 2.0 * (work[:remaining] @ query)
+        position = int(np.argmin(distances))
+    return order
+
+
+def two_opt(
+    matrix: np.ndarray, order: np.ndarray, window: int = 50, passes: int = 1
+) -> np.ndarray:
+    """Shorten an open tour with 2-opt moves between edges at most `window` positions apart.
+
+    For each edge (i, i+1) the gains of reversing the segment up to every edge
+    (j, j+1) in the window are computed at once and the best move is applied.
+    """
+    order = np.array(order, dtype=np.int64)
+    points = np.asarray(matrix, dtype=np.float32)[order]
+    n = len(order)
+    for _ in range(passes):
+        improved = False
+        for i in range(n - 3):
+            last = min(i + window, n - 2)
+            a, b = points[i], points[i + 1]
+            c = points[i + 2 : last + 1]
+            d = points[i + 3 : last + 2]
+            gains = (
+                np.linalg.norm(a - b)
+                + np.linalg.norm(c - d, axis=1)
+                - np.linalg.norm(c - a, axis=1)
+                - np.linalg.norm(d - b, axis=1)
+            )
+            best = int(np.argmax(gains))
+            if gains[best] > 1e-6:
+                j = i + 2 + best
+                order[i + 1 : j + 1] = order[i + 1 : j + 1][::-1]
+                points[i + 1 : j + 1] = points[i + 1 : j + 1][::-1]
+                improved = True
+        if not improved:
+            break
+    return order
+
+
+def tour_length(matrix: np.ndarray, order: np.ndarray) -> float:
+    points = np.asarray(matrix)[order]
+    return float(np.linalg.norm(points[1:] - points[:-1], axis=1).sum())
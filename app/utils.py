@@ -1,11 +1,30 @@
+import io
 import os
+import re
+import glob
+import shutil
+import uuid
+import hashlib
 import logging
-from zipfile import ZipFile
-from typing import List, Tuple
+from functools import lru_cache
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile, ZipInfo
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Tuple
 import rawpy
 from PIL import Image
 
 
+# Session directories waiting to be deleted in the background
+TRASH_DIR = ".trash"
+
+
+# Session ids are uuid4().hex, anything else (".content", "..") is never a session directory
+SESSION_ID = re.compile(r"[0-9a-f]{32}")
+
+
+def is_session_id(sweep_session_id: str) -> bool:
+    return SESSION_ID.fullmatch(sweep_session_id) is not None
+
+
 class FileClient:
     """Class to handle file operations such as creating, removing and zipping directories."""
 
@@ -13,6 +32,8 @@ class FileClient:
         self.media_folder = media_folder
         self.sweep_session_id = sweep_session_id
         self.upload_dir = os.path.join(self.media_folder, self.sweep_session_id)
+        self.archive_dir = os.path.join(self.media_folder, ".archives")
+        self.trash_dir = os.path.join(self.media_folder, TRASH_DIR)
 
     def create_dir(self) -> None:
         """Create new dir in media_folder with name sweep_session_id."""
@@ -32,6 +53,7 @@ class FileClient:
             logging.info(f"Zipfile '{zip_to_remove}' successfully removed.")
         except FileNotFoundError as e:
             logging.info(f"No file {zip_to_remove} found: {e.strerror}")
+        self.remove_archives()
         try:
             # Iterate over all files and subdirectories in the directory
             for root, dirs, files in os.walk(dir_to_remove, topdown=False):
@@ -48,6 +70,93 @@ class FileClient:
         except OSError as e:
             logging.info(f"Error: {dir_to_remove} : {e.strerror}")
 
+    def upload_part_path(self, filename: str) -> str:
+        """Path an upload is written to until it is finalized, hidden from ingestion."""
+        return os.path.join(self.upload_dir, f".{filename}.part")
+
+    def upload_offset(self, filename: str) -> int:
+        """Number of bytes of an unfinished upload received so far."""
+        try:
+            return os.path.getsize(self.upload_part_path(filename))
+        except FileNotFoundError:
+            return 0
+
+    def write_upload_chunk(
+        self, filename: str, offset: int, stream: BinaryIO, buffer_size: int = 1024 ** 2
+    ) -> int:
+        """Write a chunk read from `stream` at `offset` of an upload, returns the new offset.
+
+        The chunk is copied from the stream to the part file buffer by buffer, so
+        it is never held in memory or spooled to a temporary file as a whole.
+        """
+        fd = os.open(self.upload_part_path(filename), os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            while True:
+                data = stream.read(buffer_size)
+                if not data:
+                    break
+                view = memoryview(data)
+                while view:
+                    written = os.pwrite(fd, view, offset)
+                    view = view[written:]
+                    offset += written
+        finally:
+            os.close(fd)
+        return offset
+
+    def finalize_upload(
+        self, filename: str, size: int, sha256: Optional[str] = None
+    ) -> bool:
+        """Move a complete upload into place if its size (and sha256, if given) match.
+
+        A part file that doesn't match is removed, so the upload restarts from zero.
+        """
+        part_path = self.upload_part_path(filename)
+        final_path = os.path.join(self.upload_dir, filename)
+        if not os.path.exists(part_path):
+            if size == 0:
+                open(final_path, "wb").close()
+            # Finalizing twice is fine, e.g. after the response got lost
+            return os.path.exists(final_path) and os.path.getsize(final_path) == size
+        received = os.path.getsize(part_path)
+        if received != size:
+            logging.error(f"Upload {part_path} has {received} of {size} bytes")
+            if received > size:
+                os.remove(part_path)
+            return False
+        if sha256 is not None:
+            digest = hashlib.sha256()
+            with open(part_path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 ** 2), b""):
+                    digest.update(chunk)
+            if digest.hexdigest() != sha256.lower():
+                logging.error(f"Upload {part_path} doesn't match its sha256, discarding it")
+                os.remove(part_path)
+                return False
+        os.replace(part_path, final_path)
+        return True
+
+    def trash_directory(self) -> Optional[str]:
+        """Atomically move the session dir into the trash, returns its new path.
+
+        The files themselves are left to be removed in the background, see
+        reaper.TrashReaper. None if the session has no directory.
+        """
+        os.makedirs(self.trash_dir, exist_ok=True)
+        trash_path = os.path.join(
+            self.trash_dir, f"{self.sweep_session_id}-{uuid.uuid4().hex}"
+        )
+        try:
+            os.rename(self.upload_dir, trash_path)
+        except FileNotFoundError:
+            return None
+        try:
+            os.remove(os.path.join(self.media_folder, f"{self.sweep_session_id}.zip"))
+        except FileNotFoundError:
+            pass
+        self.remove_archives()
+        return trash_path
+
     def zip_dir(self, subset: List[str]) -> str:
         zip_filename: str = f"{self.sweep_session_id}.zip"
         zip_filepath: str = os.path.join(self.media_folder, zip_filename)
@@ -57,24 +166,213 @@ class FileClient:
 
         return zip_filename
 
+    def archive_path(self, subset: List[str]) -> str:
+        """Path of the cached zip of `subset`, keyed by a hash of the files it contains."""
+        key = hashlib.sha256("\n".join(sorted(subset)).encode()).hexdigest()[:16]
+        return os.path.join(self.archive_dir, f"{self.sweep_session_id}-{key}.zip")
+
+    def stream_zip(self, subset: List[str]) -> Iterator[bytes]:
+        """Stream a zip of `subset` and cache it under `archive_path` once it is complete."""
+        archive_path = self.archive_path(subset)
+        os.makedirs(self.archive_dir, exist_ok=True)
+        part_path = f"{archive_path}.{uuid.uuid4().hex}.part"
+        try:
+            with open(part_path, "wb") as part:
+                for chunk in stream_zip(subset):
+                    part.write(chunk)
+                    yield chunk
+            # Only the archive of the latest keep-set is worth keeping around
+            self.remove_archives()
+            os.replace(part_path, archive_path)
+        finally:
+            # The client went away before the archive was complete
+            if os.path.exists(part_path):
+                os.remove(part_path)
+
+    def remove_archives(self) -> None:
+        for archive in glob.glob(
+            os.path.join(self.archive_dir, f"{self.sweep_session_id}-*.zip")
+        ):
+            os.remove(archive)
+            logging.info(f"Zipfile '{archive}' successfully removed.")
+
+
+# Formats that are already compressed, deflating them again only costs CPU
+STORED_EXTENSIONS = (
+    ".jpg",
+    ".jpeg",
+    ".png",
+    ".webp",
+    ".heic",
+    ".dng",
+    ".nef",
+    ".cr2",
+    ".cr3",
+    ".arw",
+)
+
+
+class _ZipStream:
+    """Write-only file object that collects what ZipFile writes until it is popped."""
+
+    def __init__(self) -> None:
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self) -> None:
+        pass
+
+    def pop(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_zip(files: Iterable[str], chunk_size: int = 1024 * 1024) -> Iterator[bytes]:
+    """Build a zip of `files` on the fly, yielding it in chunks as it is written."""
+    stream = _ZipStream()
+    # Without seek() ZipFile writes data descriptors instead of patching headers
+    with ZipFile(stream, "w") as zip:
+        for file in files:
+            zip_info = ZipInfo.from_file(file, os.path.basename(file))
+            if file.lower().endswith(STORED_EXTENSIONS):
+                zip_info.compress_type = ZIP_STORED
+            else:
+                zip_info.compress_type = ZIP_DEFLATED
+            with open(file, "rb") as src, zip.open(zip_info, "w") as dest:
+                for chunk in iter(lambda: src.read(chunk_size), b""):
+                    dest.write(chunk)
+                    data = stream.pop()
+                    if data:
+                        yield data
+    yield stream.pop()
+
+
+# Ways to produce the display jpg of a raw file, from cheapest to most expensive
+PREVIEW_STRATEGIES = ("embedded", "half", "full")
+# Embedded previews smaller than this (long side, px) are too small for swiping
+MIN_EMBEDDED_PREVIEW_SIZE = 1024
+# LibRaw's flip of the sensor image (raw.sizes.flip) as the transpose that turns
+# the embedded preview upright, 5 is 90 degrees counterclockwise and 6 clockwise
+FLIP_TRANSPOSES = {
+    3: Image.Transpose.ROTATE_180,
+    5: Image.Transpose.ROTATE_90,
+    6: Image.Transpose.ROTATE_270,
+}
+
+
+def jpg_twin_path(dng_path: str) -> str:
+    """Path of the jpg written next to a raw file."""
+    return os.path.splitext(dng_path)[0] + ".jpg"
+
+
+def convert_dng_to_jpg(dng_path: str, strategy: str = "full") -> Tuple[str, str]:
+    """Write a jpg twin next to a raw file.
+
+    `strategy` is one of PREVIEW_STRATEGIES: "embedded" uses the camera's embedded
+    JPEG preview and falls back to "half", a half-size demosaic, while "full"
+    runs the full-quality postprocessing.
+    """
+    assert strategy in PREVIEW_STRATEGIES
+    jpg_path = jpg_twin_path(dng_path)
 
-def convert_dng_to_jpg(dng_path: str) -> Tuple[str, str]:
     # Open the DNG file
     with rawpy.imread(dng_path) as raw:
+        if strategy == "embedded" and _save_embedded_preview(raw, jpg_path):
+            return jpg_path, dng_path
         # Convert to RGB array
-        rgb = raw.postprocess()
+        if strategy == "full":
+            rgb = raw.postprocess()
+        else:
+            rgb = raw.postprocess(half_size=True, use_camera_wb=True)
 
     # Create a PIL Image object from the RGB array
     img = Image.fromarray(rgb)
-    # Get the directory and filename of the DNG file
-    directory, filename = os.path.split(dng_path)
-    # Generate the path for the JPG file in the same directory
-    jpg_path = os.path.join(directory, os.path.splitext(filename)[0] + ".jpg")
     # Save the PIL Image as a JPG file
     img.save(jpg_path)
 
     return jpg_path, dng_path
 
 
+def _save_embedded_preview(raw: rawpy.RawPy, jpg_path: str) -> bool:
+    """Save the embedded preview of a raw file, False if there is no usable one."""
+    try:
+        thumb = raw.extract_thumb()
+    except (rawpy.LibRawNoThumbnailError, rawpy.LibRawUnsupportedThumbnailError):
+        return False
+
+    transpose = FLIP_TRANSPOSES.get(raw.sizes.flip)
+    if thumb.format == rawpy.ThumbFormat.JPEG:
+        img = Image.open(io.BytesIO(thumb.data))
+        if max(img.size) < MIN_EMBEDDED_PREVIEW_SIZE:
+            return False
+        if transpose is None:
+            # Already an upright JPEG, write the bytes as they are instead of re-encoding
+            with open(jpg_path, "wb") as f:
+                f.write(thumb.data)
+            return True
+    else:
+        img = Image.fromarray(thumb.data)
+        if max(img.size) < MIN_EMBEDDED_PREVIEW_SIZE:
+            return False
+    if transpose is not None:
+        img = img.transpose(transpose)
+    img.save(jpg_path, quality=95)
+    return True
+
+
+# Previews shared by all sessions, named by the content hash of their source file
+CONTENT_DIR = ".content"
+
+
+def content_preview_path(media_folder: str, content_hash: str) -> str:
+    return os.path.join(media_folder, CONTENT_DIR, f"{content_hash}.jpg")
+
+
+def link_file(source: str, target: str) -> None:
+    """Hardlink `source` to `target`, copying where the filesystem can't link."""
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.link(source, target)
+    except FileExistsError:
+        pass
+    except OSError:
+        shutil.copyfile(source, target)
+
+
 def strip_media_folder_from_path(media_folder: str, path: str) -> str:
     return path.replace(media_folder, "")
+
+
+def file_validator(path: str) -> str:
+    """A cheap version tag of a file from its inode, modification time and size.
+
+    Files in the media folder are written once, so a different file or a rewrite
+    always changes the tag; hardlinked copies share it. Only reads the inode.
+    """
+    stat = os.stat(path)
+    key = f"{stat.st_dev}-{stat.st_ino}-{stat.st_mtime_ns}-{stat.st_size}"
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def file_digest(path: str) -> str:
+    """Get the sha256 of a file's contents, memoized until the file changes."""
+    stat = os.stat(path)
+    return _file_digest(path, stat.st_mtime_ns, stat.st_size)
+
+
+@lru_cache(maxsize=65536)
+def _file_digest(path: str, mtime_ns: int, size: int) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
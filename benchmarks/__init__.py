@@ -0,0 +1,11 @@
+"""Benchmarks for the app, run from the project directory, e.g.
+
+    python -m benchmarks.data_access --sizes 1000 10000 --output before.json
+"""
+import os
+import sys
+
+# The app modules import each other by module name, see app/app.py
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
@@ -0,0 +1,215 @@
+"""Time the data-access functions of the app on synthetic sessions of several sizes.
+
+Runs against the database configured for the app (`.env.dev`), so use a local
+Postgres with pgvector. Synthetic data is removed again afterwards. Results
+are written as JSON tagged with the current commit; `--compare` prints the
+change of the median times against an earlier result file. Run from the
+project directory:
+
+    python -m benchmarks.data_access [--sizes 1000 10000 100000] [--repeat 50]
+    python -m benchmarks.data_access --output after.json --compare before.json
+"""
+import json
+import time
+import argparse
+import datetime
+import subprocess
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from benchmarks import synthetic
+from app import (
+    add_embedding_for_sweep_session,
+    app,
+    db,
+    get_images_to_keep,
+    get_nearest_neighbor,
+    get_percentage_reviewed,
+    get_starting_image,
+    remove_session_for_user,
+)
+from models import Embedding, SweepSession
+from sqlalchemy import func, text
+
+CONFIG_KEYS = (
+    "TRAVERSAL_MODE",
+    "NEIGHBOR_GRAPH_K",
+    "EMBEDDING_CACHE_ENABLED",
+    "EMBEDDING_QUANTIZATION",
+    "INGEST_BATCH_SIZE",
+)
+
+
+def summarize(durations: List[float]) -> Dict[str, float]:
+    milliseconds = np.array(durations) * 1000
+    return {
+        "calls": len(durations),
+        "first_ms": round(float(milliseconds[0]), 3),
+        "min_ms": round(float(milliseconds.min()), 3),
+        "median_ms": round(float(np.median(milliseconds)), 3),
+        "p95_ms": round(float(np.percentile(milliseconds, 95)), 3),
+        "mean_ms": round(float(milliseconds.mean()), 3),
+    }
+
+
+def timed(calls: List[Callable[[], object]]) -> Dict[str, float]:
+    durations = []
+    for call in calls:
+        start = time.perf_counter()
+        call()
+        durations.append(time.perf_counter() - start)
+        # Start every call from an empty identity map, like a new request
+        db.session.rollback()
+    return summarize(durations)
+
+
+def benchmark_size(size: int, repeat: int, remove_repeat: int, seed: int) -> dict:
+    email = synthetic.create_user(0).email
+    sweep_session_id = synthetic.create_session(email, size, seed=seed)
+    sweep_session = SweepSession.query.filter_by(sweep_session_token=sweep_session_id).one()
+    query_ids = [
+        image_id
+        for (image_id,) in db.session.query(Embedding.id)
+        .filter_by(sweep_session_token=sweep_session_id, status="unreviewed")
+        .order_by(func.random())
+        .limit(repeat)
+    ]
+    added = synthetic.clustered_embeddings(repeat, seed=seed + size)
+
+    results = {
+        "get_nearest_neighbor": timed(
+            [
+                lambda image_id=image_id: get_nearest_neighbor(sweep_session_id, image_id)
+                for image_id in query_ids
+            ]
+        ),
+        "get_starting_image": timed(
+            [lambda: get_starting_image(sweep_session_id)] * repeat
+        ),
+        "get_percentage_reviewed": timed(
+            [lambda: get_percentage_reviewed(sweep_session_id)] * repeat
+        ),
+        "get_images_to_keep": timed(
+            [lambda: get_images_to_keep(sweep_session_id)] * repeat
+        ),
+        "add_embedding_for_sweep_session": timed(
+            [
+                lambda i=i: add_embedding_for_sweep_session(
+                    sweep_session.id,
+                    f"/{sweep_session_id}/ADDED_{i:06d}.jpg",
+                    f"/{sweep_session_id}/ADDED_{i:06d}.jpg",
+                    added[i],
+                )
+                for i in range(repeat)
+            ]
+        ),
+    }
+
+    # Removing is destructive, so every call gets a fresh session of the same size
+    remove_session_for_user(email, sweep_session_id)
+    removable = [
+        synthetic.create_session(email, size, seed=seed + 1 + i)
+        for i in range(remove_repeat)
+    ]
+    results["remove_session_for_user"] = timed(
+        [
+            lambda token=token: remove_session_for_user(email, token)
+            for token in removable
+        ]
+    )
+    return results
+
+
+def database_versions() -> Dict[str, str]:
+    return {
+        "postgres": db.session.execute(text("SHOW server_version")).scalar(),
+        "pgvector": db.session.execute(
+            text("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+        ).scalar(),
+    }
+
+
+def current_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results: dict, baseline: dict) -> None:
+    """Print the median of every function relative to the baseline run."""
+    print(f"{'size':>8} {'function':<34} {'before':>10} {'after':>10} {'change':>8}")
+    for size, functions in results["results"].items():
+        for function, stats in functions.items():
+            before = baseline["results"].get(size, {}).get(function)
+            if before is None:
+                continue
+            change = stats["median_ms"] / before["median_ms"] - 1 if before["median_ms"] else 0
+            print(
+                f"{size:>8} {function:<34} {before['median_ms']:>8.2f}ms "
+                f"{stats['median_ms']:>8.2f}ms {change:>+8.0%}"
+            )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=50, help="calls per function")
+    parser.add_argument(
+        "--remove-repeat", type=int, default=3, help="sessions removed per size"
+    )
+    parser.add_argument(
+        "--background",
+        type=int,
+        nargs=3,
+        metavar=("USERS", "SESSIONS", "SIZE"),
+        help="other users' sessions in the table while measuring",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="result file, benchmark-<commit>.json by default")
+    parser.add_argument("--compare", help="earlier result file to compare against")
+    args = parser.parse_args()
+
+    commit = current_commit()
+    with app.app_context():
+        results = {
+            "commit": commit,
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "database": database_versions(),
+            "config": {key: app.config[key] for key in CONFIG_KEYS},
+            "repeat": args.repeat,
+            "background": args.background,
+            "results": {},
+        }
+        try:
+            if args.background:
+                print("Creating background sessions...")
+                synthetic.create_synthetic_data(*args.background)
+            for size in args.sizes:
+                print(f"Benchmarking sessions of {size} images...")
+                results["results"][str(size)] = benchmark_size(
+                    size, args.repeat, args.remove_repeat, args.seed
+                )
+        finally:
+            db.session.rollback()
+            synthetic.remove_synthetic_data()
+
+    output = args.output or f"benchmark-{commit}.json"
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    else:
+        print(json.dumps(results["results"], indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+"""Replay swipe sessions against a running app with many users at once.
+
+Every virtual user logs in through the test-auth hook, uploads a session of
+generated images, has it embedded and then replays its decisions through the
+same routes the browser uses, finally downloading the kept images. Latency
+percentiles and throughput are reported per route. Start the app with
+TEST_AUTH_TOKEN set and run from the project directory:
+
+    python -m benchmarks.load --token TOKEN [--users 50] [--concurrency 10]
+    python -m benchmarks.load --save-trace trace.json [--users 50] [--images 40]
+    python -m benchmarks.load --token TOKEN --trace trace.json --output load.json
+
+A trace is {"users": [{"images": 40, "download": true, "decisions": [{"decision":
+"keep" | "discard" | "continue", "position": "left" | "right", "think_time": 0.8}]}]},
+either written by --save-trace or converted from recorded sessions.
+"""
+import io
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import requests
+from PIL import Image
+
+EMAIL_DOMAIN = "bench.invalid"
+DECISIONS = ("keep", "discard", "continue")
+# The legacy routes identify images by their path instead of their id
+LEGACY_ROUTES = {"keep": "like_image", "discard": "drop_image", "continue": "continue_from"}
+IMAGE_PATTERN = re.compile(
+    r'<img src="(?P<src>[^"]+)" alt="(?P<position>left|right)" data-image-id="(?P<id>[^"]*)"'
+)
+
+
+def synthetic_trace(
+    users: int,
+    images: int,
+    decisions: Optional[int] = None,
+    think_time: float = 1.0,
+    seed: int = 0,
+) -> dict:
+    """Random decisions, mostly discards, with exponentially distributed think times."""
+    rng = random.Random(seed)
+    decisions = images - 1 if decisions is None else decisions
+    return {
+        "users": [
+            {
+                "images": images,
+                "download": True,
+                "decisions": [
+                    {
+                        "decision": rng.choices(DECISIONS, weights=(3, 5, 2))[0],
+                        "position": rng.choice(("left", "right")),
+                        "think_time": round(rng.expovariate(1 / think_time), 3)
+                        if think_time
+                        else 0.0,
+                    }
+                    for _ in range(decisions)
+                ],
+            }
+            for _ in range(users)
+        ]
+    }
+
+
+def synthetic_images(count: int, size: int, seed: int) -> List[bytes]:
+    """Distinct jpgs, so sessions of different users don't share content embeddings."""
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(count):
+        pixels = rng.integers(0, 256, (size // 8, size // 8, 3), dtype=np.uint8)
+        image = Image.fromarray(pixels).resize((size, size), Image.BILINEAR)
+        buffer = io.BytesIO()
+        image.save(buffer, "JPEG", quality=85)
+        images.append(buffer.getvalue())
+    return images
+
+
+class Recorder:
+    """Collects request latencies per route from all virtual users."""
+
+    def __init__(self) -> None:
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def record(self, route: str, seconds: float, ok: bool) -> None:
+        with self._lock:
+            self.latencies[route].append(seconds)
+            if not ok:
+                self.errors[route] += 1
+
+    def error(self, route: str) -> None:
+        with self._lock:
+            self.errors[route] += 1
+
+    def report(self, duration: float) -> dict:
+        routes = {}
+        for route in sorted(set(self.latencies) | set(self.errors)):
+            latencies = self.latencies[route]
+            routes[route] = {
+                "requests": len(latencies),
+                "errors": self.errors[route],
+                "throughput_rps": round(len(latencies) / duration, 2),
+            }
+            if latencies:
+                percentiles = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+                for name, value in zip(("p50_ms", "p95_ms", "p99_ms"), percentiles):
+                    routes[route][name] = round(float(value), 2)
+        total = sum(len(latencies) for latencies in self.latencies.values())
+        return {
+            "duration_s": round(duration, 2),
+            "requests": total,
+            "throughput_rps": round(total / duration, 2),
+            "routes": routes,
+        }
+
+
+class VirtualUser:
+    def __init__(
+        self,
+        index: int,
+        base_url: str,
+        token: str,
+        recorder: Recorder,
+        options: argparse.Namespace,
+    ) -> None:
+        self.index = index
+        self.base_url = base_url.rstrip("/")
+        self.recorder = recorder
+        self.options = options
+        self.http = requests.Session()
+        self.http.headers["X-Test-Auth-Token"] = token
+
+    def request(self, route: str, method: str, path: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("allow_redirects", False)
+        kwargs.setdefault("timeout", self.options.timeout)
+        url = path if path.startswith("http") else self.base_url + path
+        start = time.perf_counter()
+        try:
+            response = self.http.request(method, url, **kwargs)
+            if kwargs.get("stream"):
+                for _ in response.iter_content(1024 * 1024):
+                    pass
+        except requests.RequestException:
+            self.recorder.record(route, time.perf_counter() - start, False)
+            raise
+        self.recorder.record(route, time.perf_counter() - start, response.status_code < 400)
+        return response
+
+    def run(self, trace: dict) -> None:
+        try:
+            self.request(
+                "test_login", "POST", "/test_login",
+                json={"email": f"load-{self.index}@{EMAIL_DOMAIN}"},
+            ).raise_for_status()
+            sweep_session_id = self.create_session(trace["images"])
+            try:
+                self.swipe(sweep_session_id, trace["decisions"])
+                if trace.get("download", True):
+                    self.request(
+                        "download_subset", "GET", f"/download/{sweep_session_id}", stream=True
+                    )
+            finally:
+                if not self.options.keep_sessions:
+                    self.request(
+                        "drop_sweep_session", "GET", f"/drop_sweep_session/{sweep_session_id}"
+                    )
+        except Exception as e:
+            print(f"User {self.index} failed: {e}")
+            self.recorder.error("user")
+
+    def create_session(self, images: int) -> str:
+        response = self.request("init_new_sweep_session", "GET", "/init_new_sweep_session")
+        sweep_session_id = response.headers["Location"].rstrip("/").split("/")[-1]
+        for i, image in enumerate(
+            synthetic_images(images, self.options.image_size, seed=self.index)
+        ):
+            self.request(
+                "upload_image", "POST", f"/upload_image/{sweep_session_id}",
+                files={"files": (f"IMG_{i:04d}.jpg", image, "image/jpeg")},
+            ).raise_for_status()
+
+        response = self.request("embed_images", "POST", f"/embed_images/{sweep_session_id}")
+        response.raise_for_status()
+        status_url = response.json()["status_url"]
+        deadline = time.monotonic() + self.options.timeout
+        while time.monotonic() < deadline:
+            status = self.request("ingest_status", "GET", status_url).json()
+            if status["status"] == "finished":
+                return sweep_session_id
+            if status["status"] == "failed":
+                raise RuntimeError(f"Ingestion failed: {status['error']}")
+            time.sleep(self.options.poll_interval)
+        raise RuntimeError(f"Ingestion of {sweep_session_id} timed out")
+
+    def render(self, route: str, path: str) -> Optional[Dict[str, Tuple[str, str]]]:
+        """Load a decision page like the browser, returns the (src, id) shown per side."""
+        response = self.request(route, "GET", path)
+        if response.is_redirect:
+            response = self.request("render_decision_by_id", "GET", response.headers["Location"])
+        images = {
+            match["position"]: (match["src"], match["id"])
+            for match in IMAGE_PATTERN.finditer(response.text)
+        }
+        if len(images) < 2 or any(image_id in ("", "None") for _, image_id in images.values()):
+            return None
+        if self.options.media:
+            for src, _ in images.values():
+                self.request("media", "GET", src)
+        return images
+
+    def swipe(self, sweep_session_id: str, decisions: List[dict]) -> None:
+        images = self.render(
+            "render_decision", f"/sweep/{sweep_session_id}/left=initial/right=initial"
+        )
+        for step in decisions:
+            if images is None:
+                # Nothing left to review
+                return
+            time.sleep(step.get("think_time", 0.0) * self.options.think_scale)
+            position = step["position"]
+            clicked_src, clicked_id = images[position]
+            other_src, other_id = images["right" if position == "left" else "left"]
+            if self.options.api == "decide":
+                response = self.request(
+                    "decide", "POST", "/decide",
+                    json={
+                        "decision": step["decision"],
+                        "clicked_id": clicked_id,
+                        "other_id": other_id,
+                        "position": position,
+                        "sweep_session_id": sweep_session_id,
+                    },
+                )
+                route = "render_decision_by_id"
+            else:
+                response = self.request(
+                    LEGACY_ROUTES[step["decision"]], "POST", "/" + LEGACY_ROUTES[step["decision"]],
+                    json={
+                        "clickedImageSrc": clicked_src,
+                        "otherImageSrc": other_src,
+                        "position": position,
+                        "sweep_session_id": sweep_session_id,
+                    },
+                )
+                route = "render_decision"
+            if response.status_code >= 400:
+                return
+            redirect_url = response.json().get("redirect", "")
+            if "/sweep/" not in redirect_url:
+                return
+            images = self.render(route, redirect_url)
+
+
+def run(trace: dict, options: argparse.Namespace) -> dict:
+    recorder = Recorder()
+    users = trace["users"]
+
+    def start(index: int) -> None:
+        # Spread the start of the users over the ramp up
+        time.sleep(options.ramp_up * index / max(len(users), 1))
+        VirtualUser(index, options.url, options.token, recorder, options).run(users[index])
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=options.concurrency) as executor:
+        list(executor.map(start, range(len(users))))
+    return recorder.report(time.perf_counter() - started)
+
+
+def print_report(report: dict) -> None:
+    print(f"{'route':<26} {'requests':>8} {'errors':>6} {'p50':>9} {'p95':>9} {'p99':>9} {'req/s':>8}")
+    for route, stats in report["routes"].items():
+        percentiles = " ".join(
+            f"{stats[name]:>7.1f}ms" if name in stats else f"{'-':>9}"
+            for name in ("p50_ms", "p95_ms", "p99_ms")
+        )
+        print(
+            f"{route:<26} {stats['requests']:>8} {stats['errors']:>6} "
+            f"{percentiles} {stats['throughput_rps']:>8.2f}"
+        )
+    print(
+        f"{report['requests']} requests in {report['duration_s']}s, "
+        f"{report['throughput_rps']} req/s"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--token", help="the app's TEST_AUTH_TOKEN")
+    parser.add_argument("--trace", help="trace to replay, synthetic decisions otherwise")
+    parser.add_argument("--save-trace", help="write the synthetic trace here and exit")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--images", type=int, default=40, help="images per session")
+    parser.add_argument("--decisions", type=int, help="decisions per user, images - 1 by default")
+    parser.add_argument("--think-time", type=float, default=1.0, help="mean seconds per decision")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--concurrency", type=int, default=10, help="users active at once")
+    parser.add_argument("--ramp-up", type=float, default=0.0, help="seconds until all users started")
+    parser.add_argument(
+        "--think-scale", type=float, default=1.0, help="multiplies think times, 0 swipes flat out"
+    )
+    parser.add_argument(
+        "--api", choices=("decide", "legacy"), default="decide",
+        help="/decide like the decision page, or /like_image, /drop_image and /continue_from",
+    )
+    parser.add_argument("--media", action="store_true", help="also fetch the images shown")
+    parser.add_argument("--image-size", type=int, default=512)
+    parser.add_argument("--keep-sessions", action="store_true", help="don't drop the sessions")
+    parser.add_argument("--poll-interval", type=float, default=0.5)
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--output", help="write the report as JSON")
+    options = parser.parse_args()
+
+    if options.trace:
+        with open(options.trace) as f:
+            trace = json.load(f)
+    else:
+        trace = synthetic_trace(
+            options.users, options.images, options.decisions, options.think_time, options.seed
+        )
+    if options.save_trace:
+        with open(options.save_trace, "w") as f:
+            json.dump(trace, f, indent=2)
+        print(f"Trace of {len(trace['users'])} users written to {options.save_trace}")
+        return
+    if not options.token:
+        parser.error("--token is required to log in through /test_login")
+
+    report = run(trace, options)
+    report["options"] = {
+        "users": len(trace["users"]),
+        "concurrency": options.concurrency,
+        "think_scale": options.think_scale,
+        "api": options.api,
+        "trace": options.trace,
+    }
+    print_report(report)
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""Measure recall@1 of quantized candidate search with full precision re-ranking.
+
+Recall@1 is the share of queries for which the shortlist + re-rank picks the
+same neighbor as the exact `l2_distance` ordering. Without arguments it runs
+on synthetic clustered embeddings in NumPy, simulating what the database
+compares; with `--sweep-session-id` it runs the app's queries against the
+configured database and also reports the size of each vector index. Run from
+the project directory:
+
+    python -m benchmarks.quantization_recall [--rows 20000] [--shortlist 40]
+    python -m benchmarks.quantization_recall --sweep-session-id TOKEN
+"""
+import os
+import json
+import argparse
+from typing import Dict, List
+
+import numpy as np
+
+import benchmarks  # noqa: F401 (puts app/ on the path)
+import quantization
+
+MODES = ("half", "binary")
+VECTOR_INDEXES = (
+    "ix_embeddings_embedding_hnsw",
+    "ix_embeddings_embedding_half_hnsw",
+    "ix_embeddings_embedding_binary_hnsw",
+)
+
+
+def clustered_embeddings(
+    rows: int,
+    clusters: int = 200,
+    noise: float = 1.0,
+    dim: int = quantization.DIM,
+    seed: int = 0,
+) -> np.ndarray:
+    """Unit vectors around random centers, like a photo library of similar shots."""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    members = centers[rng.integers(0, clusters, rows)]
+    embeddings = members + noise * rng.standard_normal((rows, dim)).astype(np.float32)
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+def nearest(matrix: np.ndarray, query_row: int, candidates: np.ndarray = None) -> int:
+    rows = np.arange(len(matrix)) if candidates is None else candidates
+    distances = ((matrix[rows] - matrix[query_row]) ** 2).sum(axis=1)
+    distances[rows == query_row] = np.inf
+    return int(rows[np.argmin(distances)])
+
+
+def shortlist(matrix: np.ndarray, query_row: int, size: int) -> np.ndarray:
+    distances = ((matrix - matrix[query_row]) ** 2).sum(axis=1)
+    distances[query_row] = np.inf
+    return np.argpartition(distances, size)[:size]
+
+
+def synthetic_recall(
+    rows: int, clusters: int, noise: float, queries: int, shortlist_size: int
+) -> Dict[str, dict]:
+    embeddings = clustered_embeddings(rows, clusters, noise)
+    query_rows = np.random.default_rng(1).choice(rows, size=queries, replace=False)
+    exact = {row: nearest(embeddings, row) for row in query_rows}
+
+    results = {}
+    for mode in MODES:
+        quantized = quantization.simulate(embeddings, mode)
+        hits = sum(
+            nearest(embeddings, row, shortlist(quantized, row, shortlist_size))
+            == exact[row]
+            for row in query_rows
+        )
+        results[mode] = {"recall@1": hits / queries}
+    return results
+
+
+def database_recall(sweep_session_id: str, queries: int) -> Dict[str, dict]:
+    from app import (
+        app,
+        db,
+        Embedding,
+        _nearest_neighbors,
+        vector_search,
+    )
+    from sqlalchemy import func, text
+
+    results = {}
+    with app.app_context():
+        images: List[Embedding] = (
+            Embedding.query.filter_by(sweep_session_token=sweep_session_id)
+            .order_by(func.random())
+            .limit(queries)
+            .all()
+        )
+        with vector_search(False):
+            exact = {
+                image.id: [n.id for n in _nearest_neighbors(sweep_session_id, image)]
+                for image in images
+            }
+        db.session.rollback()
+
+        for mode in MODES:
+            try:
+                hits = 0
+                for image in images:
+                    with vector_search(True):
+                        found = _nearest_neighbors(sweep_session_id, image, 1, mode)
+                    hits += [n.id for n in found] == exact[image.id]
+                    db.session.rollback()
+                results[mode] = {"recall@1": hits / max(len(images), 1)}
+            except Exception as e:
+                # Most likely pgvector < 0.7 without halfvec / binary_quantize
+                db.session.rollback()
+                results[mode] = {"error": str(e).splitlines()[0]}
+
+        for index in VECTOR_INDEXES:
+            size = db.session.execute(
+                text("SELECT pg_relation_size(to_regclass(:index))"), {"index": index}
+            ).scalar()
+            results.setdefault("index_bytes", {})[index] = size
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sweep-session-id", help="measure against the database")
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--clusters", type=int, default=200)
+    parser.add_argument("--noise", type=float, default=1.0, help="spread within a cluster")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--shortlist", type=int, default=40)
+    args = parser.parse_args()
+
+    if args.sweep_session_id:
+        os.environ.setdefault("QUANTIZATION_SHORTLIST", str(args.shortlist))
+        results = database_recall(args.sweep_session_id, args.queries)
+    else:
+        results = synthetic_recall(
+            args.rows, args.clusters, args.noise, args.queries, args.shortlist
+        )
+    # Bytes per stored vector (pgvector adds an 8 byte header)
+    dim = quantization.DIM
+    for mode, bytes_per_vector in (("half", 2 * dim + 8), ("binary", dim // 8 + 8)):
+        if "error" not in results[mode]:
+            results[mode]["bytes_per_vector"] = bytes_per_vector
+            results[mode]["compression"] = round((4 * dim + 8) / bytes_per_vector, 1)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
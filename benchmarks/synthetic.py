@@ -0,0 +1,122 @@
+"""Synthetic users, sessions and embeddings for benchmarking against a local database.
+
+All generated users share the `bench.invalid` email domain and all sessions
+a `bench-` token prefix, so they can be told apart from real data and removed
+with `remove_synthetic_data`. Everything here needs an app context.
+"""
+import uuid
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+
+import benchmarks  # noqa: F401 (puts app/ on the path)
+from app import (
+    add_embeddings_for_sweep_session,
+    add_session_for_user,
+    add_user,
+    compute_neighbor_graph,
+    compute_session_tour,
+    db,
+    invalidate_session_caches,
+    load_session_matrix,
+    remove_session_for_user,
+    use_tour,
+)
+from models import Embedding, SweepSession, User
+from benchmarks.quantization_recall import clustered_embeddings
+from sqlalchemy import update
+from flask import current_app
+
+EMAIL_DOMAIN = "bench.invalid"
+TOKEN_PREFIX = "bench-"
+
+
+def synthetic_rows(
+    sweep_session_id: str, embeddings: np.ndarray
+) -> Iterator[Tuple[str, str, np.ndarray, Optional[str]]]:
+    for i, embedding in enumerate(embeddings):
+        path = f"/{sweep_session_id}/IMG_{i:06d}.jpg"
+        yield path, path, embedding, None
+
+
+def create_user(index: int) -> User:
+    email = f"user-{index}@{EMAIL_DOMAIN}"
+    return User.query.filter_by(email=email).first() or add_user(email, f"bench {index}")
+
+
+def create_session(
+    email: str, size: int, reviewed: float = 0.5, index: bool = True, seed: int = 0
+) -> str:
+    """Add a session of `size` images to a user and return its token.
+
+    A `reviewed` share of the images is marked as reviewed, half of them kept.
+    With `index` the tour and neighbor graph are built like after an ingest.
+    """
+    sweep_session_id = f"{TOKEN_PREFIX}{uuid.uuid4().hex}"
+    sweep_session = add_session_for_user(email, sweep_session_id)
+    add_embeddings_for_sweep_session(
+        sweep_session.id,
+        synthetic_rows(sweep_session_id, clustered_embeddings(size, seed=seed)),
+    )
+    if reviewed:
+        ids = [
+            image_id
+            for (image_id,) in db.session.query(Embedding.id).filter_by(
+                sweep_session_token=sweep_session_id
+            )
+        ]
+        statuses = np.random.default_rng(seed).choice(
+            ["reviewed_keep", "reviewed_discard", "unreviewed"],
+            size=len(ids),
+            p=[reviewed / 2, reviewed / 2, 1 - reviewed],
+        )
+        db.session.execute(
+            update(Embedding),
+            [
+                {"id": image_id, "status": str(status)}
+                for image_id, status in zip(ids, statuses)
+            ],
+        )
+        db.session.commit()
+    if index:
+        session_matrix = load_session_matrix(sweep_session_id)
+        if use_tour():
+            compute_session_tour(sweep_session_id, session_matrix)
+        if current_app.config["NEIGHBOR_GRAPH_K"]:
+            compute_neighbor_graph(sweep_session_id, session_matrix)
+    invalidate_session_caches(sweep_session_id)
+    return sweep_session_id
+
+
+def create_synthetic_data(
+    users: int, sessions_per_user: int, size: int, reviewed: float = 0.5, index: bool = True
+) -> List[Tuple[str, str]]:
+    """Create users with sessions of `size` images, returns (email, token) pairs."""
+    created = []
+    for i in range(users):
+        user = create_user(i)
+        for j in range(sessions_per_user):
+            seed = i * sessions_per_user + j
+            created.append(
+                (user.email, create_session(user.email, size, reviewed, index, seed))
+            )
+    return created
+
+
+def remove_synthetic_data() -> int:
+    """Remove all generated sessions and users, returns the number of sessions removed."""
+    sessions = (
+        db.session.query(User.email, SweepSession.sweep_session_token)
+        .join(SweepSession, SweepSession.user_id == User.id)
+        .filter(User.email.like(f"%@{EMAIL_DOMAIN}"))
+        .all()
+    )
+    removed = sum(
+        remove_session_for_user(email, sweep_session_id)
+        for email, sweep_session_id in sessions
+    )
+    User.query.filter(User.email.like(f"%@{EMAIL_DOMAIN}")).delete(
+        synchronize_session=False
+    )
+    db.session.commit()
+    return removed
@@ -0,0 +1,120 @@
+import threading
+
+import numpy as np
+import pytest
+from werkzeug.serving import make_server
+
+import embeddings
+import embeddings_stub
+
+
+class FailingFirst:
+    """WSGI middleware answering the first `failures` requests with a 503."""
+
+    def __init__(self, app, failures: int) -> None:
+        self.app = app
+        self.failures = failures
+        self.requests = 0
+
+    def __call__(self, environ, start_response):
+        self.requests += 1
+        if self.requests <= self.failures:
+            start_response("503 Service Unavailable", [("Content-Length", "0")])
+            return [b""]
+        return self.app(environ, start_response)
+
+
+@pytest.fixture
+def media_folder(tmp_path):
+    for i in range(10):
+        (tmp_path / f"IMG_{i}.jpg").write_bytes(f"image {i}".encode())
+    return tmp_path
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def serve(wsgi_app) -> str:
+        server = make_server("127.0.0.1", 0, wsgi_app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_port}"
+
+    yield serve
+    for server in servers:
+        server.shutdown()
+
+
+def expected(media_folder, names):
+    return np.stack([embeddings_stub.stub_embedding(str(media_folder / n)) for n in names])
+
+
+def test_wire_format_round_trip():
+    matrix = np.random.default_rng(0).standard_normal((3, 4)).astype(np.float32)
+    decoded = embeddings.decode_embeddings(embeddings.encode_embeddings(matrix))
+    np.testing.assert_array_equal(decoded, matrix)
+    plain = embeddings.decode_embeddings({"embeddings": matrix.tolist()})
+    np.testing.assert_array_equal(plain, matrix)
+
+
+def test_embed_keeps_input_order_across_batches(media_folder, serve):
+    base_url = serve(embeddings_stub.create_stub_app(str(media_folder)))
+    client = embeddings.EmbeddingsClient(base_url, batch_size=3, max_concurrency=2)
+    names = [f"IMG_{i}.jpg" for i in range(10)]
+    try:
+        results = list(client.embed(names))
+    finally:
+        client.close()
+    assert [name for name, _ in results] == names
+    np.testing.assert_allclose(
+        np.stack([embedding for _, embedding in results]), expected(media_folder, names)
+    )
+
+
+def test_embed_retries_unavailable_service(media_folder, serve):
+    stub = FailingFirst(embeddings_stub.create_stub_app(str(media_folder)), failures=1)
+    client = embeddings.EmbeddingsClient(serve(stub), batch_size=4, retries=2)
+    try:
+        results = list(client.embed(["IMG_0.jpg", "IMG_1.jpg"]))
+    finally:
+        client.close()
+    assert stub.requests == 2
+    assert all(embedding is not None for _, embedding in results)
+
+
+def test_failed_batch_yields_none(media_folder, serve):
+    base_url = serve(embeddings_stub.create_stub_app(str(media_folder)))
+    client = embeddings.EmbeddingsClient(base_url, batch_size=2)
+    try:
+        results = dict(client.embed(["IMG_0.jpg", "IMG_1.jpg", "missing.jpg", "IMG_2.jpg"]))
+    finally:
+        client.close()
+    # Only the batch with the missing image fails
+    assert results["IMG_0.jpg"] is not None and results["IMG_1.jpg"] is not None
+    assert results["missing.jpg"] is None and results["IMG_2.jpg"] is None
+
+
+def test_gives_up_after_retries(media_folder, serve):
+    stub = FailingFirst(embeddings_stub.create_stub_app(str(media_folder)), failures=100)
+    client = embeddings.EmbeddingsClient(serve(stub), retries=1)
+    try:
+        results = list(client.embed(["IMG_0.jpg"]))
+    finally:
+        client.close()
+    assert stub.requests == 2
+    assert results == [("IMG_0.jpg", None)]
+
+
+def test_falls_back_to_the_per_image_endpoint(media_folder, serve):
+    stub = embeddings_stub.create_stub_app(str(media_folder), batch_endpoint=False)
+    client = embeddings.EmbeddingsClient(serve(stub), batch_size=3)
+    names = [f"IMG_{i}.jpg" for i in range(5)]
+    try:
+        results = list(client.embed(names))
+    finally:
+        client.close()
+    assert not client.batch_endpoint
+    np.testing.assert_allclose(
+        np.stack([embedding for _, embedding in results]), expected(media_folder, names)
+    )
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+import neighbor_graph
+
+
+def brute_force(matrix: np.ndarray, k: int):
+    distances = ((matrix[:, None, :] - matrix[None, :, :]) ** 2).sum(axis=2)
+    np.fill_diagonal(distances, np.inf)
+    neighbors = np.argsort(distances, axis=1, kind="stable")[:, :k]
+    return neighbors, np.take_along_axis(distances, neighbors, axis=1)
+
+
+@pytest.mark.parametrize("block_size", [None, 1, 7])
+def test_knn_graph_matches_brute_force(block_size):
+    matrix = np.random.default_rng(0).standard_normal((60, 8)).astype(np.float32)
+    neighbors, distances = neighbor_graph.knn_graph(matrix, 5, block_size=block_size)
+    expected_neighbors, expected_distances = brute_force(matrix, 5)
+    assert neighbors.shape == distances.shape == (60, 5)
+    np.testing.assert_array_equal(neighbors, expected_neighbors)
+    np.testing.assert_allclose(distances, expected_distances, rtol=1e-4, atol=1e-4)
+
+
+def test_knn_graph_excludes_the_row_itself():
+    matrix = np.zeros((4, 3), dtype=np.float32)
+    neighbors, distances = neighbor_graph.knn_graph(matrix, 3)
+    for row, row_neighbors in enumerate(neighbors):
+        assert row not in row_neighbors
+        assert sorted(row_neighbors.tolist()) == [i for i in range(4) if i != row]
+    assert (distances == 0).all()
+
+
+def test_knn_graph_caps_k_at_the_other_rows():
+    matrix = np.random.default_rng(1).standard_normal((3, 4)).astype(np.float32)
+    neighbors, _ = neighbor_graph.knn_graph(matrix, 10)
+    assert neighbors.shape == (3, 2)
+
+
+def test_knn_graph_of_a_single_row():
+    neighbors, distances = neighbor_graph.knn_graph(np.ones((1, 4), dtype=np.float32), 10)
+    assert neighbors.shape == distances.shape == (1, 0)
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+from pgvector.sqlalchemy import Vector
+from sqlalchemy import column
+from sqlalchemy.dialects import postgresql
+
+import quantization
+
+
+def compile_sql(expression) -> str:
+    return str(expression.compile(dialect=postgresql.dialect()))
+
+
+def test_simulate_half_rounds_to_float16():
+    matrix = np.array([[0.1, -0.2, 1 / 3]], dtype=np.float32)
+    simulated = quantization.simulate(matrix, "half")
+    assert simulated.dtype == np.float32
+    np.testing.assert_array_equal(simulated, matrix.astype(np.float16).astype(np.float32))
+    np.testing.assert_allclose(simulated, matrix, atol=1e-3)
+
+
+def test_simulate_binary_keeps_sign_bits():
+    matrix = np.array([[0.5, -0.1, 0.0, 2.0]], dtype=np.float32)
+    assert quantization.simulate(matrix, "binary").tolist() == [[1.0, 0.0, 0.0, 1.0]]
+
+
+def test_simulate_none_is_the_identity():
+    matrix = np.ones((2, 3), dtype=np.float32)
+    assert quantization.simulate(matrix, "none") is matrix
+
+
+def test_half_distance_casts_both_sides():
+    embedding = column("embedding", Vector(quantization.DIM))
+    query = np.zeros(quantization.DIM, dtype=np.float32)
+    sql = compile_sql(quantization.quantized_distance(embedding, query, "half"))
+    assert sql.count(f"AS halfvec({quantization.DIM})") == 2
+    assert "<->" in sql
+
+
+def test_binary_distance_uses_hamming_on_sign_bits():
+    embedding = column("embedding", Vector(quantization.DIM))
+    query = np.zeros(quantization.DIM, dtype=np.float32)
+    sql = compile_sql(quantization.quantized_distance(embedding, query, "binary"))
+    assert sql.count("binary_quantize(") == 2
+    assert sql.count(f"AS BIT({quantization.DIM})") == 2
+    assert "<~>" in sql
+
+
+def test_quantize_rejects_unknown_modes():
+    with pytest.raises(ValueError):
+        quantization.quantize(column("embedding", Vector(quantization.DIM)), "int8")
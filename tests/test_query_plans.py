@@ -0,0 +1,19 @@
+import os
+
+import pytest
+from dotenv import find_dotenv, load_dotenv
+
+# The same configuration the app loads on import
+load_dotenv(find_dotenv(".env.dev"))
+
+pytestmark = pytest.mark.skipif(
+    not os.getenv("DATABASE_URI"), reason="needs a Postgres database with pgvector"
+)
+
+
+def test_hot_queries_use_indices():
+    import query_plans
+
+    with query_plans.app.app_context():
+        failures = query_plans.check_query_plans(*query_plans.check_target())
+    assert failures == {}
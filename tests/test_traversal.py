@@ -0,0 +1,46 @@
+import numpy as np
+
+import traversal
+
+
+def random_matrix(rows: int, dim: int = 16, seed: int = 0) -> np.ndarray:
+    return np.random.default_rng(seed).standard_normal((rows, dim)).astype(np.float32)
+
+
+def test_greedy_tour_visits_every_row_once():
+    matrix = random_matrix(200)
+    order = traversal.greedy_tour(matrix, start=17)
+    assert order[0] == 17
+    assert sorted(order.tolist()) == list(range(200))
+
+
+def test_greedy_tour_follows_nearest_neighbors():
+    positions = np.random.default_rng(1).permutation(50)
+    matrix = positions[:, None].astype(np.float32)
+    start = int(np.argmin(positions))
+    order = traversal.greedy_tour(matrix, start=start)
+    assert positions[order].tolist() == list(range(50))
+
+
+def test_greedy_tour_of_empty_matrix():
+    assert len(traversal.greedy_tour(np.empty((0, 16), dtype=np.float32))) == 0
+
+
+def test_two_opt_uncrosses_a_tour():
+    matrix = np.array([[0, 0], [1, 0], [2, 0], [3, 0], [4, 0]], dtype=np.float32)
+    crossed = np.array([0, 3, 2, 1, 4])
+    order = traversal.two_opt(matrix, crossed)
+    assert order.tolist() == [0, 1, 2, 3, 4]
+
+
+def test_two_opt_never_lengthens_a_tour():
+    matrix = random_matrix(300, seed=2)
+    greedy = traversal.greedy_tour(matrix)
+    order = traversal.two_opt(matrix, greedy, window=20, passes=3)
+    assert sorted(order.tolist()) == list(range(300))
+    assert traversal.tour_length(matrix, order) <= traversal.tour_length(matrix, greedy)
+
+
+def test_tour_length():
+    matrix = np.array([[0, 0], [3, 4], [3, 0]], dtype=np.float32)
+    assert traversal.tour_length(matrix, np.array([0, 1, 2])) == 9.0